@@ -9,7 +9,6 @@ from uuid import uuid4
 import json
 from config import ADMIN_TELEGRAM_ID
 from storage.database import async_session_maker, User, Config, Server, PendingPayment, get_or_create_user
-from services.xui_manager import XUIManager
 from utils.helpers import generate_random_prefix, gb_to_bytes, get_next_config_number
 from utils.link_builder import build_vless_reality_link
 from handlers.payment import process_skip_payment
@@ -1,8 +1,9 @@
 # handlers/admin_panel.py
 import asyncio
+import html
 import json
 import logging
-from datetime import datetime, timezone
+from datetime import datetime
 from typing import List
 from sqlalchemy import func, select
 from aiogram.exceptions import TelegramBadRequest
@@ -12,10 +13,21 @@ from aiogram.filters import Command, StateFilter
 from aiogram.enums import ParseMode
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from utils.helpers import format_tariff_name, format_duration_human
+from utils.helpers import format_tariff_name, format_duration_human, now_ts, from_ts
+from utils.cache import my_configs_cache, invalidate_user_configs
 from config import ADMIN_TELEGRAM_ID
-from storage.database import async_session_maker, User, Server, Config, Promocode, Tariff
-from services.xui_manager import XUIManager
+from storage.database import async_session_maker, User, Server, Config, Promocode
+from services.xui_manager import get_xui_manager, invalidate_xui_manager
+from services.server_registry import server_registry
+from services.tariff_service import get_all_tariffs, create_tariff, set_tariff_price, delete_tariff as delete_tariff_by_id
+from services.traffic_stats import get_total_usage, day_bucket, month_bucket
+from services.message_sender import outbound
+from services.crypto_pay import get_crypto_pay_client
+from services.reconcile_service import reconcile_server, repair_server, format_reconcile_report, has_discrepancies
+from services.broadcast_service import (
+    create_broadcast_job, set_progress_message, start_broadcast_job, cancel_broadcast_job,
+    format_progress, progress_keyboard,
+)
 
 router = Router()
 logger = logging.getLogger(__name__)
@@ -84,20 +96,15 @@ async def process_new_price(message: Message, state: FSMContext):
     data = await state.get_data()
     tariff_id = data["editing_tariff_id"]
 
-    async with async_session_maker() as session:
-        tariff = await session.get(Tariff, tariff_id)
-        if not tariff:
-            await message.answer("❌ Тариф не найден.")
-            await state.clear()
-            return
-        tariff.price_rub = new_price
-        await session.commit()
+    if not await set_tariff_price(int(tariff_id), new_price):
+        await message.answer("❌ Тариф не найден.")
+        await state.clear()
+        return
 
     await message.answer("✅ Цена обновлена!")
     await state.clear()
     # Вернём в админ-меню тарифов — но нужно callback
     # Поскольку мы в message, просто отправим новое сообщение
-    from services.tariff_service import get_all_tariffs
     tariffs = await get_all_tariffs()
     text = "<b>💳 Тарифы:</b>\n\n"
     for t in tariffs:
@@ -133,55 +140,26 @@ async def admin_broadcast_start(callback: CallbackQuery, state: FSMContext):
 @router.message(StateFilter(AdminStates.waiting_for_broadcast))
 async def handle_broadcast_message(message: Message, state: FSMContext, bot: Bot):
     await state.clear()
-    
-    # Получаем всех пользователей
-    async with async_session_maker() as session:
-        result = await session.execute(User.__table__.select())
-        users = result.fetchall()
-    
-    success_count = 0
-    total = len(users)
-    
-    await message.answer(f"📤 Начинаю рассылку {total} пользователям...")
-    
-    for user in users:
-        try:
-            if message.text:
-                await bot.send_message(user.tg_id, message.text, parse_mode=ParseMode.HTML)
-            elif message.photo:
-                photo = message.photo[-1]  # самое большое
-                await bot.send_photo(
-                    user.tg_id,
-                    photo.file_id,
-                    caption=message.caption,
-                    parse_mode=ParseMode.HTML if message.caption else None
-                )
-            elif message.document:
-                await bot.send_document(
-                    user.tg_id,
-                    message.document.file_id,
-                    caption=message.caption,
-                    parse_mode=ParseMode.HTML if message.caption else None
-                )
-            elif message.video:
-                await bot.send_video(
-                    user.tg_id,
-                    message.video.file_id,
-                    caption=message.caption,
-                    parse_mode=ParseMode.HTML if message.caption else None
-                )
-            else:
-                # Пересылка (если нельзя отправить как есть)
-                await bot.forward_message(user.tg_id, message.chat.id, message.message_id)
-            
-            success_count += 1
-            await asyncio.sleep(0.05)  # защита от flood
-            
-        except Exception as e:
-            # Пользователь заблокировал бота или удалил чат — пропускаем
-            continue
-    
-    await message.answer(f"✅ Рассылка завершена!\nУспешно: {success_count}/{total}")
+
+    # Рассылка — сохраняемое задание: пользователи получают копию этого сообщения,
+    # прогресс пишется в БД и переживает перезапуск бота
+    job = await create_broadcast_job(message.chat.id, message.message_id, message.chat.id)
+    progress = await message.answer(
+        format_progress(job),
+        parse_mode=ParseMode.HTML,
+        reply_markup=progress_keyboard(job)
+    )
+    await set_progress_message(job.id, progress.message_id)
+    start_broadcast_job(bot, job.id)
+
+@router.callback_query(F.data.startswith("broadcast_cancel_"), admin_only())
+async def cancel_broadcast(callback: CallbackQuery):
+    job_id = int(callback.data.split("_")[-1])
+    if await cancel_broadcast_job(job_id):
+        await callback.answer("⛔ Рассылка будет остановлена после текущей пачки")
+        await callback.message.edit_reply_markup(reply_markup=None)
+    else:
+        await callback.answer("Рассылка уже завершена", show_alert=True)
 
 @router.callback_query(F.data == "admin_menu", admin_only())
 async def admin_menu(callback: CallbackQuery, state: FSMContext):
@@ -214,10 +192,100 @@ async def edit_server_start(callback: CallbackQuery):
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🗑️ Удалить сервер", callback_data=f"delete_server_{server_id}")],
         [InlineKeyboardButton(text="🔄 Переключить статус", callback_data=f"toggle_server_{server_id}")],
+        [InlineKeyboardButton(text="🔑 Обновить параметры inbound", callback_data=f"refresh_inbound_{server_id}")],
+        [InlineKeyboardButton(text="🔍 Сверка с панелью", callback_data=f"reconcile_server_{server_id}")],
         [InlineKeyboardButton(text="⬅️ Назад к списку", callback_data="admin_servers")]
     ])
     await callback.message.edit_text(text, reply_markup=kb, parse_mode=ParseMode.HTML)
 
+@router.callback_query(F.data.startswith("refresh_inbound_"), admin_only())
+async def refresh_inbound_params(callback: CallbackQuery):
+    """Сбрасывает кэш параметров inbound (например, после смены ключей REALITY в панели)."""
+    server_id = callback.data.split("_", 2)[-1]
+    server = server_registry.get(server_id)
+    if not server:
+        await callback.answer("Сервер не найден.", show_alert=True)
+        return
+    try:
+        xui = await get_xui_manager(server)
+        xui.invalidate_inbound_params(server.inbound_id)
+        params = await xui.get_inbound_params(server.inbound_id)
+    except Exception as e:
+        logger.error(f"Ошибка обновления inbound для {server_id}: {e}")
+        await callback.answer(f"❌ Ошибка: {e}", show_alert=True)
+        return
+    await callback.answer(
+        f"✅ Inbound обновлён: порт {params['port']}, {params['network']['network']}, SNI {params['reality']['sni']}",
+        show_alert=True
+    )
+
+@router.callback_query(F.data.startswith("reconcile_server_"), admin_only())
+async def reconcile_server_report(callback: CallbackQuery):
+    """Сверка configs с inbound'ом панели: только отчёт, исправление — отдельной кнопкой."""
+    server_id = callback.data.split("_", 2)[-1]
+    server = server_registry.get(server_id)
+    if not server:
+        await callback.answer("Сервер не найден.", show_alert=True)
+        return
+    await callback.answer("⏳ Сверяем с панелью...")
+    try:
+        report = await reconcile_server(server)
+    except Exception as e:
+        logger.error(f"Ошибка сверки сервера {server_id}: {e}")
+        await callback.message.edit_text(
+            f"❌ Не удалось сверить сервер {server_id}: {e}",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="⬅️ К серверу", callback_data=f"edit_server_{server_id}")]
+            ])
+        )
+        return
+
+    buttons = []
+    if has_discrepancies(report):
+        buttons.append([InlineKeyboardButton(text="🧹 Исправить", callback_data=f"reconcile_fix_{server_id}")])
+    buttons.append([InlineKeyboardButton(text="🔄 Повторить", callback_data=f"reconcile_server_{server_id}")])
+    buttons.append([InlineKeyboardButton(text="⬅️ К серверу", callback_data=f"edit_server_{server_id}")])
+    await callback.message.edit_text(
+        format_reconcile_report(report),
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons),
+        parse_mode=ParseMode.HTML
+    )
+
+@router.callback_query(F.data.startswith("reconcile_fix_"), admin_only())
+async def reconcile_server_fix(callback: CallbackQuery):
+    """Повторная сверка (отчёт на экране мог устареть) и исправление расхождений."""
+    server_id = callback.data.split("_", 2)[-1]
+    server = server_registry.get(server_id)
+    if not server:
+        await callback.answer("Сервер не найден.", show_alert=True)
+        return
+    await callback.answer("⏳ Исправляем...")
+    try:
+        result = await repair_server(server, await reconcile_server(server))
+    except Exception as e:
+        logger.error(f"Ошибка исправления сверки {server_id}: {e}")
+        await callback.message.edit_text(
+            f"❌ Не удалось исправить сервер {server_id}: {e}",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="⬅️ К серверу", callback_data=f"edit_server_{server_id}")]
+            ])
+        )
+        return
+
+    await callback.message.edit_text(
+        f"<b>🧹 Сервер {server_id}: расхождения исправлены</b>\n\n"
+        f"Удалено клиентов из панели: {result['ghosts_deleted']}\n"
+        f"Оставлено созданных вручную: {result['ghosts_skipped']}\n"
+        f"Удалено истёкших конфигов из БД: {result['rows_deleted']}\n"
+        f"Отключено конфигов без клиента: {result['rows_deactivated']}\n"
+        f"Пропущено (расхождение исчезло при перепроверке): {result['rechecked_ok']}",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="🔍 Сверить ещё раз", callback_data=f"reconcile_server_{server_id}")],
+            [InlineKeyboardButton(text="⬅️ К серверу", callback_data=f"edit_server_{server_id}")]
+        ]),
+        parse_mode=ParseMode.HTML
+    )
+
 @router.callback_query(F.data.startswith("toggle_server_"), admin_only())
 async def toggle_server_status(callback: CallbackQuery):
     server_id = callback.data.split("_", 2)[-1]
@@ -228,6 +296,7 @@ async def toggle_server_status(callback: CallbackQuery):
             return
         server.active = not server.active
         await session.commit()
+    await server_registry.reload()
     await edit_server_start(callback)  # Обновить карточку
 
 @router.callback_query(F.data.startswith("delete_server_"), admin_only())
@@ -240,6 +309,8 @@ async def delete_server(callback: CallbackQuery, state: FSMContext):
             return
         await session.delete(server)
         await session.commit()
+    await server_registry.reload()
+    await invalidate_xui_manager(server_id)
     
     await callback.answer("✅ Сервер удалён", show_alert=False)
     # Правильно: вызываем с тем же state
@@ -253,49 +324,53 @@ async def admin_stats(callback: CallbackQuery, state: FSMContext):
 
 
 async def _update_stats_message(message):
-    now_iso = datetime.now(timezone.utc).isoformat()
+    now = now_ts()
 
     async with async_session_maker() as session:
-        # Пользователи
-        user_result = await session.execute(select(User))
-        users = user_result.scalars().all()
-        
-        # Все конфиги
-        config_result = await session.execute(select(Config))
-        all_configs = config_result.scalars().all()
-        
-        # Активные конфиги = active=True И expiry > сейчас
-        active_configs = [
-            c for c in all_configs 
-            if c.active and c.expiry and c.expiry > now_iso
-        ]
-        
-        # Уникальные пользователи с активными конфигами
-        active_user_ids = {c.user_tg_id for c in active_configs}
-        active_users_count = len(active_user_ids)
-        
-        # Сервера
-        server_result = await session.execute(select(Server))
-        servers = server_result.scalars().all()
-        active_servers = [s for s in servers if s.active]
-        
-        # Трафик
-        total_traffic = sum(
-            int(cfg.traffic_used_bytes) 
-            for cfg in all_configs 
-            if cfg.traffic_used_bytes and cfg.traffic_used_bytes.isdigit()
-        )
-        total_gb = total_traffic / (1024 ** 3)
+        # Всё считается агрегатами на стороне БД, строки в Python не загружаются
+        users_count = (await session.execute(select(func.count()).select_from(User))).scalar()
+
+        configs_count, total_traffic = (await session.execute(
+            select(func.count(), func.coalesce(func.sum(Config.traffic_used_bytes), 0)).select_from(Config)
+        )).one()
+
+        # Активные конфиги = active=True И expiry > сейчас (индекс ix_configs_active_expiry)
+        active_configs_count, active_users_count = (await session.execute(
+            select(func.count(), func.count(func.distinct(Config.user_tg_id)))
+            .where(Config.active == True, Config.expiry > now)
+        )).one()
+
+    # Сервера
+    servers = server_registry.all()
+    active_servers = server_registry.active()
+    total_gb = total_traffic / (1024 ** 3)
+
+    # Трафик за сегодня и за месяц — из инкрементальных сумм
+    today_gb = await get_total_usage("day", day_bucket(now)) / (1024 ** 3)
+    month_gb = await get_total_usage("month", month_bucket(now)) / (1024 ** 3)
+    sent = outbound.stats()
+    cache = my_configs_cache.stats()
+    crypto = get_crypto_pay_client().stats()
     
     text = (
         "<b>📊 Статистика</b>\n\n"
-        f"👥 <b>Пользователей:</b> {len(users)}\n"
+        f"👥 <b>Пользователей:</b> {users_count}\n"
         f"   └─ С активной подпиской: {active_users_count}\n\n"
-        f"🔌 <b>Конфигураций:</b> {len(all_configs)}\n"
-        f"   └─ Активных: {len(active_configs)}\n\n"
+        f"🔌 <b>Конфигураций:</b> {configs_count}\n"
+        f"   └─ Активных: {active_configs_count}\n\n"
         f"🌐 <b>Серверов:</b> {len(servers)}\n"
         f"   └─ Активных: {len(active_servers)}\n\n"
         f"📈 <b>Использовано трафика:</b> {total_gb:.2f} ГБ\n"
+        f"   ├─ Сегодня: {today_gb:.2f} ГБ\n"
+        f"   └─ В этом месяце: {month_gb:.2f} ГБ\n"
+        f"📨 <b>Исходящие сообщения:</b> {sent['last_minute']} за минуту\n"
+        f"   ├─ Всего с запуска: {sent['sent']} (в очереди: {sent['queued']})\n"
+        f"   └─ RetryAfter от Telegram: {sent['retry_after']}\n"
+        f"🗂️ <b>Кэш «Мои конфиги»:</b> {cache['hit_rate']:.0%} попаданий\n"
+        f"   ├─ Попаданий / промахов: {cache['hits']} / {cache['misses']}\n"
+        f"   └─ Записей: {cache['size']}/{cache['max_entries']} (вытеснено: {cache['evictions']})\n"
+        f"💳 <b>Crypto Pay:</b> {crypto['avg_ms']:.0f} мс в среднем, p95 {crypto['p95_ms']:.0f} мс\n"
+        f"   └─ Запросов: {crypto['requests']} (ошибок: {crypto['errors']}, повторов: {crypto['retries']})\n"
         f"🕒 <b>Обновлено:</b> {datetime.now().strftime('%d.%m %H:%M')}"
     )
     
@@ -390,7 +465,8 @@ async def admin_add_server_start(callback: CallbackQuery, state: FSMContext):
         '  "subscription_path": "/sub",\n'
         '  "subscription_port": "2096",\n'
         '  "active": true\n'
-        "}</code>",
+        "}</code>\n\n"
+        "Несколько серверов можно добавить одним сообщением — массивом <code>[{...}, {...}]</code>.",
         parse_mode=ParseMode.HTML,
         reply_markup=InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="⬅️ Отмена", callback_data="admin_servers")]
@@ -473,9 +549,7 @@ async def admin_backup(callback: CallbackQuery, state: FSMContext):
 
 
 async def _get_backup_servers_keyboard():
-    async with async_session_maker() as session:
-        result = await session.execute(Server.__table__.select().where(Server.active == True))
-        servers = result.fetchall()
+    servers = server_registry.active()
     
     buttons = [
         [InlineKeyboardButton(text=f"{s.country} ({s.city})", callback_data=f"backup_server_{s.id}")]
@@ -489,24 +563,15 @@ async def _get_backup_servers_keyboard():
 async def backup_server(callback: CallbackQuery, bot: Bot):
     server_id = callback.data.split("_", 2)[-1]
     
-    async with async_session_maker() as session:
-        server_result = await session.execute(
-            Server.__table__.select().where(Server.id == server_id)
-        )
-        server = server_result.fetchone()
-        if not server:
-            await callback.message.edit_text("❌ Сервер не найден.")
-            return
+    server = server_registry.get(server_id)
+    if not server:
+        await callback.message.edit_text("❌ Сервер не найден.")
+        return
 
     try:
         await callback.message.edit_text("⏳ Создание бэкапа конфигурации...")
 
-        xui = XUIManager(
-            base_url=server.xui_url,
-            username=server.xui_username,
-            password=server.xui_password,
-            server_id=server_id
-        )
+        xui = await get_xui_manager(server)
         
         backup_data = await xui.backup()
         filename = f"xray_config_{server_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
@@ -521,13 +586,10 @@ async def backup_server(callback: CallbackQuery, bot: Bot):
     except Exception as e:
         logger.error(f"Ошибка бэкапа для {server_id}: {e}")
         await callback.message.edit_text(f"❌ Ошибка: {e}")
-    finally:
-        await xui.close()
 
 @router.callback_query(F.data == "admin_tariffs", admin_only())
 async def admin_tariffs(callback: CallbackQuery, state: FSMContext):
     await state.clear()
-    from services.tariff_service import get_all_tariffs
     tariffs = await get_all_tariffs()
     
     text = "<b>💳 Тарифы:</b>\n\n"
@@ -552,13 +614,9 @@ async def admin_tariffs(callback: CallbackQuery, state: FSMContext):
 @router.callback_query(F.data.startswith("tariff_delete_"), admin_only())
 async def delete_tariff(callback: CallbackQuery, state: FSMContext):
     tariff_id = int(callback.data.split("_")[-1])
-    async with async_session_maker() as session:
-        tariff = await session.get(Tariff, tariff_id)
-        if not tariff:
-            await callback.answer("Тариф не найден.", show_alert=True)
-            return
-        await session.delete(tariff)
-        await session.commit()
+    if not await delete_tariff_by_id(tariff_id):
+        await callback.answer("Тариф не найден.", show_alert=True)
+        return
     await callback.answer("✅ Тариф удалён", show_alert=False)
     await admin_tariffs(callback, state)
 
@@ -736,42 +794,30 @@ async def admin_reset_traffic(callback: CallbackQuery):
 
             # 2. Получаем сервер
             server_id = config_row.server_id
-            server_result = await session.execute(
-                Server.__table__.select().where(Server.id == server_id)
-            )
-            server_row = server_result.fetchone()
+            server_row = server_registry.get(server_id)
             if not server_row:
                 await callback.message.edit_text("❌ Сервер не найден.")
                 return
 
             # 3. Сбрасываем трафик через XUIManager
-            xui = XUIManager(
-                base_url=server_row.xui_url,
-                username=server_row.xui_username,
-                password=server_row.xui_password,
-                server_id=server_id
-            )
-            try:
-                # Выполняем настоящий сброс на сервере
-                success = await xui.reset_client_traffic(server_row.inbound_id, config_row.client_email)
-                if not success:
-                    raise Exception("Не удалось сбросить трафик в панели 3x-ui")
-
-                # Обновляем флаги в БД (чтобы уведомления приходили снова)
-                await session.execute(
-                    Config.__table__.update()
-                    .where(Config.id == config_id)
-                    .values(
-                        notify_traffic_80_sent=False,
-                        notify_traffic_95_sent=False
-                    )
+            xui = await get_xui_manager(server_row)
+            # Выполняем настоящий сброс на сервере
+            success = await xui.reset_client_traffic(server_row.inbound_id, config_row.client_email)
+            if not success:
+                raise Exception("Не удалось сбросить трафик в панели 3x-ui")
+
+            # Обновляем флаги в БД (чтобы уведомления приходили снова)
+            await session.execute(
+                Config.__table__.update()
+                .where(Config.id == config_id)
+                .values(
+                    notify_traffic_80_sent=False,
+                    notify_traffic_95_sent=False
                 )
-                await session.commit()
-
-                await callback.message.edit_text("✅ Трафик успешно сброшен!")
+            )
+            await session.commit()
 
-            finally:
-                await xui.close()
+            await callback.message.edit_text("✅ Трафик успешно сброшен!")
 
     except Exception as e:
         logger.error(f"Ошибка сброса трафика для админа: {e}")
@@ -792,25 +838,15 @@ async def admin_delete_config(callback: CallbackQuery):
             return
 
         # Удаляем из X-UI
-        server_result = await session.execute(
-            Server.__table__.select().where(Server.id == config.server_id)
-        )
-        server = server_result.fetchone()
+        server = server_registry.get(config.server_id)
         if server:
-            xui = XUIManager(
-                base_url=server.xui_url,
-                username=server.xui_username,
-                password=server.xui_password,
-                server_id=server.id
-            )
-            try:
-                await xui.delete_client_by_email(int(server.inbound_id), config.client_email)
-            finally:
-                await xui.close()
+            xui = await get_xui_manager(server)
+            await xui.delete_client_by_email(int(server.inbound_id), config.client_email)
 
         # Удаляем из БД бота
         await session.execute(Config.__table__.delete().where(Config.id == config_id))
         await session.commit()
+        invalidate_user_configs(config.user_tg_id)
         await callback.message.edit_text("✅ Конфиг удалён!")
 
 @router.callback_query(F.data.startswith("admin_user_configs_"), admin_only())
@@ -861,21 +897,18 @@ async def admin_config_detail(callback: CallbackQuery):
         # Получаем сервер (если есть)
         server_name = "—"
         if cfg.server_id:
-            server_result = await session.execute(
-                Server.__table__.select().where(Server.id == cfg.server_id)
-            )
-            server = server_result.fetchone()
+            server = server_registry.get(cfg.server_id)
             if server:
                 server_name = f"{server.country} ({server.city})"
         
-        used_gb = int(cfg.traffic_used_bytes) / (1024 ** 3) if cfg.traffic_used_bytes.isdigit() else 0
+        used_gb = (cfg.traffic_used_bytes or 0) / (1024 ** 3)
         limit_gb = cfg.traffic_limit_gb
         
         text = (
             f"<b>🔧 Конфиг: <code>{cfg.id}</code></b>\n\n"
             f"Сервер: {server_name}\n"
             f"Трафик: {used_gb:.1f} / {limit_gb} ГБ\n"
-            f"Истекает: {cfg.expiry.split('T')[0] if cfg.expiry else '—'}\n"
+            f"Истекает: {from_ts(cfg.expiry).strftime('%Y-%m-%d') if cfg.expiry else '—'}\n"
             f"Статус: {'✅ Активен' if cfg.active else '❌ Неактивен'}"
         )
         
@@ -920,12 +953,15 @@ async def handle_admin_messages(message: Message):
     """Универсальный обработчик сообщений от админа."""
     text = message.text.strip()
     
-    # 1. Попытка обработать как JSON сервера
-    if text.startswith("{") and text.endswith("}"):
+    # 1. Попытка обработать как JSON сервера (объект) или нескольких серверов (массив)
+    if (text.startswith("{") and text.endswith("}")) or (text.startswith("[") and text.endswith("]")):
         try:
-            server_data = json.loads(text)
-            if "id" in server_data and "xui_url" in server_data:
-                await _handle_server_json(message, server_data)
+            servers_data = json.loads(text)
+            if isinstance(servers_data, dict):
+                servers_data = [servers_data]
+            # Ошибки в отдельных серверах показывает отчёт _handle_server_json
+            if isinstance(servers_data, list) and servers_data:
+                await _handle_server_json(message, servers_data)
                 return
         except json.JSONDecodeError:
             pass
@@ -939,7 +975,6 @@ async def handle_admin_messages(message: Message):
             price = int(parts[2])
             traffic = int(parts[3])
             # Это тариф
-            from services.tariff_service import create_tariff
             await create_tariff(parts[0], days, price, traffic)
             await message.answer("✅ Тариф добавлен!")
             return
@@ -973,39 +1008,73 @@ async def handle_admin_messages(message: Message):
     await message.answer("❓ Неизвестная команда. Используйте меню.")
 
 
-async def _handle_server_json(message: Message, server_data: dict):
-
-    """Обработка JSON для добавления сервера."""
+async def _handle_server_json(message: Message, servers_data: List[dict]):
+    """
+    Добавление серверов из JSON: один объект или массив.
+    Все сервера проверяются заранее, существующие id находятся одним SELECT,
+    новые вставляются одним INSERT, реестр перечитывается один раз.
+    """
     required_fields = ["id", "country", "city", "xui_url", "xui_username", "xui_password", "inbound_id"]
-    for field in required_fields:
-        if field not in server_data:
-            await message.answer(f"❌ Отсутствует обязательное поле: {field}")
-            return
-    
+    errors = []
+    rows = {}
+    for index, item in enumerate(servers_data, 1):
+        if not isinstance(item, dict):
+            errors.append(f"#{index}: ожидался JSON-объект сервера")
+            continue
+        missing = [field for field in required_fields if field not in item]
+        if missing:
+            errors.append(f"{item.get('id', f'#{index}')}: нет полей {', '.join(missing)}")
+            continue
+        server_id = str(item["id"])
+        if server_id in rows:
+            errors.append(f"{server_id}: повторяется в списке")
+            continue
+        rows[server_id] = {
+            "id": server_id,
+            "country": item["country"],
+            "city": item["city"],
+            "xui_url": item["xui_url"].rstrip("/"),
+            "xui_username": item["xui_username"],
+            "xui_password": item["xui_password"],
+            "inbound_id": str(item["inbound_id"]),
+            "mobile_spoof": bool(item.get("mobile_spoof", False)),
+            "subscription_path": item.get("subscription_path", "/sub"),
+            "subscription_port": str(item.get("subscription_port", 2096)),
+            "active": bool(item.get("active", True))
+        }
+
     async with async_session_maker() as session:
-        existing = await session.execute(
-            Server.__table__.select().where(Server.id == server_data["id"])
+        existing = set()
+        if rows:
+            result = await session.execute(select(Server.id).where(Server.id.in_(list(rows))))
+            existing = set(result.scalars())
+        new_rows = [row for server_id, row in rows.items() if server_id not in existing]
+        if new_rows:
+            await session.execute(Server.__table__.insert(), new_rows)
+            await session.commit()
+
+    if new_rows:
+        await server_registry.reload()
+        for row in new_rows:
+            await invalidate_xui_manager(row["id"])
+
+    if len(servers_data) == 1 and not errors:
+        # Одиночный сервер — прежние короткие ответы
+        await message.answer(
+            "✅ Сервер успешно добавлен!" if new_rows else "❌ Сервер с таким ID уже существует."
         )
-        if existing.fetchone():
-            await message.answer("❌ Сервер с таким ID уже существует.")
-            return
-        
-        await session.execute(Server.__table__.insert().values(
-            id=server_data["id"],
-            country=server_data["country"],
-            city=server_data["city"],
-            xui_url=server_data["xui_url"].rstrip("/"),
-            xui_username=server_data["xui_username"],
-            xui_password=server_data["xui_password"],
-            inbound_id=str(server_data["inbound_id"]),
-            mobile_spoof=bool(server_data.get("mobile_spoof", False)),
-            subscription_path=server_data.get("subscription_path", "/sub"),
-            subscription_port=str(server_data.get("subscription_port", 2096)),
-            active=bool(server_data.get("active", True))
-        ))
-        await session.commit()
-    
-    await message.answer("✅ Сервер успешно добавлен!")
+        return
+
+    text = f"<b>🖥️ Добавлено серверов: {len(new_rows)} из {len(servers_data)}</b>"
+    if new_rows:
+        text += "\n" + ", ".join(f"<code>{row['id']}</code>" for row in new_rows)
+    if existing:
+        text += "\n\n⏭ Уже существуют: " + ", ".join(f"<code>{server_id}</code>" for server_id in sorted(existing))
+    if errors:
+        text += "\n\n❌ Ошибки:\n" + "\n".join(f"• {html.escape(error)}" for error in errors)
+    if new_rows:
+        text += "\n\n<i>Проверить клиентов inbound'а можно кнопкой «🔍 Сверка с панелью» в карточке сервера.</i>"
+    await message.answer(text, parse_mode=ParseMode.HTML)
 
 
 async def _handle_user_search(message: Message, user_id: int):
@@ -1036,7 +1105,7 @@ async def _handle_user_search(message: Message, user_id: int):
             text += "<b>Конфиги:</b>\n"
             for i, cfg in enumerate(configs, 1):
                 status = "✅ Активен" if cfg.active else "❌ Неактивен"
-                trial_mark = " 🆓 Trial" if cfg.base_tariff == "trial" else ""
+                trial_mark = " 🆓 Trial" if cfg.is_trial else ""
                 text += f"{i}. <code>{cfg.id}</code>{trial_mark}\n   Сервер: {cfg.server_id}\n   {status}\n"
         
         buttons = []
@@ -1,5 +1,4 @@
 # handlers/buy.py
-from datetime import datetime, timezone
 from uuid import uuid4
 from aiogram import Router, F
 from aiogram.types import CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
@@ -8,9 +7,11 @@ from aiogram.fsm.context import FSMContext
 
 from config import ADMIN_TELEGRAM_ID, TrialConfig 
 from services.crypto_pay import create_crypto_invoice
-from services.tariff_service import get_tariff_categories, get_tariffs_by_category
+from services.payment_service import create_pending_payment, KIND_SUBSCRIPTION
+from services.tariff_service import tariff_catalog
 from services.trial_service import is_trial_available 
-from storage.database import async_session_maker, Server, Tariff, PendingPayment, User
+from storage.database import async_session_maker, User
+from services.server_registry import server_registry
 from utils.helpers import format_tariff_name, DAYS_TO_TARIFF_CODE
 
 router = Router()
@@ -68,19 +69,7 @@ async def activate_trial_from_buy(callback: CallbackQuery):
 @router.callback_query(F.data == "buy_menu")
 async def buy_menu(callback: CallbackQuery):
     try:
-        categories = await get_tariff_categories()
-        buttons = []
-        
-        row = []
-        for cat in categories:
-            emoji = "📱" if cat == "mobile" else "🛡️" if cat == "stable" else "💎"
-            row.append(InlineKeyboardButton(text=f"{emoji} {cat.capitalize()}", callback_data=f"select_category_{cat}"))
-            if len(row) == 2:
-                buttons.append(row)
-                row = []
-        
-        if row:
-            buttons.append(row)
+        buttons = tariff_catalog.category_rows()
 
         if await is_trial_available(str(callback.from_user.id)):
             buttons.insert(0, [InlineKeyboardButton(text="🆓 Попробовать бесплатно", callback_data="activate_trial_from_buy")])
@@ -104,19 +93,7 @@ async def buy_menu(callback: CallbackQuery):
 async def select_category(callback: CallbackQuery):
     try:
         category = callback.data.split("_", 2)[-1]
-        tariffs = await get_tariffs_by_category(category)
-        
-        buttons = []
-        for tariff in tariffs:
-            name = format_tariff_name(tariff.duration_days)
-            buttons.append([
-                InlineKeyboardButton(
-                    text=f"{name} — {tariff.price_rub} ₽",
-                    callback_data=f"select_duration_{category}_{tariff.id}"
-                )
-            ])
-        buttons.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="buy_menu")])
-        await callback.message.edit_text("Выберите срок:", reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons))
+        await callback.message.edit_text("Выберите срок:", reply_markup=tariff_catalog.duration_keyboard(category))
     except Exception as e:
         import logging
         logging.error(f"Ошибка в select_category: {e}")
@@ -137,16 +114,7 @@ async def select_duration(callback: CallbackQuery):
         plan_type = parts[2]
         duration = parts[3]
         
-        async with async_session_maker() as session:
-            result = await session.execute(
-                Server.__table__.select().where(Server.active == True)
-            )
-            all_servers = result.fetchall()
-        
-        filtered = [
-            s for s in all_servers
-            if bool(s.mobile_spoof) == (plan_type == "mobile")
-        ]
+        filtered = server_registry.active_by_mobile(plan_type == "mobile")
         
         if not filtered:
             await callback.message.edit_text(
@@ -197,17 +165,11 @@ async def confirm_server(callback: CallbackQuery, state: FSMContext):
 
         # Получаем тариф и сервер
         async with async_session_maker() as session:
-            tariff_result = await session.execute(
-                Tariff.__table__.select().where(Tariff.id == int(tariff_id))
-            )
-            tariff = tariff_result.fetchone()
+            tariff = tariff_catalog.get(int(tariff_id))
             if not tariff:
                 raise Exception("Тариф не найден")
 
-            server_result = await session.execute(
-                Server.__table__.select().where(Server.id == server_id)
-            )
-            server = server_result.fetchone()
+            server = server_registry.get(server_id)
             if not server:
                 raise Exception("Сервер не найден")
 
@@ -254,17 +216,10 @@ async def confirm_server(callback: CallbackQuery, state: FSMContext):
         pay_url = invoice["bot_invoice_url"]
 
         # Сохраняем платёж в БД
-        async with async_session_maker() as session:
-            await session.execute(
-                PendingPayment.__table__.insert().values(
-                    payment_id=invoice_id,
-                    bot_invoice_id=str(invoice["invoice_id"]),
-                    payload=payload,
-                    created_at=datetime.now(timezone.utc).isoformat(),
-                    user_id=user_id_str
-                )
-            )
-            await session.commit()
+        await create_pending_payment(
+            invoice_id, invoice, user_id_str, KIND_SUBSCRIPTION, final_price, payload,
+            server_id=server_id, tariff_id=tariff.id, category=category, duration_days=duration_days
+        )
 
         kb = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text=f"💳 Оплатить {final_price} ₽", url=pay_url)],
@@ -4,19 +4,23 @@ from datetime import datetime, timezone
 from aiogram import Router, F
 from aiogram.types import CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, BufferedInputFile
 
-from storage.database import async_session_maker, Config, Server
+from storage.database import async_session_maker, Config
+from services.server_registry import server_registry
+from services.traffic_stats import get_daily_usage
 from utils.qr_generator import generate_qr_image
-from utils.helpers import bytes_to_gb
+from utils.helpers import bytes_to_gb, now_ts, from_ts
+from utils.cache import my_configs_cache, invalidate_user_configs
 
 router = Router()
 
+# Названия серверов входят в отрисованный список — сбрасываем его при изменении каталога
+server_registry.subscribe(my_configs_cache.clear)
+
 
 def _format_config_status(config) -> str:
     """Форматирует статус конфига для отображения."""
     try:
-        expiry_dt = datetime.fromisoformat(config.expiry.replace("Z", "+00:00"))
-        if expiry_dt.tzinfo is None:
-            expiry_dt = expiry_dt.replace(tzinfo=timezone.utc)
+        expiry_dt = from_ts(config.expiry)
         now = datetime.now(timezone.utc)
         
         if now > expiry_dt:
@@ -38,8 +42,8 @@ def _format_config_status(config) -> str:
 def _format_traffic_info(config) -> str:
     """Форматирует информацию о трафике."""
     try:
-        used_gb = bytes_to_gb(int(config.traffic_used_bytes))
-        limit_gb = int(config.traffic_limit_gb)
+        used_gb = bytes_to_gb(config.traffic_used_bytes or 0)
+        limit_gb = config.traffic_limit_gb or 0
         percent = min(100, round((used_gb / limit_gb) * 100)) if limit_gb > 0 else 0
         
         if percent >= 95:
@@ -56,14 +60,25 @@ def _format_traffic_info(config) -> str:
 
 def _get_tariff_name(config) -> str:
     """Возвращает читаемое название тарифа."""
-    if config.base_tariff == "Trial":
+    if config.is_trial:
         return "🆓 Пробный"
-    else:
-        try:
-            days = int(config.base_tariff)
-            return f"📅 {days} дн."
-        except ValueError:
-            return "📦 Кастомный"
+    if config.base_tariff:
+        return f"📅 {config.base_tariff} дн."
+    return "📦 Кастомный"
+
+
+def _format_usage_graph(points) -> str:
+    """Текстовый график трафика по дням: [(начало дня, байт)]."""
+    peak = max((value for _, value in points), default=0)
+    if peak == 0:
+        return "<i>Нет данных об использовании за этот период.</i>"
+
+    lines = []
+    for bucket, value in points:
+        day = datetime.fromtimestamp(bucket, timezone.utc).strftime("%d.%m")
+        bar = "▇" * max(1, round(value / peak * 10)) if value else "·"
+        lines.append(f"<code>{day} {bar:<10}</code> {bytes_to_gb(value):.2f} ГБ")
+    return "\n".join(lines)
 
 
 def _extract_config_name(email: str) -> str:
@@ -71,54 +86,37 @@ def _extract_config_name(email: str) -> str:
     return email.split("_")[0] if "_" in email else email[:6]
 
 
-@router.callback_query(F.data == "my_configs")
-async def my_configs(callback: CallbackQuery):
-    user_id = str(callback.from_user.id)
-
-    configs_data = []
+async def _render_my_configs(user_id: str):
+    """
+    Отрисовывает список конфигов пользователя.
+    Возвращает (текст, упрощённый текст, клавиатура, время жизни в кэше).
+    """
     async with async_session_maker() as session:
         result = await session.execute(
             Config.__table__.select().where(Config.user_tg_id == user_id)
         )
-        all_configs = result.fetchall()
-
-        if not all_configs:
-            text = "📭 У вас пока нет конфигураций.\n\n"
-            text += "Вы можете приобрести подписку или активировать пробный период в меню «💰 Купить»."
-            kb = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="⬅️ Назад", callback_data="start_menu")]
-            ])
-            await callback.message.edit_text(text, reply_markup=kb)
-            return
+        configs = result.fetchall()
+
+    if not configs:
+        text = "📭 У вас пока нет конфигураций.\n\n"
+        text += "Вы можете приобрести подписку или активировать пробный период в меню «💰 Купить»."
+        kb = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="⬅️ Назад", callback_data="start_menu")]
+        ])
+        return text, None, kb, None
 
-        servers_result = await session.execute(Server.__table__.select())
-        servers = {row.id: row for row in servers_result.fetchall()}
-
-        for cfg in all_configs:
-            server = servers.get(cfg.server_id)
-            configs_data.append({
-                "config": cfg,
-                "server_country": server.country if server else "??",
-                "server_city": server.city if server else "??"
-            })
-
-    def sort_key(item):
-        cfg = item["config"]
-        try:
-            expiry_dt = datetime.fromisoformat(cfg.expiry.replace("Z", "+00:00"))
-            if expiry_dt.tzinfo is None:
-                expiry_dt = expiry_dt.replace(tzinfo=timezone.utc)
-            is_active = datetime.now(timezone.utc) <= expiry_dt
-            created_dt = datetime.fromisoformat(cfg.created_at)
-            return (not is_active, -created_dt.timestamp())
-        except:
-            return (True, 0)
-
-    sorted_configs = sorted(configs_data, key=sort_key)
+    now = now_ts()
+
+    def sort_key(cfg):
+        is_active = (cfg.expiry or 0) >= now
+        return (not is_active, -(cfg.created_at or 0))
+
+    sorted_configs = sorted(configs, key=sort_key)
 
     config_texts = []
-    for i, item in enumerate(sorted_configs, 1):
-        cfg = item["config"]
+    fallback_lines = []
+    for i, cfg in enumerate(sorted_configs, 1):
+        server = server_registry.get(cfg.server_id)
         tariff_name = _get_tariff_name(cfg)
         status_line = _format_config_status(cfg)
         traffic_line = _format_traffic_info(cfg)
@@ -126,36 +124,56 @@ async def my_configs(callback: CallbackQuery):
         config_text = (
             f"<b>Конфиг #{i}</b>\n"
             f"Тариф: {tariff_name}\n"
-            f"Сервер: {item['server_country']} ({item['server_city']})\n"
+            f"Сервер: {server.country if server else '??'} ({server.city if server else '??'})\n"
             f"Статус: {status_line}\n"
             f"Трафик: {traffic_line}\n"
             f"{'─' * 20}"
         )
         config_texts.append(config_text)
+        status_emoji = "🟢" if "Активен" in status_line or "Истекает" in status_line else "🔴"
+        fallback_lines.append(f"{status_emoji} Конфиг #{i}\n")
 
-    full_text = "\n\n".join(config_texts)
+    full_text = "📋 <b>Ваши конфигурации</b>\n\n" + "\n\n".join(config_texts)
+    fallback_text = (
+        "📋 <b>Ваши конфигурации</b>\n\n" + "".join(fallback_lines)
+        + "\n<i>Для деталей выберите конфигурацию.</i>"
+    )
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(
             text=f"🔧 Управление ({i})",
-            callback_data=f"manage_config_{item['config'].id}"
+            callback_data=f"manage_config_{cfg.id}"
         )]
-        for i, item in enumerate(sorted_configs, 1)
+        for i, cfg in enumerate(sorted_configs, 1)
     ] + [[InlineKeyboardButton(text="⬅️ Назад в меню", callback_data="start_menu")]])
 
+    # Статус «Активен» должен смениться на «Истёк» вовремя, даже если кэш ещё жив
+    upcoming = [cfg.expiry for cfg in configs if cfg.expiry and cfg.expiry > now]
+    ttl = min(upcoming) - now if upcoming else None
+    return full_text, fallback_text, kb, ttl
+
+
+@router.callback_query(F.data == "my_configs")
+async def my_configs(callback: CallbackQuery):
+    user_id = str(callback.from_user.id)
+
+    cached = my_configs_cache.get(user_id)
+    if cached is None:
+        text, fallback_text, kb, ttl = await _render_my_configs(user_id)
+        my_configs_cache.set(user_id, (text, fallback_text, kb), ttl=ttl)
+    else:
+        text, fallback_text, kb = cached
+
+    if fallback_text is None:
+        await callback.message.edit_text(text, reply_markup=kb)
+        return
+
     try:
         await callback.message.edit_text(
-            f"📋 <b>Ваши конфигурации</b>\n\n{full_text}",
+            text,
             reply_markup=kb,
             parse_mode="HTML"
         )
     except Exception:
-        fallback_text = "📋 <b>Ваши конфигурации</b>\n\n"
-        for i, item in enumerate(sorted_configs, 1):
-            cfg = item["config"]
-            status_emoji = "🟢" if "Активен" in _format_config_status(cfg) or "Истекает" in _format_config_status(cfg) else "🔴"
-            fallback_text += f"{status_emoji} Конфиг #{i}\n"
-        fallback_text += "\n<i>Для деталей выберите конфигурацию.</i>"
-        
         await callback.message.edit_text(
             fallback_text,
             reply_markup=kb,
@@ -183,17 +201,21 @@ async def traffic_menu(callback: CallbackQuery):
 
     # Получаем информацию о трафике
     try:
-        used_gb = bytes_to_gb(int(config.traffic_used_bytes))
-        limit_gb = int(config.traffic_limit_gb)
+        used_gb = bytes_to_gb(config.traffic_used_bytes or 0)
+        limit_gb = config.traffic_limit_gb or 0
         percent = min(100, round((used_gb / limit_gb) * 100)) if limit_gb > 0 else 0
     except (ValueError, TypeError, ZeroDivisionError):
         used_gb, limit_gb, percent = 0, 0, 0
 
+    # График за неделю из дневных сумм (без чтения сырой истории)
+    usage_graph = _format_usage_graph(await get_daily_usage(config_id, days=7))
+
     # Формируем подробное сообщение
     traffic_info = (
         f"📊 <b>Управление трафиком</b>\n\n"
         f"Текущий лимит: <b>{limit_gb} ГБ</b>\n"
         f"Использовано: <b>{used_gb:.1f} ГБ</b> ({percent}%)\n\n"
+        f"📈 <b>За последние 7 дней:</b>\n{usage_graph}\n\n"
         f"<i>ℹ️ Примечания:</i>\n"
         f"• <b>Сбросить трафик</b> — обнуляет счётчик использованного трафика в панели. "
         f"Более актуальное значение будет запрошено с сервера.\n"
@@ -230,10 +252,7 @@ async def manage_config(callback: CallbackQuery):
             await callback.answer("Конфиг не найден.", show_alert=True)
             return
 
-        server_result = await session.execute(
-            Server.__table__.select().where(Server.id == config.server_id)
-        )
-        server = server_result.fetchone()
+        server = server_registry.get(config.server_id)
         if not server:
             await callback.message.edit_text("❌ Сервер для этого конфига не найден.")
             return
@@ -243,8 +262,8 @@ async def manage_config(callback: CallbackQuery):
     status_line = _format_config_status(config)
     traffic_line = _format_traffic_info(config)
     
-    created_dt = datetime.fromisoformat(config.created_at.replace("Z", "+00:00"))
-    expiry_dt = datetime.fromisoformat(config.expiry.replace("Z", "+00:00"))
+    created_dt = from_ts(config.created_at)
+    expiry_dt = from_ts(config.expiry)
     created_str = created_dt.strftime("%d.%m.%Y %H:%M")
     expiry_str = expiry_dt.strftime("%d.%m.%Y %H:%M")
     
@@ -322,25 +341,15 @@ async def delete_config(callback: CallbackQuery):
             await callback.answer("Конфиг не найден.", show_alert=True)
             return
 
-        server_result = await session.execute(
-            Server.__table__.select().where(Server.id == config.server_id)
-        )
-        server = server_result.fetchone()
+        server = server_registry.get(config.server_id)
         if server:
-            from services.xui_manager import XUIManager
-            xui = XUIManager(
-                base_url=server.xui_url,
-                username=server.xui_username,
-                password=server.xui_password,
-                server_id=server.id
-            )
-            try:
-                await xui.delete_client_by_email(int(server.inbound_id), config.client_email)
-            finally:
-                await xui.close()
+            from services.xui_manager import get_xui_manager
+            xui = await get_xui_manager(server)
+            await xui.delete_client_by_email(int(server.inbound_id), config.client_email)
 
         await session.execute(Config.__table__.delete().where(Config.id == config_id))
         await session.commit()
+    invalidate_user_configs(user_id)
 
     await callback.message.edit_text("✅ Конфиг удалён.")
     await asyncio.sleep(1)
@@ -1,6 +1,5 @@
 # handlers/renew.py
 import json
-from datetime import datetime, timezone
 from uuid import uuid4
 from aiogram import Router, F
 from aiogram.types import CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
@@ -9,7 +8,10 @@ from aiogram.enums import ParseMode
 from config import ADMIN_TELEGRAM_ID
 from services.crypto_pay import create_crypto_invoice
 from services.traffic_service import apply_traffic_change
-from storage.database import async_session_maker, Config, Server, User, Tariff, PendingPayment
+from services.payment_service import create_pending_payment, KIND_RESET_TRAFFIC, KIND_RENEW, KIND_ADD_TRAFFIC
+from storage.database import async_session_maker, Config, User
+from services.tariff_service import tariff_catalog
+from services.server_registry import server_registry
 from utils.helpers import format_tariff_name
 
 router = Router()
@@ -32,10 +34,7 @@ async def reset_traffic_start(callback: CallbackQuery):
             await callback.answer("Конфиг не найден.", show_alert=True)
             return
 
-        server_result = await session.execute(
-            Server.__table__.select().where(Server.id == config.server_id)
-        )
-        server = server_result.fetchone()
+        server = server_registry.get(config.server_id)
         if not server:
             await callback.message.edit_text("❌ Сервер не найден.")
             return
@@ -47,21 +46,13 @@ async def reset_traffic_start(callback: CallbackQuery):
 
     # === ШАГ 2: Работаем с X-UI ВНЕ сессии ===
     used_gb = 0
-    try:
-        from services.xui_manager import XUIManager
-        xui = XUIManager(
-            base_url=server.xui_url,
-            username=server.xui_username,
-            password=server.xui_password,
-            server_id=server.id
-        )
-        used_bytes = await xui.get_client_traffic(config.client_email)
-        used_gb = used_bytes / (1024 ** 3)
-    finally:
-        await xui.close()
+    from services.xui_manager import get_xui_manager
+    xui = await get_xui_manager(server)
+    used_bytes = await xui.get_client_traffic(config.client_email)
+    used_gb = used_bytes / (1024 ** 3)
 
     # === ШАГ 3: Рассчитываем цену и создаём счёт ===
-    current_limit_gb = int(config.traffic_limit_gb)
+    current_limit_gb = config.traffic_limit_gb or 0
     base_cost = max(10, round((used_gb / 100) * 140))
     final_price = base_cost
 
@@ -85,17 +76,9 @@ async def reset_traffic_start(callback: CallbackQuery):
     )
     pay_url = invoice["bot_invoice_url"]
     
-    async with async_session_maker() as session:
-        await session.execute(
-            PendingPayment.__table__.insert().values(
-                payment_id=invoice_id,
-                bot_invoice_id=str(invoice["invoice_id"]),
-                payload=payload,
-                created_at=datetime.now(timezone.utc).isoformat(),
-                user_id=user_id
-            )
-        )
-        await session.commit()
+    await create_pending_payment(
+        invoice_id, invoice, user_id, KIND_RESET_TRAFFIC, final_price, payload, config_id=config_id
+    )
 
     # === ШАГ 5: Отправляем сообщение ===
     price_text = f"<b>{final_price} ₽</b>" if final_price == base_cost else f"<b>{final_price} ₽</b> (было {base_cost} ₽)"
@@ -130,40 +113,15 @@ async def renew_select_duration(callback: CallbackQuery):
             await callback.answer("Конфиг не найден.", show_alert=True)
             return
 
-        server_result = await session.execute(
-            Server.__table__.select().where(Server.id == config.server_id)
-        )
-        server = server_result.fetchone()
+        server = server_registry.get(config.server_id)
         if not server:
             await callback.message.edit_text("❌ Сервер не найден.")
             return
 
     is_mobile = bool(server.mobile_spoof)
 
-    # Получаем тарифы из БД
-    tariff_result = await session.execute(
-        Tariff.__table__.select()
-        .where(
-            Tariff.category == ("mobile" if is_mobile else "stable"),
-            Tariff.active == True
-        )
-        .order_by(Tariff.duration_days)
-    )
-    available_tariffs = tariff_result.fetchall()
-
-    buttons = []
-    for tariff in available_tariffs:
-        name = format_tariff_name(tariff.duration_days)
-        buttons.append(
-            InlineKeyboardButton(
-                text=f"{name} — {tariff.price_rub} ₽",
-                callback_data=f"renew_confirm_{config_id}_{tariff.id}_{tariff.price_rub}"
-            )
-        )
-    
-    keyboard = [buttons[i:i+2] for i in range(0, len(buttons), 2)]
-    keyboard.append([InlineKeyboardButton(text="⬅️ Назад", callback_data=f"manage_config_{config_id}")])
-    kb = InlineKeyboardMarkup(inline_keyboard=keyboard)
+    # Кнопки тарифов категории собраны заранее в каталоге
+    kb = tariff_catalog.renew_keyboard("mobile" if is_mobile else "stable", config_id)
     await callback.message.edit_text(
         "<b>⏳ Выберите срок продления:</b>",
         reply_markup=kb,
@@ -181,7 +139,7 @@ async def renew_confirm(callback: CallbackQuery):
     try:
         # === ВСЯ РАБОТА С БД — В ОДНОЙ СЕССИИ ===
         async with async_session_maker() as session:
-            tariff = await session.get(Tariff, tariff_id)
+            tariff = tariff_catalog.get(tariff_id)
             if not tariff:
                 raise Exception("Тариф не найден")
             duration_name = format_tariff_name(tariff.duration_days)
@@ -213,17 +171,11 @@ async def renew_confirm(callback: CallbackQuery):
             )
             pay_url = invoice["bot_invoice_url"]
             invoice_id = str(uuid4())
-            
-            await session.execute(
-                PendingPayment.__table__.insert().values(
-                    payment_id=invoice_id,
-                    bot_invoice_id=str(invoice["invoice_id"]),
-                    payload=payload,
-                    created_at=datetime.now(timezone.utc).isoformat(),
-                    user_id=user_id
-                )
-            )
-            await session.commit()
+
+        await create_pending_payment(
+            invoice_id, invoice, user_id, KIND_RENEW, final_price, payload,
+            config_id=config_id, tariff_id=tariff_id, duration_days=tariff.duration_days
+        )
 
         # === ОТПРАВКА СООБЩЕНИЯ — ВНЕ СЕССИИ ===
         price_text = f"<b>{final_price} ₽</b>" if final_price == base_price else f"<b>{final_price} ₽</b> (было {base_price} ₽)"
@@ -296,17 +248,9 @@ async def add_traffic_start(callback: CallbackQuery):
         pay_url = invoice["bot_invoice_url"]
         
         # === ШАГ 3: Сохраняем платёж в БД ===
-        async with async_session_maker() as session:
-            await session.execute(
-                PendingPayment.__table__.insert().values(
-                    payment_id=invoice_id,
-                    bot_invoice_id=str(invoice["invoice_id"]),
-                    payload=payload,
-                    created_at=datetime.now(timezone.utc).isoformat(),
-                    user_id=user_id
-                )
-            )
-            await session.commit()
+        await create_pending_payment(
+            invoice_id, invoice, user_id, KIND_ADD_TRAFFIC, final_price, payload, config_id=config_id
+        )
 
         # === ШАГ 4: Отправляем сообщение ===
         price_text = f"<b>{final_price} ₽</b>" if final_price == BASE_TRAFFIC_PRICE else f"<b>{final_price} ₽</b> (было {BASE_TRAFFIC_PRICE} ₽)"
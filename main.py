@@ -5,12 +5,22 @@ import signal
 from aiogram import Bot, Dispatcher
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
-from config import BOT_TOKEN
+from config import BOT_TOKEN, CRYPTO_PAY_API_TOKEN, WebhookConfig, ReconcileConfig
 from handlers import register_all_handlers
 from tasks.expiration_checker import deactivate_expired_subscriptions, reset_monthly_traffic
 from tasks.notifications import send_subscription_notifications, send_traffic_notifications
-from tasks.traffic_updater import update_all_traffic
+from tasks.traffic_updater import update_all_traffic, prune_traffic_history_task
+from tasks.db_maintenance import sqlite_maintenance_task
+from tasks.payment_watcher import watch_payments
+from tasks.reconcile_task import reconcile_servers_task
 from storage.database import init_db, async_engine
+from services.xui_manager import close_all_xui_managers
+from services.crypto_pay import CryptoPayClient, set_crypto_pay_client
+from services.message_sender import outbound
+from services.server_registry import server_registry
+from services.tariff_service import tariff_catalog
+from services.broadcast_service import resume_broadcast_jobs, stop_broadcast_jobs
+from services.webhook_server import run_webhook
 
 logging.basicConfig(level=logging.INFO, stream=sys.stdout)
 logger = logging.getLogger(__name__)
@@ -18,25 +28,46 @@ logger = logging.getLogger(__name__)
 
 async def main():
     bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    # Все исходящие запросы идут через общий лимитер (лимиты Telegram, приоритеты, RetryAfter)
+    bot.session.middleware(outbound)
     dp = Dispatcher()
+    # Общий клиент Crypto Pay: одна сессия с keep-alive на все счета и проверки оплат
+    crypto_pay = CryptoPayClient(CRYPTO_PAY_API_TOKEN)
+    set_crypto_pay_client(crypto_pay)
     
     await init_db()
+    # Каталоги серверов и тарифов держим в памяти: перечитываются только после изменений в админ-панели
+    await server_registry.reload()
+    await tariff_catalog.reload()
     register_all_handlers(dp)
     dp["bot"] = bot
 
+    # Продолжаем рассылки, прерванные перезапуском
+    await resume_broadcast_jobs(bot)
+
     # Запускаем фоновые задачи и сохраняем ссылки на них
     background_tasks = [
         asyncio.create_task(deactivate_expired_subscriptions(), name="deactivate_expired"),
         asyncio.create_task(update_all_traffic(), name="update_traffic"),
+        asyncio.create_task(prune_traffic_history_task(), name="prune_traffic_history"),
         asyncio.create_task(reset_monthly_traffic(), name="reset_traffic"),
         asyncio.create_task(send_subscription_notifications(bot), name="notify_subscriptions"),
         asyncio.create_task(send_traffic_notifications(bot), name="notify_traffic"),
+        asyncio.create_task(sqlite_maintenance_task(), name="sqlite_maintenance"),
+        asyncio.create_task(watch_payments(bot), name="watch_payments"),
     ]
+    if ReconcileConfig.INTERVAL:
+        background_tasks.append(asyncio.create_task(reconcile_servers_task(bot), name="reconcile_servers"))
+
+    # Остановка webhook-сервера (polling обрабатывает сигналы сам; на Windows run_webhook
+    # останавливается по отмене задачи, которую asyncio.run выполняет при Ctrl+C)
+    stop_event = asyncio.Event()
 
     # На Linux/macOS добавляем обработчики сигналов для graceful shutdown
     if sys.platform != "win32":
         def _signal_handler():
             logger.info("Получен сигнал завершения. Отмена фоновых задач...")
+            stop_event.set()
             for task in background_tasks:
                 if not task.done():
                     task.cancel()
@@ -46,7 +77,12 @@ async def main():
             loop.add_signal_handler(sig, _signal_handler)
 
     try:
-        await dp.start_polling(bot)
+        if WebhookConfig.ENABLED:
+            await run_webhook(dp, bot, stop_event)
+        else:
+            # Если ранее работал webhook, getUpdates вернёт конфликт — снимаем его
+            await bot.delete_webhook(drop_pending_updates=False)
+            await dp.start_polling(bot)
     finally:
         # Отменяем все фоновые задачи
         for task in background_tasks:
@@ -59,6 +95,15 @@ async def main():
                 except Exception as e:
                     logger.warning(f"Ошибка при отмене задачи {task.get_name()}: {e}")
 
+        # Останавливаем рассылки: курсор сохранён, после запуска они продолжатся
+        await stop_broadcast_jobs()
+
+        # Закрываем общие сессии 3x-ui панелей
+        await close_all_xui_managers()
+
+        # Закрываем сессию Crypto Pay
+        await crypto_pay.close()
+
         # Корректно закрываем пул соединений с БД
         await async_engine.dispose()
         logger.info("Соединения с базой данных закрыты.")
@@ -0,0 +1,244 @@
+# services/broadcast_service.py
+"""
+Рассылки объявлений как сохраняемые задания (таблица broadcast_jobs).
+
+Получатели выбираются пачками по возрастанию tg_id (keyset-пагинация), после каждой
+пачки в задании сохраняются курсор и счётчики — после перезапуска бота рассылка
+продолжается с места остановки (повторно может уйти только прерванная пачка).
+Пользователи, заблокировавшие бота, помечаются users.is_blocked и в следующих
+рассылках не выбираются.
+"""
+import asyncio
+import logging
+from typing import Optional, Set
+
+from aiogram import Bot
+from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from sqlalchemy import func, select
+
+from config import BroadcastConfig
+from services.message_sender import outbound_lane, LANE_BROADCAST
+from storage.database import async_session_maker, User, BroadcastJob
+from utils.helpers import now_ts
+
+logger = logging.getLogger(__name__)
+
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_CANCELLED = "cancelled"
+
+# Ссылки на запущенные задания, чтобы их не собрал сборщик мусора
+_running: Set[asyncio.Task] = set()
+
+
+def format_progress(job: BroadcastJob) -> str:
+    processed = job.sent + job.blocked + job.failed
+    if job.status == STATUS_DONE:
+        title = "✅ Рассылка завершена"
+    elif job.status == STATUS_CANCELLED:
+        title = "⛔ Рассылка остановлена"
+    else:
+        title = "📤 Идёт рассылка"
+    return (
+        f"<b>{title}</b> #{job.id}\n\n"
+        f"Обработано: {processed}/{job.total}\n"
+        f"✅ Доставлено: {job.sent}\n"
+        f"🚫 Заблокировали бота: {job.blocked}\n"
+        f"⚠️ Ошибки: {job.failed}"
+    )
+
+
+def progress_keyboard(job: BroadcastJob) -> Optional[InlineKeyboardMarkup]:
+    if job.status != STATUS_RUNNING:
+        return None
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="⛔ Остановить", callback_data=f"broadcast_cancel_{job.id}")]
+    ])
+
+
+async def create_broadcast_job(source_chat_id: int, source_message_id: int, admin_chat_id: int) -> BroadcastJob:
+    """Создаёт задание рассылки сообщения source_message_id всем незаблокированным пользователям."""
+    async with async_session_maker() as session:
+        total = await session.scalar(
+            select(func.count()).select_from(User).where(User.is_blocked == False)
+        )
+        job = BroadcastJob(
+            status=STATUS_RUNNING,
+            source_chat_id=str(source_chat_id),
+            source_message_id=source_message_id,
+            admin_chat_id=str(admin_chat_id),
+            total=total or 0,
+            created_at=now_ts(),
+        )
+        session.add(job)
+        await session.commit()
+        await session.refresh(job)
+        return job
+
+
+async def set_progress_message(job_id: int, message_id: int) -> None:
+    async with async_session_maker() as session:
+        await session.execute(
+            BroadcastJob.__table__.update()
+            .where(BroadcastJob.id == job_id)
+            .values(progress_message_id=message_id)
+        )
+        await session.commit()
+
+
+async def cancel_broadcast_job(job_id: int) -> bool:
+    """Помечает задание остановленным; рассылка прервётся после текущей пачки."""
+    async with async_session_maker() as session:
+        result = await session.execute(
+            BroadcastJob.__table__.update()
+            .where(BroadcastJob.id == job_id, BroadcastJob.status == STATUS_RUNNING)
+            .values(status=STATUS_CANCELLED, finished_at=now_ts())
+        )
+        await session.commit()
+        return result.rowcount > 0
+
+
+async def _update_progress_message(bot: Bot, job: BroadcastJob) -> None:
+    if not job.progress_message_id:
+        return
+    try:
+        await bot.edit_message_text(
+            format_progress(job),
+            chat_id=job.admin_chat_id,
+            message_id=job.progress_message_id,
+            parse_mode=ParseMode.HTML,
+            reply_markup=progress_keyboard(job),
+        )
+    except TelegramBadRequest as e:
+        # "message is not modified" или сообщение удалено администратором
+        logger.debug(f"Не удалось обновить прогресс рассылки #{job.id}: {e}")
+
+
+async def _send_one(bot: Bot, job: BroadcastJob, tg_id: str, semaphore: asyncio.Semaphore) -> str:
+    """Копирует сообщение пользователю. Возвращает "sent", "blocked" или "failed"."""
+    async with semaphore:
+        try:
+            await bot.copy_message(tg_id, job.source_chat_id, job.source_message_id)
+            return "sent"
+        except TelegramForbiddenError:
+            # Бот заблокирован или аккаунт удалён
+            return "blocked"
+        except TelegramBadRequest as e:
+            if "chat not found" in str(e).lower():
+                return "blocked"
+            logger.warning(f"⚠️ Рассылка #{job.id}: ошибка отправки {tg_id}: {e}")
+            return "failed"
+        except Exception as e:
+            logger.warning(f"⚠️ Рассылка #{job.id}: ошибка отправки {tg_id}: {e}")
+            return "failed"
+
+
+async def run_broadcast_job(bot: Bot, job_id: int) -> None:
+    """Выполняет (или продолжает) рассылку с сохранённого курсора."""
+    semaphore = asyncio.Semaphore(BroadcastConfig.CONCURRENCY)
+    next_progress = None
+
+    # Темп рассылки задаёт общий лимитер исходящих (с учётом RetryAfter),
+    # полоса рассылки пропускает вперёд ответы пользователям
+    with outbound_lane(LANE_BROADCAST):
+        while True:
+            async with async_session_maker() as session:
+                job = await session.get(BroadcastJob, job_id)
+                if job is None or job.status != STATUS_RUNNING:
+                    break
+                query = (
+                    select(User.tg_id)
+                    .where(User.is_blocked == False)
+                    .order_by(User.tg_id)
+                    .limit(BroadcastConfig.CHUNK_SIZE)
+                )
+                if job.cursor is not None:
+                    query = query.where(User.tg_id > job.cursor)
+                recipients = (await session.execute(query)).scalars().all()
+
+            if next_progress is None:
+                next_progress = job.sent + job.blocked + job.failed + BroadcastConfig.PROGRESS_EVERY
+
+            if not recipients:
+                async with async_session_maker() as session:
+                    job = await session.get(BroadcastJob, job_id)
+                    if job.status == STATUS_RUNNING:
+                        job.status = STATUS_DONE
+                        job.finished_at = now_ts()
+                        await session.commit()
+                logger.info(
+                    f"📢 Рассылка #{job.id} завершена: доставлено {job.sent}, "
+                    f"заблокировали {job.blocked}, ошибок {job.failed}"
+                )
+                await _update_progress_message(bot, job)
+                break
+
+            results = await asyncio.gather(
+                *(_send_one(bot, job, tg_id, semaphore) for tg_id in recipients)
+            )
+            blocked_ids = [tg_id for tg_id, status in zip(recipients, results) if status == "blocked"]
+
+            # Курсор, счётчики и пометки заблокировавших — одной транзакцией на пачку
+            async with async_session_maker() as session:
+                if blocked_ids:
+                    await session.execute(
+                        User.__table__.update()
+                        .where(User.tg_id.in_(blocked_ids))
+                        .values(is_blocked=True)
+                    )
+                await session.execute(
+                    BroadcastJob.__table__.update()
+                    .where(BroadcastJob.id == job_id)
+                    .values(
+                        cursor=recipients[-1],
+                        sent=BroadcastJob.sent + results.count("sent"),
+                        blocked=BroadcastJob.blocked + len(blocked_ids),
+                        failed=BroadcastJob.failed + results.count("failed"),
+                    )
+                )
+                await session.commit()
+                job = await session.get(BroadcastJob, job_id, populate_existing=True)
+
+            processed = job.sent + job.blocked + job.failed
+            if processed >= next_progress:
+                next_progress = processed + BroadcastConfig.PROGRESS_EVERY
+                await _update_progress_message(bot, job)
+
+
+def start_broadcast_job(bot: Bot, job_id: int) -> asyncio.Task:
+    task = asyncio.create_task(_run_logged(bot, job_id), name=f"broadcast_{job_id}")
+    _running.add(task)
+    task.add_done_callback(_running.discard)
+    return task
+
+
+async def _run_logged(bot: Bot, job_id: int) -> None:
+    try:
+        await run_broadcast_job(bot, job_id)
+    except asyncio.CancelledError:
+        logger.info(f"📢 Рассылка #{job_id} прервана, продолжится после перезапуска")
+        raise
+    except Exception as e:
+        logger.error(f"❌ Рассылка #{job_id} упала: {e}", exc_info=True)
+
+
+async def resume_broadcast_jobs(bot: Bot) -> int:
+    """Продолжает рассылки, прерванные перезапуском бота. Возвращает их число."""
+    async with async_session_maker() as session:
+        job_ids = (await session.execute(
+            select(BroadcastJob.id).where(BroadcastJob.status == STATUS_RUNNING)
+        )).scalars().all()
+    for job_id in job_ids:
+        logger.info(f"📢 Продолжаю рассылку #{job_id}")
+        start_broadcast_job(bot, job_id)
+    return len(job_ids)
+
+
+async def stop_broadcast_jobs() -> None:
+    """Останавливает запущенные рассылки при завершении бота (статус остаётся running)."""
+    tasks = list(_running)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
@@ -1,8 +1,184 @@
-import aiohttp
+# services/crypto_pay.py
+"""
+Клиент Crypto Pay API (@CryptoBot).
+
+Один долгоживущий CryptoPayClient на процесс: общая aiohttp-сессия с keep-alive,
+таймауты и повторы с экспоненциальной задержкой на 429 и 5xx. Создаётся в main.py
+(set_crypto_pay_client) и закрывается при остановке; функции модуля
+(create_crypto_invoice, get_invoices, ...) работают через него.
+"""
+import asyncio
 import logging
-from typing import Dict, Any
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+from aiohttp import ClientConnectorError, ClientError, ClientSession, ClientTimeout, TCPConnector
+
+from config import CRYPTO_PAY_API_TOKEN, PaymentConfig
+
+logger = logging.getLogger(__name__)
+
+# Сколько последних замеров задержки хранить для перцентилей
+_LATENCY_WINDOW = 200
+
+
+class CryptoPayError(Exception):
+    """Ошибка Crypto Pay API (ok=false, неожиданный ответ или исчерпаны повторы)."""
+
+    def __init__(self, method: str, message: str, status: Optional[int] = None):
+        super().__init__(f"CryptoPay {method}: {message}")
+        self.method = method
+        self.status = status
+
+
+class CryptoPayClient:
+    def __init__(
+        self,
+        token: str,
+        base_url: str = PaymentConfig.API_URL,
+        timeout: float = PaymentConfig.REQUEST_TIMEOUT,
+        max_retries: int = PaymentConfig.MAX_RETRIES,
+        retry_backoff: float = PaymentConfig.RETRY_BACKOFF,
+    ):
+        self.token = token
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.session: Optional[ClientSession] = None
+        # Метрики
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self._latencies: deque = deque(maxlen=_LATENCY_WINDOW)
+
+    def _get_session(self) -> ClientSession:
+        if self.session is None or self.session.closed:
+            self.session = ClientSession(
+                connector=TCPConnector(keepalive_timeout=60, ttl_dns_cache=300),
+                headers={"Crypto-Pay-API-Token": self.token},
+                timeout=ClientTimeout(total=self.timeout)
+            )
+        return self.session
+
+    def _retry_delay(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        if retry_after and retry_after.isdigit():
+            return float(retry_after)
+        return self.retry_backoff * (2 ** attempt)
+
+    async def _call(self, method: str, http_method: str = "GET", **kwargs) -> Any:
+        """
+        Вызывает метод API и возвращает поле result.
+
+        GET идемпотентны: 429, 5xx и сетевые ошибки повторяются до max_retries раз
+        с растущей задержкой. POST (createInvoice) повторяется только когда запрос
+        заведомо не выполнен — 429 или ошибка установки соединения; при таймауте
+        чтения или 5xx счёт мог уже создаться, и повтор создал бы второй.
+        """
+        idempotent = http_method == "GET"
+        session = self._get_session()
+        for attempt in range(self.max_retries + 1):
+            last_attempt = attempt == self.max_retries
+            started = time.monotonic()
+            self.requests += 1
+            try:
+                async with session.request(http_method, f"{self.base_url}/{method}", **kwargs) as resp:
+                    self._latencies.append(time.monotonic() - started)
+                    retryable = resp.status == 429 or (idempotent and resp.status >= 500)
+                    if retryable and not last_attempt:
+                        delay = self._retry_delay(attempt, resp.headers.get("Retry-After"))
+                        logger.warning(f"CryptoPay {method}: HTTP {resp.status}, повтор через {delay:.1f} с")
+                        self.retries += 1
+                        await asyncio.sleep(delay)
+                        continue
+                    data = await resp.json(content_type=None)
+            except (ClientError, asyncio.TimeoutError, ValueError) as e:
+                self.errors += 1
+                if last_attempt or not (idempotent or isinstance(e, ClientConnectorError)):
+                    raise CryptoPayError(method, f"{type(e).__name__}: {e}")
+                delay = self._retry_delay(attempt)
+                logger.warning(f"CryptoPay {method}: {type(e).__name__}, повтор через {delay:.1f} с")
+                self.retries += 1
+                await asyncio.sleep(delay)
+                continue
 
-from config import CRYPTO_PAY_API_TOKEN
+            if not isinstance(data, dict) or not data.get("ok"):
+                self.errors += 1
+                error = data.get("error", "Unknown error") if isinstance(data, dict) else data
+                raise CryptoPayError(method, f"HTTP {resp.status}: {error}", resp.status)
+            return data["result"]
+
+    async def create_invoice(
+        self,
+        amount_fiat: float,
+        fiat_currency: str,
+        description: str,
+        payload: str,
+        expires_in: int = 900
+    ) -> Dict[str, Any]:
+        """Создаёт счёт в фиатной валюте с оплатой в крипте (USDT)."""
+        return await self._call("createInvoice", "POST", json={
+            "currency_type": "fiat",
+            "fiat": fiat_currency,
+            "amount": str(amount_fiat),
+            "accepted_assets": "USDT",
+            "description": description[:1024],
+            "payload": payload[:4096],
+            "allow_comments": False,
+            "allow_anonymous": False,
+            "expires_in": expires_in
+        })
+
+    async def get_invoices(self, invoice_ids: List[int]) -> List[Dict[str, Any]]:
+        """
+        Статусы нескольких счетов: по PaymentConfig.BATCH_SIZE id на запрос getInvoices.
+        Возвращает найденные счета (поля invoice_id, status, ...).
+        """
+        items: List[Dict[str, Any]] = []
+        for i in range(0, len(invoice_ids), PaymentConfig.BATCH_SIZE):
+            chunk = invoice_ids[i:i + PaymentConfig.BATCH_SIZE]
+            result = await self._call("getInvoices", params={
+                "invoice_ids": ",".join(str(invoice_id) for invoice_id in chunk),
+                "count": str(len(chunk))
+            })
+            items.extend(result["items"])
+        return items
+
+    def stats(self) -> dict:
+        """Запросы, ошибки, повторы и задержка (средняя и p95 по последним запросам, мс)."""
+        latencies = sorted(self._latencies)
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] if latencies else 0.0
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "retries": self.retries,
+            "avg_ms": sum(latencies) / len(latencies) * 1000 if latencies else 0.0,
+            "p95_ms": p95 * 1000,
+        }
+
+    async def close(self) -> None:
+        """Закрывает сессию (вызывается при остановке бота)."""
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+
+# ---------- Общий клиент процесса ----------
+_client: Optional[CryptoPayClient] = None
+
+
+def set_crypto_pay_client(client: CryptoPayClient) -> None:
+    global _client
+    _client = client
+
+
+def get_crypto_pay_client() -> CryptoPayClient:
+    """Клиент, созданный в main.py; если его нет (скрипты, тесты) — создаётся по умолчанию."""
+    global _client
+    if _client is None:
+        _client = CryptoPayClient(CRYPTO_PAY_API_TOKEN)
+    return _client
 
 
 async def create_crypto_invoice(
@@ -14,46 +190,13 @@ async def create_crypto_invoice(
     """
     Создаёт счёт в фиатной валюте, но принимает оплату в крипте (USDT).
     """
-    async with aiohttp.ClientSession() as session:
-        async with session.post(
-            "https://pay.crypt.bot/api/createInvoice",
-            headers={
-                "Crypto-Pay-API-Token": CRYPTO_PAY_API_TOKEN,
-                "Content-Type": "application/json"
-            },
-            json={
-                "currency_type": "fiat",
-                "fiat": fiat_currency,
-                "amount": str(amount_fiat),
-                "accepted_assets": "USDT",
-                "description": description[:1024],
-                "payload": payload[:4096],
-                "allow_comments": False,
-                "allow_anonymous": False,
-                "expires_in": 900  # 15 минут
-            }
-        ) as resp:
-            if resp.status != 200:
-                text = await resp.text()
-                raise Exception(f"HTTP {resp.status}: {text}")
-            content_type = resp.headers.get('Content-Type', '')
-            if 'application/json' not in content_type:
-                text = await resp.text()
-                raise Exception(f"Unexpected content type: {content_type}. Response: {text}")
-            data = await resp.json()
-            if not data.get("ok"):
-                error = data.get("error", "Unknown error")
-                raise Exception(f"CryptoPay API error: {error}")
-            return data["result"]
+    return await get_crypto_pay_client().create_invoice(amount_fiat, fiat_currency, description, payload)
+
+
+async def get_invoices(invoice_ids: List[int]) -> List[Dict[str, Any]]:
+    return await get_crypto_pay_client().get_invoices(invoice_ids)
 
 
 async def get_invoice_status(invoice_id: int) -> Dict[str, Any] | None:
-    async with aiohttp.ClientSession() as session:
-        async with session.get(
-            f"https://pay.crypt.bot/api/getInvoices?invoice_ids={invoice_id}",
-            headers={"Crypto-Pay-API-Token": CRYPTO_PAY_API_TOKEN}
-        ) as resp:
-            data = await resp.json()
-            if data.get("ok") and data["result"]["items"]:
-                return data["result"]["items"][0]
-            return None
+    items = await get_invoices([invoice_id])
+    return items[0] if items else None
@@ -0,0 +1,220 @@
+# services/message_sender.py
+"""
+Единый диспетчер исходящих запросов к Telegram Bot API.
+
+Подключается как request-middleware сессии бота, поэтому через него проходят все вызовы:
+ответы хендлеров, уведомления и рассылки. Отправка сообщений ограничивается общим
+token bucket (~30 сообщ./с) и bucket'ом на каждый чат; ожидающие запросы обслуживаются
+по приоритету полос: интерактивные ответы → уведомления → рассылки.
+TelegramRetryAfter обрабатывается автоматически: отправка ставится на паузу и повторяется.
+
+Полоса задаётся контекстом:
+    with outbound_lane(LANE_BROADCAST):
+        await bot.send_message(...)
+или для всей фоновой задачи — set_outbound_lane(LANE_NOTIFICATION) в её начале.
+"""
+import asyncio
+import contextvars
+import itertools
+import logging
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+from config import OutboundConfig
+
+logger = logging.getLogger(__name__)
+
+LANE_INTERACTIVE = 0
+LANE_NOTIFICATION = 1
+LANE_BROADCAST = 2
+LANE_NAMES = {
+    LANE_INTERACTIVE: "interactive",
+    LANE_NOTIFICATION: "notification",
+    LANE_BROADCAST: "broadcast",
+}
+
+_lane = contextvars.ContextVar("outbound_lane", default=LANE_INTERACTIVE)
+
+# Методы, которые отправляют новое сообщение в чат и подпадают под лимиты рассылки
+_LIMITED_PREFIXES = ("send", "copy", "forward")
+_UNLIMITED_METHODS = {"sendChatAction"}
+
+
+def set_outbound_lane(lane: int) -> None:
+    """Назначает полосу для текущей задачи (наследуется дочерними задачами)."""
+    _lane.set(lane)
+
+
+@contextmanager
+def outbound_lane(lane: int):
+    """Временно назначает полосу для запросов внутри блока."""
+    token = _lane.set(lane)
+    try:
+        yield
+    finally:
+        _lane.reset(token)
+
+
+class TokenBucket:
+    """Классический token bucket: rate токенов в секунду, не более capacity про запас."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def is_full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class OutboundLimiter(BaseRequestMiddleware):
+    """Request-middleware: лимиты Telegram, приоритетные полосы, RetryAfter и счётчики."""
+
+    def __init__(self):
+        self._global = TokenBucket(OutboundConfig.GLOBAL_RATE, OutboundConfig.GLOBAL_BURST)
+        self._chats: Dict[int, TokenBucket] = {}
+        self._queue: asyncio.PriorityQueue = None
+        self._pump_task: asyncio.Task = None
+        self._seq = itertools.count()
+        self._paused_until = 0.0
+
+        # Счётчики пропускной способности
+        self.sent_by_lane = {lane: 0 for lane in LANE_NAMES}
+        self.retry_after_count = 0
+        self._recent = deque()
+
+    # ---------- Очередь с приоритетами ----------
+    def _ensure_pump(self) -> None:
+        """
+        Запускает насос очереди, если его нет или он завершился (ошибка, смена event loop).
+        Очередь создаётся заново (она привязана к loop), ожидающие запросы текущего loop
+        переносятся в новую, чтобы их отправка не зависла навсегда.
+        """
+        if self._pump_task is not None and not self._pump_task.done():
+            return
+        if self._pump_task is not None and not self._pump_task.cancelled() and self._pump_task.exception():
+            logger.error(f"Насос исходящей очереди упал: {self._pump_task.exception()!r}, перезапуск")
+
+        old_queue = self._queue
+        self._queue = asyncio.PriorityQueue()
+        if old_queue is not None:
+            loop = asyncio.get_running_loop()
+            while not old_queue.empty():
+                item = old_queue.get_nowait()
+                future = item[2]
+                # Futures завершённого loop разбудить уже нельзя — их ожидающих больше нет
+                if not future.done() and future.get_loop() is loop:
+                    self._queue.put_nowait(item)
+        self._pump_task = asyncio.create_task(self._pump(), name="outbound_pump")
+
+    async def _pump(self) -> None:
+        """Выдаёт глобальные токены ожидающим запросам в порядке приоритета полос."""
+        while True:
+            lane, seq, future = await self._queue.get()
+            if future.done():
+                continue  # запрос отменён, пока стоял в очереди
+            try:
+                delay = self._paused_until - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                await self._global.acquire()
+            except Exception as e:
+                # Уже взятый из очереди запрос не должен зависнуть вместе с насосом
+                if not future.done():
+                    future.set_exception(e)
+                raise
+            if not future.done():
+                future.set_result(None)
+
+    async def _wait_turn(self, chat_id, lane: int) -> None:
+        if chat_id is not None:
+            bucket = self._chats.get(chat_id)
+            if bucket is None:
+                self._prune_chats()
+                bucket = self._chats[chat_id] = TokenBucket(
+                    1 / OutboundConfig.PER_CHAT_INTERVAL, OutboundConfig.PER_CHAT_BURST
+                )
+            await bucket.acquire()
+
+        self._ensure_pump()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((lane, next(self._seq), future))
+        await future
+
+    def _prune_chats(self) -> None:
+        """Удаляет простаивающие bucket'ы чатов, чтобы словарь не рос бесконечно."""
+        if len(self._chats) < OutboundConfig.MAX_TRACKED_CHATS:
+            return
+        for chat_id in [cid for cid, bucket in self._chats.items() if bucket.is_full()]:
+            del self._chats[chat_id]
+
+    # ---------- Счётчики ----------
+    def _record_sent(self, lane: int) -> None:
+        now = time.monotonic()
+        self.sent_by_lane[lane] += 1
+        self._recent.append(now)
+        while self._recent and self._recent[0] < now - 60:
+            self._recent.popleft()
+
+    def stats(self) -> dict:
+        """Пропускная способность: всего отправлено, по полосам, за последнюю минуту, RetryAfter."""
+        now = time.monotonic()
+        while self._recent and self._recent[0] < now - 60:
+            self._recent.popleft()
+        return {
+            "sent": sum(self.sent_by_lane.values()),
+            "by_lane": {LANE_NAMES[lane]: count for lane, count in self.sent_by_lane.items()},
+            "last_minute": len(self._recent),
+            "queued": self._queue.qsize() if self._queue else 0,
+            "retry_after": self.retry_after_count,
+        }
+
+    # ---------- Middleware ----------
+    async def __call__(self, make_request, bot, method):
+        api_method = method.__api_method__
+        limited = api_method.startswith(_LIMITED_PREFIXES) and api_method not in _UNLIMITED_METHODS
+        lane = _lane.get()
+        chat_id = getattr(method, "chat_id", None)
+
+        for attempt in range(OutboundConfig.MAX_RETRIES + 1):
+            if limited:
+                await self._wait_turn(chat_id, lane)
+            try:
+                response = await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self.retry_after_count += 1
+                if attempt >= OutboundConfig.MAX_RETRIES:
+                    raise
+                # Флуд-контроль действует на весь бот: приостанавливаем все лимитируемые отправки
+                self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+                logger.warning(f"⏳ Telegram RetryAfter {e.retry_after} с ({api_method}), повтор {attempt + 1}")
+                await asyncio.sleep(e.retry_after)
+                continue
+            if limited:
+                self._record_sent(lane)
+            return response
+
+
+outbound = OutboundLimiter()
@@ -0,0 +1,359 @@
+# services/payment_service.py
+"""
+Выполнение оплаченных операций. Используется кнопкой «Проверить оплату»
+и фоновой задачей tasks/payment_watcher.
+
+Платёж проходит состояния pending → paid → provisioning → done / failed.
+Каждый переход — условный UPDATE по текущему статусу, поэтому выдачу выполняет
+ровно один обработчик; блокировка на счёт дополнительно сводит одновременные
+проверки к одному запросу статуса. Статус сохраняется в БД: после перезапуска
+recover_payments продолжает с записанного состояния.
+"""
+import asyncio
+import json
+import logging
+from contextlib import asynccontextmanager
+from typing import Dict, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.enums import ParseMode
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from sqlalchemy.engine import Row
+
+from config import ADMIN_TELEGRAM_ID
+from services.crypto_pay import get_invoice_status
+from services.server_registry import server_registry
+from services.subscription_service import create_new_subscription, renew_subscription
+from services.traffic_service import apply_traffic_change
+from services.xui_manager import get_xui_manager
+from storage.database import async_session_maker, PendingPayment, Config, User
+from utils.helpers import now_ts
+
+logger = logging.getLogger(__name__)
+
+STATUS_PENDING = "pending"
+STATUS_PAID = "paid"
+STATUS_PROVISIONING = "provisioning"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+KIND_SUBSCRIPTION = "subscription"
+KIND_RENEW = "renew"
+KIND_RESET_TRAFFIC = "reset_traffic"
+KIND_ADD_TRAFFIC = "add_traffic"
+
+# Блокировки по payment_id и число их ожидающих (блокировка удаляется, когда никто не ждёт)
+_locks: Dict[str, asyncio.Lock] = {}
+_lock_waiters: Dict[str, int] = {}
+
+
+@asynccontextmanager
+async def _payment_lock(payment_id: str):
+    lock = _locks.setdefault(payment_id, asyncio.Lock())
+    _lock_waiters[payment_id] = _lock_waiters.get(payment_id, 0) + 1
+    try:
+        async with lock:
+            yield
+    finally:
+        _lock_waiters[payment_id] -= 1
+        if not _lock_waiters[payment_id]:
+            del _lock_waiters[payment_id]
+            del _locks[payment_id]
+
+
+async def create_pending_payment(
+    payment_id: str,
+    invoice: dict,
+    user_id,
+    kind: str,
+    amount: int,
+    payload: str,
+    server_id: Optional[str] = None,
+    config_id: Optional[str] = None,
+    tariff_id: Optional[int] = None,
+    category: Optional[str] = None,
+    duration_days: Optional[int] = None
+) -> None:
+    """Сохраняет созданный в Crypto Pay счёт (invoice — ответ createInvoice) в статусе pending."""
+    async with async_session_maker() as session:
+        await session.execute(
+            PendingPayment.__table__.insert().values(
+                payment_id=payment_id,
+                bot_invoice_id=str(invoice["invoice_id"]),
+                payload=payload,
+                created_at=now_ts(),
+                user_id=str(user_id),
+                status=STATUS_PENDING,
+                kind=kind,
+                server_id=server_id,
+                config_id=config_id,
+                tariff_id=tariff_id,
+                category=category,
+                duration_days=duration_days,
+                amount=amount
+            )
+        )
+        await session.commit()
+
+
+async def get_payment(payment_id: str) -> Optional[Row]:
+    async with async_session_maker() as session:
+        result = await session.execute(
+            PendingPayment.__table__.select().where(PendingPayment.payment_id == payment_id)
+        )
+        return result.fetchone()
+
+
+async def _transition(payment_id: str, from_status: str, to_status: str) -> bool:
+    """Атомарно меняет статус, только если платёж всё ещё в from_status."""
+    async with async_session_maker() as session:
+        result = await session.execute(
+            PendingPayment.__table__.update()
+            .where(PendingPayment.payment_id == payment_id, PendingPayment.status == from_status)
+            .values(status=to_status, updated_at=now_ts())
+        )
+        await session.commit()
+    return result.rowcount == 1
+
+
+async def process_payment(
+    payment_id: str,
+    username: Optional[str] = None,
+    confirmed: bool = False
+) -> Optional[Tuple[str, Optional[str], Optional[InlineKeyboardMarkup]]]:
+    """
+    Проверяет оплату счёта и выполняет его.
+
+    Args:
+        payment_id: PendingPayment.payment_id
+        username: Имя пользователя в Telegram (для новой подписки); None — из таблицы users
+        confirmed: Оплата уже подтверждена (наблюдатель, пропуск оплаты админом) — без запроса статуса
+
+    Returns:
+        None, если счёт не найден, иначе (статус, текст, клавиатура). Текст есть только
+        у выполненного этим вызовом платежа; (STATUS_PENDING, None, None) — оплаты ещё нет,
+        другой статус без текста — платёж обработан ранее. Ошибка выдачи переводит
+        платёж в failed и пробрасывается.
+    """
+    async with _payment_lock(payment_id):
+        payment_row = await get_payment(payment_id)
+        if not payment_row:
+            return None
+
+        if payment_row.status == STATUS_PENDING:
+            if not confirmed:
+                invoice = await get_invoice_status(int(payment_row.bot_invoice_id))
+                if not (invoice and invoice["status"] == "paid"):
+                    return STATUS_PENDING, None, None
+            if not await _transition(payment_id, STATUS_PENDING, STATUS_PAID):
+                return (await get_payment(payment_id)).status, None, None
+        elif payment_row.status != STATUS_PAID:
+            return payment_row.status, None, None
+
+        return await _provision(payment_row, username)
+
+
+async def _provision(
+    payment_row: Row,
+    username: Optional[str]
+) -> Tuple[str, Optional[str], Optional[InlineKeyboardMarkup]]:
+    """paid → provisioning → done / failed."""
+    payment_id = payment_row.payment_id
+    if not await _transition(payment_id, STATUS_PAID, STATUS_PROVISIONING):
+        return (await get_payment(payment_id)).status, None, None
+
+    try:
+        if username is None:
+            async with async_session_maker() as session:
+                result = await session.execute(
+                    User.__table__.select().where(User.tg_id == str(payment_row.user_id))
+                )
+                user_row = result.fetchone()
+            username = user_row.username if user_row else None
+        text, kb = await provision_payment(payment_row, username)
+    except Exception:
+        await _transition(payment_id, STATUS_PROVISIONING, STATUS_FAILED)
+        raise
+
+    await _transition(payment_id, STATUS_PROVISIONING, STATUS_DONE)
+    logger.info(f"💰 Счёт {payment_id} выполнен (пользователь {payment_row.user_id})")
+    return STATUS_DONE, text, kb
+
+
+async def notify_payment_failed(bot: Bot, payment_row: Row, error: str) -> None:
+    """Сообщает администратору об оплаченном, но не выполненном счёте."""
+    try:
+        await bot.send_message(
+            ADMIN_TELEGRAM_ID,
+            f"⚠️ Оплаченный счёт не выполнен\n"
+            f"Счёт: <code>{payment_row.payment_id}</code>\n"
+            f"Пользователь: {payment_row.user_id}\n"
+            f"Payload: <code>{payment_row.payload}</code>\n"
+            f"Ошибка: {error}",
+            parse_mode=ParseMode.HTML
+        )
+    except Exception as e:
+        logger.error(f"Не удалось уведомить администратора о счёте {payment_row.payment_id}: {e}")
+
+
+async def complete_paid_payment(bot: Bot, payment_id: str) -> None:
+    """Выполняет счёт с подтверждённой оплатой и присылает пользователю результат."""
+    try:
+        outcome = await process_payment(payment_id, confirmed=True)
+    except Exception as e:
+        logger.error(f"❌ Оплаченный счёт {payment_id} не выполнен: {e}")
+        payment_row = await get_payment(payment_id)
+        try:
+            await bot.send_message(
+                int(payment_row.user_id),
+                "❌ <b>Оплата получена, но при выдаче произошла ошибка.</b>\n"
+                "Администратор уже уведомлён и решит вопрос.",
+                parse_mode=ParseMode.HTML,
+                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                    [InlineKeyboardButton(text="ОК", callback_data="start_menu")]
+                ])
+            )
+        except Exception as notify_error:
+            logger.warning(f"Не удалось уведомить пользователя {payment_row.user_id}: {notify_error}")
+        await notify_payment_failed(bot, payment_row, str(e))
+        return
+
+    if not outcome or not outcome[1]:
+        # Уже выполнен кнопкой «Проверить оплату» или другим проходом
+        return
+    _, text, kb = outcome
+    payment_row = await get_payment(payment_id)
+    try:
+        await bot.send_message(int(payment_row.user_id), text, parse_mode=ParseMode.HTML, reply_markup=kb)
+    except Exception as e:
+        logger.warning(f"Не удалось уведомить пользователя {payment_row.user_id} об оплате: {e}")
+
+
+async def recover_payments(bot: Bot) -> None:
+    """
+    Продолжает платежи, прерванные перезапуском.
+    paid — оплата подтверждена, выдача не начиналась: выполняется сейчас.
+    provisioning — выдача прервана на середине и могла частично пройти в панели;
+    повтор может создать дубликат, поэтому платёж переводится в failed и передаётся администратору.
+    """
+    async with async_session_maker() as session:
+        result = await session.execute(
+            PendingPayment.__table__.select().where(
+                PendingPayment.status.in_([STATUS_PAID, STATUS_PROVISIONING])
+            )
+        )
+        rows = result.fetchall()
+    if not rows:
+        return
+
+    logger.info(f"🔁 Восстановление прерванных платежей: {len(rows)}")
+    for payment_row in rows:
+        if payment_row.status == STATUS_PAID:
+            await complete_paid_payment(bot, payment_row.payment_id)
+        elif await _transition(payment_row.payment_id, STATUS_PROVISIONING, STATUS_FAILED):
+            logger.warning(f"Счёт {payment_row.payment_id} прерван во время выдачи, требуется проверка")
+            await notify_payment_failed(bot, payment_row, "выдача прервана перезапуском бота, проверьте панель")
+
+
+async def provision_payment(payment_row: Row, username: Optional[str]) -> Tuple[str, InlineKeyboardMarkup]:
+    """
+    Выполняет оплаченную операцию по колонкам платежа (kind, config_id, ...) и сбрасывает
+    скидку пользователя. Возвращает текст и клавиатуру сообщения для пользователя;
+    при ошибке бросает исключение.
+    """
+    user_id = payment_row.user_id
+    config_id = payment_row.config_id
+
+    # 1. Сброс трафика
+    if payment_row.kind == KIND_RESET_TRAFFIC:
+        async with async_session_maker() as session:
+            config_result = await session.execute(
+                Config.__table__.select().where(
+                    Config.id == config_id,
+                    Config.user_tg_id == str(user_id)
+                )
+            )
+            config_row = config_result.fetchone()
+            if not config_row:
+                raise Exception("Конфиг не найден или не принадлежит вам")
+
+            server_row = server_registry.get(config_row.server_id)
+            if not server_row:
+                raise Exception("Сервер не найден")
+
+            xui = await get_xui_manager(server_row)
+            used_bytes = await xui.get_client_traffic(config_row.client_email)
+            used_gb = used_bytes / (1024 ** 3)
+            current_limit_gb = config_row.traffic_limit_gb or 0
+            success = await xui.reset_client_traffic(server_row.inbound_id, config_row.client_email)
+            if not success:
+                raise Exception("Не удалось сбросить трафик")
+
+            addons = json.loads(config_row.addons)
+            addons["traffic_reset_count"] = addons.get("traffic_reset_count", 0) + 1
+            await session.execute(
+                Config.__table__.update()
+                .where(Config.id == config_id)
+                .values(
+                    notify_traffic_80_sent=False,
+                    notify_traffic_95_sent=False
+                )
+            )
+            await session.commit()
+
+        text = f"✅ Трафик сброшен!\nИспользовано: {used_gb:.1f} / {current_limit_gb} ГБ"
+        kb = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="⬅️ Назад к конфигу", callback_data=f"manage_config_{config_id}")]
+        ])
+
+    # 2. Новая подписка
+    elif payment_row.kind == KIND_SUBSCRIPTION:
+        if not payment_row.duration_days:
+            raise Exception("В платеже не указан срок подписки")
+        result = await create_new_subscription(
+            int(user_id), payment_row.server_id, payment_row.category, payment_row.duration_days, username
+        )
+        if not result:
+            raise Exception("Не удалось создать подписку")
+        text = (
+            "✅ Оплата подтверждена!\n"
+            "Ваша ссылка:\n"
+            f"<code>{result['vless_link']}</code>\n"
+            "Ссылка на подписку:\n"
+            f"<code>{result['subscription_link']}</code>"
+        )
+        kb = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="🖼️ Сгенерировать QR-коды", callback_data=f"generate_qr_{result['config_id']}")]
+        ])
+
+    # 3. Продление (срок зафиксирован при создании счёта)
+    elif payment_row.kind == KIND_RENEW:
+        if not payment_row.duration_days:
+            raise Exception("В платеже не указан срок продления")
+        if not await renew_subscription(user_id, config_id, payment_row.duration_days):
+            raise Exception("Не удалось продлить подписку")
+        text = "✅ Подписка успешно продлена!"
+        kb = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="⬅️ Назад к конфигу", callback_data=f"manage_config_{config_id}")]
+        ])
+
+    # 4. +100 ГБ
+    elif payment_row.kind == KIND_ADD_TRAFFIC:
+        await apply_traffic_change(config_id, user_id, delta_gb=100)
+        text = "✅ +100 ГБ добавлено."
+        kb = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="⬅️ Назад к конфигу", callback_data=f"manage_config_{config_id}")]
+        ])
+
+    else:
+        raise Exception(f"Неизвестный тип платежа: {payment_row.kind}")
+
+    async with async_session_maker() as session:
+        await session.execute(
+            User.__table__.update()
+            .where(User.tg_id == str(user_id))
+            .values(pending_discount_type=None, pending_discount_value=None)
+        )
+        await session.commit()
+
+    return text, kb
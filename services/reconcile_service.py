@@ -0,0 +1,239 @@
+# services/reconcile_service.py
+"""
+Сверка таблицы configs с клиентами inbound'а в панели 3x-ui.
+
+На сервер — один запрос getInbound; клиенты панели и строки Config сопоставляются
+по email через словари, поэтому расхождения находятся за один проход:
+  • «призраки» — клиенты в панели без строки в БД (занимают место и трафик);
+  • «потерянные» — строки в БД, клиента которых в панели уже нет.
+"""
+import asyncio
+import json
+import logging
+import re
+import time
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import select
+
+from config import ReconcileConfig
+from storage.database import async_session_maker, Config
+from services.xui_manager import get_xui_manager
+from utils.cache import my_configs_cache
+from utils.helpers import now_ts
+
+logger = logging.getLogger(__name__)
+
+# Email, выданный ботом: {префикс из 6 букв/цифр}_{tg_id}_{номер}, trial_{префикс}_{tg_id}_{номер}
+# или старый {tg_id}_{номер}. Группа tg_id сверяется с tgId клиента в панели.
+BOT_EMAIL_RE = re.compile(r"^(?:(?:trial_)?[A-Za-z0-9]{6}_(?P<tg_id>\d+)|(?P<legacy_tg_id>\d+))_\d+$")
+
+
+def is_bot_client(client: Dict[str, Any]) -> bool:
+    """
+    Клиент создан ботом: email точно в формате бота и tgId совпадает с tg_id из email.
+    Остальных клиентов (созданных в панели вручную) сверка только показывает и никогда не удаляет.
+    """
+    match = BOT_EMAIL_RE.match(client["email"])
+    if not match:
+        return False
+    return client["tg_id"] == (match.group("tg_id") or match.group("legacy_tg_id"))
+
+
+def _panel_clients(inbound: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    """email -> клиент из settings inbound'а, с трафиком и enable из clientStats."""
+    settings = inbound.get("settings") or "{}"
+    if isinstance(settings, str):
+        settings = json.loads(settings)
+    stats = {s.get("email"): s for s in inbound.get("clientStats") or []}
+
+    clients = {}
+    for client in settings.get("clients") or []:
+        email = client.get("email")
+        if not email:
+            continue
+        stat = stats.get(email) or {}
+        clients[email] = {
+            "email": email,
+            "enable": bool(stat.get("enable", client.get("enable", True))),
+            "used_bytes": int(stat.get("up") or 0) + int(stat.get("down") or 0),
+            "expiry_ms": int(client.get("expiryTime") or 0),
+            "tg_id": str(client.get("tgId") or ""),
+        }
+    return clients
+
+
+async def _email_in_db(server_id: str, email: str) -> bool:
+    async with async_session_maker() as session:
+        result = await session.execute(
+            select(Config.id).where(Config.server_id == server_id, Config.client_email == email).limit(1)
+        )
+        return result.first() is not None
+
+
+async def reconcile_server(server) -> Dict[str, Any]:
+    """
+    Сверяет один сервер: один SELECT по configs и один запрос к панели.
+    Ничего не меняет — возвращает отчёт для format_reconcile_report / repair_server.
+
+    Сначала читается БД, потом панель: покупка создаёт клиента в панели раньше строки
+    в БД, поэтому при таком порядке она может показаться только «призраком», а не
+    «потерянной» строкой. Призраки перед удалением перепроверяются в repair_server.
+    """
+    started = time.monotonic()
+    async with async_session_maker() as session:
+        result = await session.execute(
+            select(
+                Config.id, Config.client_email, Config.user_tg_id, Config.active, Config.expiry
+            ).where(Config.server_id == server.id)
+        )
+        db = {row.client_email: row for row in result if row.client_email}
+
+    xui = await get_xui_manager(server)
+    inbound = await xui.get_inbound(int(server.inbound_id))
+    panel = _panel_clients(inbound)
+
+    ghosts = [client for email, client in panel.items() if email not in db]
+    now = now_ts()
+    missing = [
+        {
+            "config_id": row.id,
+            "email": email,
+            "user_tg_id": row.user_tg_id,
+            "active": bool(row.active),
+            "expired": bool(row.expiry and row.expiry < now),
+        }
+        for email, row in db.items() if email not in panel
+    ]
+
+    return {
+        "server_id": server.id,
+        "inbound_id": server.inbound_id,
+        "panel_clients": len(panel),
+        "db_configs": len(db),
+        "ghosts": ghosts,
+        "missing": missing,
+        "elapsed": time.monotonic() - started,
+    }
+
+
+async def repair_server(server, report: Dict[str, Any]) -> Dict[str, int]:
+    """
+    Исправляет расхождения из отчёта reconcile_server:
+      • призраки с email формата бота удаляются из панели (ручные клиенты не трогаются);
+      • потерянные строки с истёкшим сроком удаляются из БД, остальные помечаются active=False
+        (оплаченная подписка без клиента — повод разобраться вручную, а не молча удалить).
+    Отчёт к этому моменту мог устареть (покупка или продление между чтениями),
+    поэтому каждый email перепроверяется прямо перед изменением и пропускается,
+    если расхождения уже нет.
+    """
+    xui = await get_xui_manager(server)
+    own_ghosts = [c["email"] for c in report["ghosts"] if is_bot_client(c)]
+
+    async def _delete_ghost(email: str) -> Optional[bool]:
+        """True — удалён; None — строка в БД уже появилась; False — не удалось."""
+        try:
+            if await _email_in_db(server.id, email):
+                return None
+            return await xui.delete_client_by_email(inbound_id=server.inbound_id, email=email)
+        except Exception as e:
+            logger.error(f"Сверка {server.id}: не удалось удалить клиента {email}: {e}")
+            return False
+
+    async def _fix_row(row: dict) -> Optional[str]:
+        """"deleted" / "deactivated"; None — клиент уже есть в панели; "error" — не удалось."""
+        try:
+            if await xui.get_client_state(row["email"]):
+                return None
+            async with async_session_maker() as session:
+                if row["expired"]:
+                    await session.execute(Config.__table__.delete().where(Config.id == row["config_id"]))
+                    action = "deleted"
+                else:
+                    await session.execute(
+                        Config.__table__.update().where(Config.id == row["config_id"]).values(active=False)
+                    )
+                    action = "deactivated"
+                await session.commit()
+            return action
+        except Exception as e:
+            logger.error(f"Сверка {server.id}: не удалось исправить конфиг {row['config_id']}: {e}")
+            return "error"
+
+    # Параллельность запросов к панели ограничена семафором XUIManager
+    ghost_results = await asyncio.gather(*(_delete_ghost(email) for email in own_ghosts))
+    rows = [m for m in report["missing"] if m["expired"] or m["active"]]
+    row_results = await asyncio.gather(*(_fix_row(m) for m in rows))
+    if "deleted" in row_results or "deactivated" in row_results:
+        my_configs_cache.clear()
+
+    result = {
+        "ghosts_deleted": sum(1 for r in ghost_results if r),
+        "ghosts_skipped": len(report["ghosts"]) - len(own_ghosts),
+        "rows_deleted": row_results.count("deleted"),
+        "rows_deactivated": row_results.count("deactivated"),
+        "rechecked_ok": ghost_results.count(None) + row_results.count(None),
+    }
+    logger.info(f"🧹 Сверка {server.id}: исправлено {result}")
+    return result
+
+
+def has_discrepancies(report: Dict[str, Any]) -> bool:
+    """Есть ли что исправлять: ручные клиенты панели и уже отключённые строки не считаются."""
+    return (
+        any(is_bot_client(c) for c in report["ghosts"])
+        or any(m["active"] or m["expired"] for m in report["missing"])
+    )
+
+
+def format_reconcile_report(report: Dict[str, Any], limit: int = 10) -> str:
+    """Текст отчёта для админ-панели (HTML)."""
+    ghosts: List[dict] = report["ghosts"]
+    missing: List[dict] = report["missing"]
+    ghost_gb = sum(c["used_bytes"] for c in ghosts) / 1024 ** 3
+    enabled = sum(1 for c in ghosts if c["enable"])
+    foreign = sum(1 for c in ghosts if not is_bot_client(c))
+
+    lines = [
+        f"<b>🔍 Сверка сервера {report['server_id']}</b> (inbound {report['inbound_id']})\n",
+        f"Клиентов в панели: {report['panel_clients']}",
+        f"Конфигов в БД: {report['db_configs']}\n",
+        f"👻 Клиенты без записи в БД: <b>{len(ghosts)}</b>"
+        + (f" (включены: {enabled}, трафик {ghost_gb:.2f} ГБ, созданы вручную: {foreign})" if ghosts else ""),
+    ]
+    for c in ghosts[:limit]:
+        lines.append(f"  • <code>{c['email']}</code>{'' if c['enable'] else ' (выключен)'}")
+    if len(ghosts) > limit:
+        lines.append(f"  … и ещё {len(ghosts) - limit}")
+
+    active = sum(1 for m in missing if m["active"] and not m["expired"])
+    lines.append(
+        f"\n🕳 Конфиги без клиента в панели: <b>{len(missing)}</b>"
+        + (f" (действующих: {active})" if missing else "")
+    )
+    for m in missing[:limit]:
+        state = "истёк" if m["expired"] else ("активен" if m["active"] else "отключён")
+        lines.append(f"  • <code>{m['email']}</code> — пользователь {m['user_tg_id']}, {state}")
+    if len(missing) > limit:
+        lines.append(f"  … и ещё {len(missing) - limit}")
+
+    lines.append(f"\n⏱ {report['elapsed']:.2f} с")
+    return "\n".join(lines)
+
+
+async def reconcile_all_servers(servers) -> List[Dict[str, Any]]:
+    """
+    Сверяет несколько серверов параллельно (не более ReconcileConfig.MAX_CONCURRENT_SERVERS).
+    Ошибка одной панели не прерывает остальные: в отчёт попадает {"server_id", "error"}.
+    """
+    semaphore = asyncio.Semaphore(ReconcileConfig.MAX_CONCURRENT_SERVERS)
+
+    async def _one(server) -> Dict[str, Any]:
+        async with semaphore:
+            try:
+                return await asyncio.wait_for(reconcile_server(server), timeout=ReconcileConfig.SERVER_TIMEOUT)
+            except Exception as e:
+                logger.error(f"❌ Сверка сервера {server.id} не удалась: {type(e).__name__}: {e}")
+                return {"server_id": server.id, "error": str(e) or type(e).__name__}
+
+    return await asyncio.gather(*(_one(server) for server in servers))
@@ -0,0 +1,69 @@
+# services/server_registry.py
+"""
+Каталог серверов в памяти процесса.
+
+Список серверов меняется редко (только из админ-панели), а читается почти каждым хендлером,
+поэтому он загружается один раз при запуске и перезагружается после изменений
+(ServerRegistry.reload). Записи — строки Server.__table__.select(): неизменяемые,
+с теми же атрибутами, что и модель, и подходят для get_xui_manager().
+"""
+import logging
+from typing import Callable, Dict, List, Optional
+
+from sqlalchemy.engine import Row
+
+from storage.database import async_session_maker, Server
+
+logger = logging.getLogger(__name__)
+
+
+class ServerRegistry:
+    def __init__(self):
+        self._by_id: Dict[str, Row] = {}
+        self._active: List[Row] = []
+        self._active_by_mobile: Dict[bool, List[Row]] = {True: [], False: []}
+        self._listeners: List[Callable[[], None]] = []
+        self.loaded = False
+
+    async def reload(self) -> None:
+        """Перечитывает сервера из БД, пересобирает индексы и уведомляет подписчиков."""
+        async with async_session_maker() as session:
+            result = await session.execute(Server.__table__.select().order_by(Server.id))
+            rows = result.fetchall()
+
+        active = [row for row in rows if row.active]
+        self._by_id = {row.id: row for row in rows}
+        self._active = active
+        self._active_by_mobile = {
+            True: [row for row in active if row.mobile_spoof],
+            False: [row for row in active if not row.mobile_spoof],
+        }
+        self.loaded = True
+        logger.info(f"🖥️ Каталог серверов загружен: {len(rows)} (активных: {len(active)})")
+
+        for listener in self._listeners:
+            try:
+                listener()
+            except Exception as e:
+                logger.error(f"Ошибка в подписчике каталога серверов: {e}")
+
+    def subscribe(self, listener: Callable[[], None]) -> None:
+        """Регистрирует функцию, вызываемую после каждой перезагрузки каталога."""
+        self._listeners.append(listener)
+
+    def get(self, server_id: str) -> Optional[Row]:
+        """Сервер по id (включая неактивные) или None."""
+        return self._by_id.get(server_id)
+
+    def all(self) -> List[Row]:
+        return list(self._by_id.values())
+
+    def active(self) -> List[Row]:
+        return list(self._active)
+
+    def active_by_mobile(self, mobile_spoof: bool) -> List[Row]:
+        """Активные сервера нужного типа: мобильные (mobile_spoof) или обычные."""
+        return list(self._active_by_mobile[bool(mobile_spoof)])
+
+
+server_registry = ServerRegistry()
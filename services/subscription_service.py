@@ -4,9 +4,11 @@ import json
 import logging
 
 from config import STABLE_BASE_PRICES, MOBILE_BASE_PRICES
-from services.xui_manager import XUIManager
-from storage.database import async_session_maker, Config, Server, User
-from utils.helpers import generate_random_prefix, gb_to_bytes
+from services.xui_manager import get_xui_manager
+from storage.database import async_session_maker, Config, User
+from services.server_registry import server_registry
+from utils.helpers import generate_random_prefix, gb_to_bytes, now_ts, to_ts, from_ts, add_months_ts
+from utils.cache import invalidate_user_configs
 
 
 async def get_next_config_number(user_id: str) -> int:
@@ -51,10 +53,7 @@ async def create_new_subscription(
 
         async with async_session_maker() as session:
             # Получаем сервер
-            server_result = await session.execute(
-                Server.__table__.select().where(Server.id == server_id)
-            )
-            server_row = server_result.fetchone()
+            server_row = server_registry.get(server_id)
             if not server_row:
                 logging.error(f"Сервер не найден: {server_id}")
                 return None
@@ -83,81 +82,77 @@ async def create_new_subscription(
             telegram_name = f"@{username}" if username else f"ID:{user_id}"
             comment = f"Telegram: {telegram_name} | Config #{config_number}"
 
-            xui = XUIManager(
-                base_url=server_row.xui_url,
-                username=server_row.xui_username,
-                password=server_row.xui_password,
-                server_id=server_id
+            xui = await get_xui_manager(server_row)
+
+            client_uuid = await xui.add_client(
+                inbound_id=server_row.inbound_id,
+                email=email,
+                user_id=user_id,
+                comment=comment,
+                expiry_days=duration_days,  # ← передаём число дней
+                client_sub_id=client_sub_id,
+                traffic_gb=100
             )
 
-            try:
-                client_uuid = await xui.add_client(
-                    inbound_id=server_row.inbound_id,
-                    email=email,
-                    user_id=user_id,
-                    comment=comment,
-                    expiry_days=duration_days,  # ← передаём число дней
-                    client_sub_id=client_sub_id,
-                    traffic_gb=100
-                )
+            if not client_uuid:
+                logging.error("Не удалось создать клиента в XUI")
+                return None
 
-                if not client_uuid:
-                    logging.error("Не удалось создать клиента в XUI")
-                    return None
-
-                inbound_data = await xui.get_inbound(server_row.inbound_id)
-                if not inbound_data:
-                    logging.error("Не удалось получить данные inbound")
-                    return None
-
-                server_ip = server_row.xui_url.split("//")[1].split(":")[0]
-
-                from utils.link_builder import build_vless_reality_link
-                vless_link = build_vless_reality_link(
-                    client_uuid=client_uuid,
-                    server_ip=server_ip,
-                    inbound=inbound_data,
-                    user_id=user_id,
-                    config_number=config_number,
-                    random_prefix=random_prefix,
-                    random_prefix_email=random_prefix_email
-                )
+            # Параметры REALITY/транспорта из кэша менеджера — без загрузки всего inbound
+            inbound_params = await xui.get_inbound_params(server_row.inbound_id)
+            if not inbound_params:
+                logging.error("Не удалось получить данные inbound")
+                return None
 
-                subscription_path = server_row.subscription_path or f"/sub{client_sub_id}"
-                subscription_port = server_row.subscription_port or "2096"
-                subscription_link = f"http://{server_ip}:{subscription_port}{subscription_path}/{client_sub_id}"
+            server_ip = server_row.xui_url.split("//")[1].split(":")[0]
+
+            from utils.link_builder import build_vless_reality_link
+            vless_link = build_vless_reality_link(
+                client_uuid=client_uuid,
+                server_ip=server_ip,
+                inbound_params=inbound_params,
+                user_id=user_id,
+                config_number=config_number,
+                random_prefix=random_prefix,
+                random_prefix_email=random_prefix_email
+            )
 
-                # Сохраняем конфиг в БД
-                new_expiry = datetime.now(timezone.utc) + timedelta(days=duration_days)
-                await session.execute(
-                    Config.__table__.insert().values(
-                        id=client_uuid,
-                        user_tg_id=str(user_id),
-                        server_id=server_id,
-                        client_email=email,
-                        base_tariff=str(duration_days),  # ← сохраняем как строку дней
-                        traffic_limit_gb="100",
-                        traffic_used_bytes="0",
-                        expiry=new_expiry.isoformat(),
-                        created_at=datetime.now(timezone.utc).isoformat(),
-                        vless_link=vless_link,
-                        subscription_link=subscription_link,
-                        client_sub_id=client_sub_id,
-                        active=True,
-                        addons='{"extra_traffic_gb": 0, "traffic_reset_count": 0}'
-                    )
+            subscription_path = server_row.subscription_path or f"/sub{client_sub_id}"
+            subscription_port = server_row.subscription_port or "2096"
+            subscription_link = f"http://{server_ip}:{subscription_port}{subscription_path}/{client_sub_id}"
+
+            # Сохраняем конфиг в БД
+            new_expiry = datetime.now(timezone.utc) + timedelta(days=duration_days)
+            created_at = now_ts()
+            await session.execute(
+                Config.__table__.insert().values(
+                    id=client_uuid,
+                    user_tg_id=str(user_id),
+                    server_id=server_id,
+                    client_email=email,
+                    base_tariff=duration_days,
+                    traffic_limit_gb=100,
+                    traffic_used_bytes=0,
+                    expiry=to_ts(new_expiry),
+                    created_at=created_at,
+                    # Ежемесячный сброс трафика — только для тарифов > 30 дней
+                    next_traffic_reset_at=add_months_ts(created_at) if duration_days > 30 else None,
+                    vless_link=vless_link,
+                    subscription_link=subscription_link,
+                    client_sub_id=client_sub_id,
+                    active=True,
+                    addons='{"extra_traffic_gb": 0, "traffic_reset_count": 0}'
                 )
-                await session.commit()
+            )
+            await session.commit()
+            invalidate_user_configs(user_id)
+
+            return {
+                "vless_link": vless_link,
+                "subscription_link": subscription_link,
+                "config_id": client_uuid
+            }
 
-                return {
-                    "vless_link": vless_link,
-                    "subscription_link": subscription_link,
-                    "config_id": client_uuid
-                }
-                
-            finally:
-                await xui.close()
-                
     except Exception as e:
         logging.error(f"Критическая ошибка в create_new_subscription: {e}")
         return None
@@ -189,66 +184,60 @@ async def renew_subscription(
                 return False
 
             # === НОВАЯ ПРОВЕРКА: ЗАПРЕТ ПРОДЛЕНИЯ TRIAL НА УРОВНЕ СЕРВИСА ===
-            if config_row.base_tariff == "Trial":
+            if config_row.is_trial:
                 logging.warning(f"Попытка продлить пробный конфиг {config_id}")
                 return False
             # === КОНЕЦ НОВОЙ ПРОВЕРКИ ===
 
 
             server_id = config_row.server_id
-            server_result = await session.execute(
-                Server.__table__.select().where(Server.id == server_id)
-            )
-            server_row = server_result.fetchone()
+            server_row = server_registry.get(server_id)
             if not server_row:
                 logging.error(f"Сервер не найден при продлении: {server_id}")
                 return False
 
-            xui = XUIManager(
-                base_url=server_row.xui_url,
-                username=server_row.xui_username,
-                password=server_row.xui_password,
-                server_id=server_id
+            xui = await get_xui_manager(server_row)
+
+            success = await xui.extend_client_expiry(
+                inbound_id=server_row.inbound_id,
+                email=config_row.client_email,
+                extra_days=duration_days  # ← передаём число дней
             )
+            if not success:
+                logging.error("Не удалось продлить подписку в XUI")
+                return False
+
+            old_expiry = from_ts(config_row.expiry)
+            new_expiry = old_expiry + timedelta(days=duration_days)
+
+            # === Подготавливаем данные для обновления ===
+            update_values = {
+                "expiry": to_ts(new_expiry),
+                "base_tariff": duration_days,
+                "notify_expiry_sent": False  # ← Сбрасываем флаг уведомления!
+            }
+
+            # === Инициализируем last_traffic_reset и дату сброса для тарифов > 30 дней ===
+            if duration_days > 30:
+                # Проверяем, установлено ли уже значение last_traffic_reset
+                last_reset = config_row.last_traffic_reset
+                if last_reset is None:
+                    last_reset = update_values["last_traffic_reset"] = now_ts()
+                if config_row.next_traffic_reset_at is None:
+                    update_values["next_traffic_reset_at"] = add_months_ts(last_reset)
+            else:
+                update_values["next_traffic_reset_at"] = None
+
+            # Обновляем конфиг в БД
+            await session.execute(
+                Config.__table__.update()
+                .where(Config.id == config_id)
+                .values(update_values)
+            )
+            await session.commit()
+            invalidate_user_configs(user_id)
+            return True
 
-            try:
-                success = await xui.extend_client_expiry(
-                    inbound_id=server_row.inbound_id,
-                    email=config_row.client_email,
-                    extra_days=duration_days  # ← передаём число дней
-                )
-                if not success:
-                    logging.error("Не удалось продлить подписку в XUI")
-                    return False
-
-                old_expiry = datetime.fromisoformat(config_row.expiry.replace("Z", "+00:00"))
-                new_expiry = old_expiry + timedelta(days=duration_days)
-
-                # === Подготавливаем данные для обновления ===
-                update_values = {
-                    "expiry": new_expiry.isoformat(),
-                    "base_tariff": str(duration_days),
-                    "notify_expiry_sent": False  # ← Сбрасываем флаг уведомления!
-                }
-
-                # === Инициализируем last_traffic_reset для тарифов > 30 дней ===
-                if duration_days > 30:
-                    # Проверяем, установлено ли уже значение last_traffic_reset
-                    if config_row.last_traffic_reset is None:
-                        update_values["last_traffic_reset"] = datetime.now(timezone.utc).isoformat()
-
-                # Обновляем конфиг в БД
-                await session.execute(
-                    Config.__table__.update()
-                    .where(Config.id == config_id)
-                    .values(update_values)
-                )
-                await session.commit()
-                return True
-                
-            finally:
-                await xui.close()
-                
     except Exception as e:
         logging.error(f"Критическая ошибка в renew_subscription: {e}")
         return False
@@ -1,19 +1,133 @@
 # services/tariff_service.py
+import logging
+from typing import Dict, List, Optional
+
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from sqlalchemy.engine import Row
+
 from storage.database import async_session_maker, Tariff
-from sqlalchemy import select, distinct
+from utils.helpers import format_tariff_name
+
+logger = logging.getLogger(__name__)
+
+
+class TariffCatalog:
+    """
+    Тарифы в памяти процесса вместе с готовыми клавиатурами покупки.
+    Перестраивается только при изменении тарифов (create_tariff, set_tariff_price, delete_tariff),
+    поэтому меню покупки и продления отвечают без обращения к БД.
+    """
+
+    def __init__(self):
+        self._by_id: Dict[int, Row] = {}
+        self._all: List[Row] = []
+        self._categories: List[str] = []
+        self._by_category: Dict[str, List[Row]] = {}
+        self._category_rows: List[List[InlineKeyboardButton]] = []
+        self._duration_keyboards: Dict[str, InlineKeyboardMarkup] = {}
+        self._renew_buttons: Dict[str, List[tuple]] = {}
+        self.loaded = False
+
+    async def reload(self) -> None:
+        async with async_session_maker() as session:
+            result = await session.execute(Tariff.__table__.select().order_by(Tariff.id))
+            rows = result.fetchall()
+
+        by_category: Dict[str, List[Row]] = {}
+        for row in rows:
+            if row.active:
+                by_category.setdefault(row.category, []).append(row)
+        for tariffs in by_category.values():
+            tariffs.sort(key=lambda t: t.duration_days)
+
+        self._by_id = {row.id: row for row in rows}
+        self._all = rows
+        self._categories = list(by_category)
+        self._by_category = by_category
+        self._category_rows = self._build_category_rows(self._categories)
+        self._duration_keyboards = {
+            category: self._build_duration_keyboard(category, tariffs)
+            for category, tariffs in by_category.items()
+        }
+        self._renew_buttons = {
+            category: [
+                (f"{format_tariff_name(t.duration_days)} — {t.price_rub} ₽", f"{t.id}_{t.price_rub}")
+                for t in tariffs
+            ]
+            for category, tariffs in by_category.items()
+        }
+        self.loaded = True
+        logger.info(f"💳 Каталог тарифов загружен: {len(rows)} (категорий: {len(self._categories)})")
+
+    @staticmethod
+    def _build_category_rows(categories: List[str]) -> List[List[InlineKeyboardButton]]:
+        buttons = []
+        row = []
+        for cat in categories:
+            emoji = "📱" if cat == "mobile" else "🛡️" if cat == "stable" else "💎"
+            row.append(InlineKeyboardButton(text=f"{emoji} {cat.capitalize()}", callback_data=f"select_category_{cat}"))
+            if len(row) == 2:
+                buttons.append(row)
+                row = []
+        if row:
+            buttons.append(row)
+        return buttons
+
+    @staticmethod
+    def _build_duration_keyboard(category: str, tariffs: List[Row]) -> InlineKeyboardMarkup:
+        buttons = [
+            [InlineKeyboardButton(
+                text=f"{format_tariff_name(t.duration_days)} — {t.price_rub} ₽",
+                callback_data=f"select_duration_{category}_{t.id}"
+            )]
+            for t in tariffs
+        ]
+        buttons.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="buy_menu")])
+        return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+    def get(self, tariff_id: int) -> Optional[Row]:
+        return self._by_id.get(tariff_id)
+
+    def all(self) -> List[Row]:
+        return list(self._all)
+
+    def categories(self) -> List[str]:
+        return list(self._categories)
+
+    def by_category(self, category: str) -> List[Row]:
+        return list(self._by_category.get(category, []))
+
+    def category_rows(self) -> List[List[InlineKeyboardButton]]:
+        """Ряды кнопок категорий для меню покупки (без персональных кнопок пользователя)."""
+        return [list(row) for row in self._category_rows]
+
+    def duration_keyboard(self, category: str) -> InlineKeyboardMarkup:
+        """Готовая клавиатура выбора срока для категории."""
+        keyboard = self._duration_keyboards.get(category)
+        if keyboard is None:
+            keyboard = self._build_duration_keyboard(category, [])
+        return keyboard
+
+    def renew_keyboard(self, category: str, config_id: str) -> InlineKeyboardMarkup:
+        """Клавиатура продления: подписи кнопок готовы заранее, подставляется только id конфига."""
+        buttons = [
+            InlineKeyboardButton(text=text, callback_data=f"renew_confirm_{config_id}_{suffix}")
+            for text, suffix in self._renew_buttons.get(category, [])
+        ]
+        keyboard = [buttons[i:i+2] for i in range(0, len(buttons), 2)]
+        keyboard.append([InlineKeyboardButton(text="⬅️ Назад", callback_data=f"manage_config_{config_id}")])
+        return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+
+tariff_catalog = TariffCatalog()
+
 
 async def get_tariff_categories():
-    """Возвращает список уникальных категорий тарифов."""
-    async with async_session_maker() as session:
-        result = await session.execute(
-            select(distinct(Tariff.category)).where(Tariff.active == True)
-        )
-        return [row[0] for row in result.fetchall()]
+    """Возвращает список уникальных категорий активных тарифов."""
+    return tariff_catalog.categories()
 
 async def get_all_tariffs():
-    async with async_session_maker() as session:
-        result = await session.execute(Tariff.__table__.select())
-        return result.fetchall()
+    return tariff_catalog.all()
 
 async def create_tariff(category: str, duration_days: int, price_rub: int, traffic_gb: int):
     async with async_session_maker() as session:
@@ -25,16 +139,29 @@ async def create_tariff(category: str, duration_days: int, price_rub: int, traff
             active=True
         ))
         await session.commit()
+    await tariff_catalog.reload()
 
-async def get_tariffs_by_category(category: str):
-    """Возвращает тарифы по категории."""
+async def set_tariff_price(tariff_id: int, price_rub: int) -> bool:
+    """Меняет цену тарифа. Возвращает False, если тариф не найден."""
     async with async_session_maker() as session:
         result = await session.execute(
-            select(Tariff)
-            .where(Tariff.category == category, Tariff.active == True)
-            .order_by(Tariff.duration_days)
+            Tariff.__table__.update().where(Tariff.id == tariff_id).values(price_rub=price_rub)
         )
-        return result.scalars().all()
+        await session.commit()
+    await tariff_catalog.reload()
+    return result.rowcount > 0
+
+async def delete_tariff(tariff_id: int) -> bool:
+    """Удаляет тариф. Возвращает False, если тариф не найден."""
+    async with async_session_maker() as session:
+        result = await session.execute(Tariff.__table__.delete().where(Tariff.id == tariff_id))
+        await session.commit()
+    await tariff_catalog.reload()
+    return result.rowcount > 0
+
+async def get_tariffs_by_category(category: str):
+    """Возвращает активные тарифы категории, по возрастанию срока."""
+    return tariff_catalog.by_category(category)
 
 async def initialize_default_tariffs():
     async with async_session_maker() as session:
@@ -52,3 +179,4 @@ async def initialize_default_tariffs():
             for t in default_tariffs:
                 await session.execute(Tariff.__table__.insert().values(**t))
             await session.commit()
+            await tariff_catalog.reload()
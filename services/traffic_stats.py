@@ -0,0 +1,115 @@
+# services/traffic_stats.py
+"""История трафика: сырые приросты (traffic_samples) и инкрементальные суммы по дням/месяцам."""
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Tuple
+
+from sqlalchemy import select, func
+
+from storage.database import async_session_maker, TrafficSample, TrafficRollup, upsert_insert
+
+DAY_SECONDS = 86400
+
+
+def day_bucket(ts: int) -> int:
+    """Начало суток (UTC) для unix time."""
+    return ts - ts % DAY_SECONDS
+
+
+def month_bucket(ts: int) -> int:
+    """Начало месяца (UTC) для unix time."""
+    dt = datetime.fromtimestamp(ts, timezone.utc)
+    return int(datetime(dt.year, dt.month, 1, tzinfo=timezone.utc).timestamp())
+
+
+def counter_delta(previous: int, current: int) -> int:
+    """Прирост счётчика панели. Если счётчик уменьшился — его сбросили, прирост = текущее значение."""
+    return current - previous if current >= previous else current
+
+
+async def record_traffic_samples(session, deltas: List[Dict[str, int]], ts: int) -> None:
+    """
+    Пакетно записывает приросты трафика и обновляет суммы по дням и месяцам.
+    Коммит выполняет вызывающий код (вместе с обновлением счётчиков конфигов).
+
+    Args:
+        deltas: список {"config_id", "up", "down"} — приросты за интервал
+        ts: время снятия показаний (unix time)
+    """
+    rows = [d for d in deltas if d["up"] or d["down"]]
+    if not rows:
+        return
+
+    await session.execute(
+        TrafficSample.__table__.insert(),
+        [{"config_id": d["config_id"], "ts": ts, "up": d["up"], "down": d["down"]} for d in rows]
+    )
+
+    rollups = TrafficRollup.__table__
+    for period, bucket in (("day", day_bucket(ts)), ("month", month_bucket(ts))):
+        stmt = upsert_insert(rollups)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[rollups.c.config_id, rollups.c.period, rollups.c.bucket],
+            set_={
+                "up": rollups.c.up + stmt.excluded.up,
+                "down": rollups.c.down + stmt.excluded.down
+            }
+        )
+        await session.execute(stmt, [
+            {"config_id": d["config_id"], "period": period, "bucket": bucket, "up": d["up"], "down": d["down"]}
+            for d in rows
+        ])
+
+
+async def get_daily_usage(config_id: str, days: int = 7) -> List[Tuple[int, int]]:
+    """Возвращает [(начало дня, байт up+down)] за последние N дней, включая дни без трафика."""
+    today = day_bucket(int(time.time()))
+    since = today - (days - 1) * DAY_SECONDS
+
+    async with async_session_maker() as session:
+        result = await session.execute(
+            select(TrafficRollup.bucket, TrafficRollup.up + TrafficRollup.down)
+            .where(
+                TrafficRollup.config_id == config_id,
+                TrafficRollup.period == "day",
+                TrafficRollup.bucket >= since
+            )
+        )
+        by_day = {row[0]: row[1] for row in result.fetchall()}
+
+    return [(bucket, by_day.get(bucket, 0)) for bucket in range(since, today + 1, DAY_SECONDS)]
+
+
+async def get_total_usage(period: str, bucket: int) -> int:
+    """Суммарный трафик всех конфигов за день/месяц (байт)."""
+    async with async_session_maker() as session:
+        result = await session.execute(
+            select(func.coalesce(func.sum(TrafficRollup.up + TrafficRollup.down), 0))
+            .where(TrafficRollup.period == period, TrafficRollup.bucket == bucket)
+        )
+        return int(result.scalar() or 0)
+
+
+async def prune_traffic_history(raw_retention_days: int, daily_retention_days: int) -> Tuple[int, int]:
+    """
+    Прореживает историю: сырые приросты старше raw_retention_days уже учтены в дневных суммах
+    и удаляются; дневные суммы старше daily_retention_days удаляются (месячные хранятся всегда).
+
+    Returns:
+        (удалено сырых записей, удалено дневных сумм)
+    """
+    now = int(time.time())
+    async with async_session_maker() as session:
+        samples = await session.execute(
+            TrafficSample.__table__.delete()
+            .where(TrafficSample.ts < now - raw_retention_days * DAY_SECONDS)
+        )
+        daily = await session.execute(
+            TrafficRollup.__table__.delete()
+            .where(
+                TrafficRollup.period == "day",
+                TrafficRollup.bucket < day_bucket(now) - daily_retention_days * DAY_SECONDS
+            )
+        )
+        await session.commit()
+        return samples.rowcount, daily.rowcount
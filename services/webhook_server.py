@@ -0,0 +1,106 @@
+# services/webhook_server.py
+"""
+Режим webhook: обновления принимает aiohttp-сервер aiogram вместо long polling.
+
+Проверка локально без Telegram (WebhookConfig.BASE_URL = None — webhook не регистрируется):
+    curl -X POST http://127.0.0.1:8080/webhook \\
+         -H "Content-Type: application/json" \\
+         -H "X-Telegram-Bot-Api-Secret-Token: <SECRET_TOKEN>" \\
+         -d @update.json
+"""
+import asyncio
+import logging
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+from config import WebhookConfig
+
+logger = logging.getLogger(__name__)
+
+
+class LimitedRequestHandler(SimpleRequestHandler):
+    """
+    Обработчик webhook с ограничением числа обновлений в работе.
+
+    Слот семафора занимается до создания фоновой задачи и освобождается по её завершении,
+    поэтому задач одновременно не больше limit. Когда слотов нет, ответ Telegram задерживается:
+    он не шлёт в одно соединение следующее обновление, пока не получил ответ на предыдущее,
+    и поток входящих обновлений замедляется вместо бесконечного роста очереди задач.
+    """
+
+    def __init__(self, *args, limit: int, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._semaphore = asyncio.Semaphore(limit)
+
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        update = await request.json(loads=bot.session.json_loads)
+        await self._semaphore.acquire()
+        try:
+            task = asyncio.create_task(self._background_feed_update(bot=bot, update=update))
+        except BaseException:
+            self._semaphore.release()
+            raise
+        self._background_feed_update_tasks.add(task)
+        task.add_done_callback(self._background_feed_update_tasks.discard)
+        task.add_done_callback(lambda _: self._semaphore.release())
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+
+def build_webhook_app(dp: Dispatcher, bot: Bot) -> web.Application:
+    """aiohttp-приложение с обработчиком обновлений на WebhookConfig.PATH."""
+    app = web.Application()
+    LimitedRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        # Telegram получает ответ сразу после постановки в работу, не дожидаясь обработки
+        handle_in_background=True,
+        secret_token=WebhookConfig.SECRET_TOKEN,
+        limit=WebhookConfig.MAX_CONCURRENT_UPDATES,
+    ).register(app, path=WebhookConfig.PATH)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot, stop_event: asyncio.Event) -> None:
+    """
+    Запускает webhook-сервер и работает до установки stop_event (SIGINT/SIGTERM на POSIX)
+    или отмены задачи: на Windows обработчиков сигналов нет, и Ctrl+C отменяет main().
+    В обоих случаях webhook снимается, сервер и сессия бота закрываются.
+    """
+    app = build_webhook_app(dp, bot)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WebhookConfig.LISTEN_HOST, WebhookConfig.LISTEN_PORT)
+    await site.start()
+    logger.info(
+        f"🌐 Webhook-сервер слушает {WebhookConfig.LISTEN_HOST}:{WebhookConfig.LISTEN_PORT}{WebhookConfig.PATH}"
+    )
+
+    if WebhookConfig.BASE_URL:
+        url = WebhookConfig.BASE_URL.rstrip("/") + WebhookConfig.PATH
+        await bot.set_webhook(
+            url,
+            secret_token=WebhookConfig.SECRET_TOKEN,
+            allowed_updates=dp.resolve_used_update_types(),
+            max_connections=WebhookConfig.MAX_CONNECTIONS,
+            drop_pending_updates=WebhookConfig.DROP_PENDING_UPDATES,
+        )
+        logger.info(f"✅ Webhook зарегистрирован: {url}")
+    else:
+        logger.warning("⚠️ WebhookConfig.BASE_URL не задан — webhook в Telegram не регистрируется")
+
+    try:
+        await stop_event.wait()
+    except (asyncio.CancelledError, KeyboardInterrupt):
+        logger.info("Получено прерывание, остановка webhook-сервера...")
+    finally:
+        if WebhookConfig.BASE_URL and WebhookConfig.DELETE_ON_SHUTDOWN:
+            try:
+                await bot.delete_webhook()
+            except Exception as e:
+                logger.warning(f"Не удалось снять webhook: {e}")
+        await runner.cleanup()
+        # В режиме polling сессию закрывает start_polling, здесь — мы
+        await bot.session.close()
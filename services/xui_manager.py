@@ -2,14 +2,24 @@
 import os
 import ssl
 import json
+import asyncio
+import logging
+import time
 from datetime import datetime, timedelta, timezone
 from uuid import uuid4
-from typing import Dict, Any, Optional
+from typing import Callable, Dict, Any, List, Optional
 
-from aiohttp import ClientSession, TCPConnector, CookieJar, FormData
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, CookieJar
 
-from config import SSL_CERTS_DIR
+from config import SSL_CERTS_DIR, TrafficSyncConfig, CacheConfig
+from utils.cache import TTLCache
 from utils.helpers import gb_to_bytes
+from utils.link_builder import parse_inbound_params
+
+logger = logging.getLogger(__name__)
+
+# Статусы, означающие, что cookie сессии панели протухла и нужен повторный вход
+_RELOGIN_STATUSES = {301, 302, 303, 307, 308, 401}
 
 
 class XUIManager:
@@ -22,41 +32,103 @@ class XUIManager:
         self.server_id = server_id
         self.session: Optional[ClientSession] = None
         self._logged_in = False
+        self._login_lock = asyncio.Lock()
+        # Номер успешного входа: запрос запоминает его, чтобы после 401 не перелогиниваться повторно
+        self._login_generation = 0
+        # Ограничение одновременных запросов к одной панели
+        self._request_semaphore = asyncio.Semaphore(TrafficSyncConfig.MAX_REQUESTS_PER_SERVER)
+        # Разобранные параметры inbound'ов для ссылок (без списка клиентов), по id inbound
+        self._inbound_params = TTLCache(CacheConfig.INBOUND_PARAMS_TTL, CacheConfig.INBOUND_PARAMS_MAX_ENTRIES)
+        # Зеркало клиентов панели: id inbound -> email -> объект клиента из settings.
+        # Обновляется при каждом чтении inbound'ов (в том числе синхронизацией трафика),
+        # чтобы изменение одного клиента не требовало загрузки и разбора всего inbound
+        self._clients: Dict[str, Dict[str, dict]] = {}
+        # Когда зеркало inbound'а обновлялось из панели (time.monotonic())
+        self._clients_synced_at: Dict[str, float] = {}
+
+    def matches(self, server) -> bool:
+        """Проверяет, что менеджер создан с актуальными данными сервера."""
+        return (
+            self.base_url == (server.xui_url or "").rstrip("/")
+            and self.username == server.xui_username
+            and self.password == server.xui_password
+        )
 
     async def ensure_login(self) -> None:
         """Гарантирует, что сессия создана и пользователь залогинен."""
-        if self.session is None:
-            await self._create_session()
-        if not self._logged_in:
-            await self.login()
+        if self._logged_in and self.session is not None:
+            return
+        async with self._login_lock:
+            if self.session is None:
+                await self._create_session()
+            if not self._logged_in:
+                await self.login()
 
     async def _create_session(self) -> None:
-        """Создаёт aiohttp сессию с SSL-сертификатом."""
+        """Создаёт долгоживущую aiohttp сессию с SSL-сертификатом и keep-alive."""
         cert_path = os.path.join(SSL_CERTS_DIR, f"{self.server_id}.crt")
         if not os.path.exists(cert_path):
             raise FileNotFoundError(f"SSL-сертификат не найден: {cert_path}")
         
         ssl_context = ssl.create_default_context(cafile=cert_path)
-        connector = TCPConnector(ssl=ssl_context)
+        connector = TCPConnector(
+            ssl=ssl_context,
+            limit_per_host=TrafficSyncConfig.MAX_REQUESTS_PER_SERVER,
+            keepalive_timeout=60
+        )
         cookie_jar = CookieJar(unsafe=True)
-        self.session = ClientSession(connector=connector, cookie_jar=cookie_jar)
+        self.session = ClientSession(
+            connector=connector,
+            cookie_jar=cookie_jar,
+            timeout=ClientTimeout(total=30)
+        )
 
     async def login(self) -> None:
         """Выполняет вход в 3x-ui панель."""
         if self.session is None:
             raise RuntimeError("Сессия не инициализирована")
 
-        form = FormData()
-        form.add_field("username", self.username)
-        form.add_field("password", self.password)
+        form = {"username": self.username, "password": self.password}
         
         async with self.session.post(f"{self.base_url}/login", data=form) as resp:
             text = await resp.text()
             if resp.status == 200 and '"success":true' in text:
                 self._logged_in = True
+                self._login_generation += 1
             else:
                 raise Exception(f"Ошибка входа в 3x-ui ({resp.status}): {text[:200]}...")
 
+    async def _relogin(self, seen_generation: int) -> None:
+        """
+        Повторный вход после истечения cookie (с той же сессией и соединениями).
+        seen_generation — номер входа, с cookie которого запрос получил отказ: если за это время
+        другая корутина уже перелогинилась, вход не повторяется и свежие cookie не стираются.
+        """
+        async with self._login_lock:
+            if self._login_generation != seen_generation:
+                return
+            self._logged_in = False
+            self.session.cookie_jar.clear()
+            await self.login()
+
+    async def _request(self, method: str, path: str, operation: str, data: Optional[dict] = None) -> Dict[str, Any]:
+        """
+        Выполняет запрос к API панели через общую сессию.
+        При 401 или редиректе на страницу входа прозрачно перелогинивается и повторяет запрос.
+        """
+        await self.ensure_login()
+        url = f"{self.base_url}{path}"
+
+        async with self._request_semaphore:
+            for attempt in range(2):
+                generation = self._login_generation
+                async with self.session.request(method, url, data=data, allow_redirects=False) as resp:
+                    if resp.status in _RELOGIN_STATUSES and attempt == 0:
+                        logger.info(f"3x-ui {self.server_id}: сессия истекла ({resp.status}), повторный вход")
+                    else:
+                        return await self._handle_json_response(resp, operation)
+                await self._relogin(generation)
+
     async def add_client(
         self,
         inbound_id: int,
@@ -68,7 +140,6 @@ class XUIManager:
         traffic_gb: int = 100
     ) -> str:
         """Добавляет нового клиента в 3x-ui."""
-        await self.ensure_login()
         
         expiry_timestamp = int(
             (datetime.now(timezone.utc) + timedelta(days=expiry_days)).timestamp() * 1000
@@ -89,119 +160,199 @@ class XUIManager:
         }
         
         settings_str = json.dumps({"clients": [client]})
-        form = FormData()
-        form.add_field("id", str(inbound_id))
-        form.add_field("settings", settings_str)
+        form = {"id": str(inbound_id), "settings": settings_str}
         
-        async with self.session.post(
-            f"{self.base_url}/panel/api/inbounds/addClient",
-            data=form
-        ) as resp:
-            # Проверяем успешность операции, но НЕ возвращаем ответ
-            await self._handle_json_response(resp, "addClient")
-            # Возвращаем именно UUID, который мы сгенерировали
-            return client_uuid
+        # Проверяем успешность операции, но НЕ возвращаем ответ
+        await self._request("POST", "/panel/api/inbounds/addClient", "addClient", data=form)
+        self._clients.setdefault(str(inbound_id), {})[email] = client
+        # Возвращаем именно UUID, который мы сгенерировали
+        return client_uuid
 
     async def extend_client_expiry(self, inbound_id: int, email: str, extra_days: int) -> bool:
         """Продлевает срок действия клиента."""
-        await self.ensure_login()
-        
-        inbound = await self.get_inbound(inbound_id)
-        settings = json.loads(inbound["settings"])
-        client = next((c for c in settings["clients"] if c["email"] == email), None)
-        if not client:
-            raise Exception("Клиент не найден в inbound")
-        
-        current_expiry = client.get("expiryTime", 0)
-        if current_expiry == 0:
-            new_expiry = int((datetime.now(timezone.utc) + timedelta(days=extra_days)).timestamp() * 1000)
-        else:
-            new_expiry = current_expiry + extra_days * 86400000
-        client["expiryTime"] = new_expiry
-        
-        return await self._update_client(inbound_id, client)
+        def _extend(client: dict) -> None:
+            current_expiry = client.get("expiryTime", 0)
+            if current_expiry == 0:
+                new_expiry = int((datetime.now(timezone.utc) + timedelta(days=extra_days)).timestamp() * 1000)
+            else:
+                new_expiry = current_expiry + extra_days * 86400000
+            client["expiryTime"] = new_expiry
+
+        return await self._modify_client(inbound_id, email, _extend)
 
     async def backup(self) -> bytes:
         """Получает полную конфигурацию сервера в формате JSON (бэкап)."""
-        await self.ensure_login()
-        async with self.session.get(f"{self.base_url}/panel/api/server/getConfigJson") as resp:
-            if resp.status == 200:
-                data = await resp.json()
-                if data.get("success"):
-                    # Возвращаем только obj (чистый конфиг без обёртки)
-                    config_json = json.dumps(data["obj"], indent=2, ensure_ascii=False)
-                    return config_json.encode("utf-8")
-                else:
-                    raise Exception(f"Ошибка в ответе: {data.get('msg', 'Неизвестно')}")
-            else:
-                text = await resp.text()
-                raise Exception(f"HTTP {resp.status}: {text[:200]}")
+        data = await self._request("GET", "/panel/api/server/getConfigJson", "getConfigJson")
+        # Возвращаем только obj (чистый конфиг без обёртки)
+        config_json = json.dumps(data["obj"], indent=2, ensure_ascii=False)
+        return config_json.encode("utf-8")
 
     async def get_client_traffic(self, email: str) -> int:
         """Получает использованный трафик клиента (в байтах)."""
-        await self.ensure_login()
-        
-        async with self.session.get(
-            f"{self.base_url}/panel/api/inbounds/getClientTraffics/{email}"
-        ) as resp:
-            data = await self._handle_json_response(resp, "getClientTraffics")
-            return data.get("obj", {}).get("down", 0)
+        return (await self.get_client_state(email) or {}).get("down", 0)
+
+    async def get_client_state(self, email: str) -> Optional[Dict[str, Any]]:
+        """Строка clientTraffics клиента: up, down, total, expiryTime, enable (без settings inbound'а)."""
+        data = await self._request(
+            "GET", f"/panel/api/inbounds/getClientTraffics/{email}", "getClientTraffics"
+        )
+        return data.get("obj")
+
+    async def get_inbounds(self) -> List[Dict[str, Any]]:
+        """Получает список всех inbound'ов панели вместе с clientStats."""
+        data = await self._request("GET", "/panel/api/inbounds/list", "listInbounds")
+        inbounds = data.get("obj") or []
+        for inbound in inbounds:
+            self._remember_inbound(inbound)
+        return inbounds
+
+    async def get_inbound_client_traffics(self, inbound_id: int) -> Dict[str, Dict[str, int]]:
+        """
+        Получает счётчики трафика всех клиентов inbound одним запросом.
+
+        Returns:
+            Словарь email -> {"up": байты, "down": байты}
+        """
+        inbounds = await self.get_inbounds()
+        inbound = next((i for i in inbounds if str(i.get("id")) == str(inbound_id)), None)
+        if inbound is None:
+            raise Exception(f"Inbound {inbound_id} не найден на сервере {self.server_id}")
+
+        traffics = {}
+        for stat in inbound.get("clientStats") or []:
+            email = stat.get("email")
+            if email:
+                traffics[email] = {
+                    "up": int(stat.get("up") or 0),
+                    "down": int(stat.get("down") or 0)
+                }
+        return traffics
 
     async def delete_client_by_email(self, inbound_id: int, email: str) -> bool:
         """Удаляет клиента по email."""
-        await self.ensure_login()
-        
-        async with self.session.post(
-            f"{self.base_url}/panel/api/inbounds/{inbound_id}/delClientByEmail/{email}"
-        ) as resp:
-            data = await self._handle_json_response(resp, "delClientByEmail")
-            return data.get("success", False)
+        data = await self._request(
+            "POST", f"/panel/api/inbounds/{inbound_id}/delClientByEmail/{email}", "delClientByEmail"
+        )
+        self._clients.get(str(inbound_id), {}).pop(email, None)
+        return data.get("success", False)
 
     async def reset_client_traffic(self, inbound_id: int, email: str) -> bool:
         """Сбрасывает использованный трафик клиента."""
-        await self.ensure_login()
-        
-        async with self.session.post(
-            f"{self.base_url}/panel/api/inbounds/{inbound_id}/resetClientTraffic/{email}"
-        ) as resp:
-            await self._handle_json_response(resp, "resetClientTraffic")
-            return True
+        await self._request(
+            "POST", f"/panel/api/inbounds/{inbound_id}/resetClientTraffic/{email}", "resetClientTraffic"
+        )
+        return True
 
     async def update_client_traffic_limit(self, inbound_id: int, email: str, new_total_gb: int) -> bool:
         """Обновляет лимит трафика клиента."""
-        await self.ensure_login()
-        
-        inbound = await self.get_inbound(inbound_id)
-        settings = json.loads(inbound["settings"])
-        client = next((c for c in settings["clients"] if c["email"] == email), None)
-        if not client:
-            raise Exception("Клиент не найден в inbound")
-        
-        client["totalGB"] = gb_to_bytes(new_total_gb)
-        return await self._update_client(inbound_id, client)
+        def _set_limit(client: dict) -> None:
+            client["totalGB"] = gb_to_bytes(new_total_gb)
+
+        return await self._modify_client(inbound_id, email, _set_limit)
+
+    def _mirror_is_stale(self, inbound_id: int) -> bool:
+        """Зеркало не обновлялось дольше периода синхронизации трафика (последняя синхронизация его не коснулась)."""
+        synced_at = self._clients_synced_at.get(str(inbound_id))
+        return synced_at is None or time.monotonic() - synced_at > TrafficSyncConfig.INTERVAL
+
+    async def get_client(self, inbound_id: int, email: str, refresh: bool = False) -> Optional[dict]:
+        """Клиент из зеркала; inbound перечитывается при промахе, устаревшем зеркале или refresh=True."""
+        clients = self._clients.get(str(inbound_id))
+        if refresh or clients is None or email not in clients or self._mirror_is_stale(inbound_id):
+            await self.get_inbound(inbound_id)
+            clients = self._clients.get(str(inbound_id), {})
+        return clients.get(email)
+
+    async def _modify_client(self, inbound_id: int, email: str, change: Callable[[dict], None]) -> bool:
+        """
+        Изменяет одного клиента: payload updateClient собирается из зеркала.
+
+        Перед записью зеркало сверяется с панелью по expiryTime, total и enable
+        (лёгкий getClientTraffics); при расхождении или ошибке записи inbound
+        перечитывается и попытка повторяется. Остальные поля payload — limitIp, flow,
+        tgId, subId, comment — getClientTraffics не возвращает, они берутся из зеркала
+        как есть; поэтому зеркало старше периода синхронизации трафика перед записью
+        перечитывается (get_client).
+        """
+        for attempt in range(2):
+            client = await self.get_client(inbound_id, email, refresh=attempt > 0)
+            if not client:
+                raise Exception("Клиент не найден в inbound")
+
+            if attempt == 0:
+                state = await self.get_client_state(email)
+                if state is None or (
+                    (state.get("expiryTime") or 0) != (client.get("expiryTime") or 0)
+                    or (state.get("total") or 0) != (client.get("totalGB") or 0)
+                    or bool(state.get("enable", True)) != bool(client.get("enable", True))
+                ):
+                    logger.info(f"3x-ui {self.server_id}: данные клиента {email} изменились в панели, перечитываем inbound")
+                    continue
+
+            updated = dict(client)
+            change(updated)
+            try:
+                success = await self._update_client(inbound_id, updated)
+            except Exception as e:
+                if attempt == 0:
+                    logger.warning(f"3x-ui {self.server_id}: updateClient {email} не удался ({e}), перечитываем inbound")
+                    continue
+                raise
+            if success:
+                self._clients.setdefault(str(inbound_id), {})[email] = updated
+            return success
 
     async def get_inbound(self, inbound_id: int) -> Dict[str, Any]:
         """Получает данные inbound."""
-        await self.ensure_login()
-        
-        async with self.session.get(
-            f"{self.base_url}/panel/api/inbounds/get/{inbound_id}"
-        ) as resp:
-            data = await self._handle_json_response(resp, "getInbound")
-            return data["obj"]
+        data = await self._request("GET", f"/panel/api/inbounds/get/{inbound_id}", "getInbound")
+        self._remember_inbound(data["obj"])
+        return data["obj"]
+
+    async def get_inbound_params(self, inbound_id: int) -> Dict[str, Any]:
+        """
+        Параметры inbound для построения ссылок (порт, REALITY, транспорт).
+        Берутся из кэша; полный inbound со списком клиентов скачивается только
+        при промахе, после истечения INBOUND_PARAMS_TTL или invalidate_inbound_params.
+        """
+        params = self._inbound_params.get(str(inbound_id))
+        if params is None:
+            await self.get_inbound(inbound_id)
+            params = self._inbound_params.get(str(inbound_id))
+        return params
+
+    def invalidate_inbound_params(self, inbound_id: Optional[int] = None) -> None:
+        """Сбрасывает кэш параметров одного inbound или всех inbound'ов панели."""
+        if inbound_id is None:
+            self._inbound_params.clear()
+        else:
+            self._inbound_params.invalidate(str(inbound_id))
+
+    def _remember_inbound(self, inbound: Dict[str, Any]) -> None:
+        """Обновляет кэш параметров и зеркало клиентов по уже полученному inbound (без лишних запросов)."""
+        if inbound.get("id") is None:
+            return
+        inbound_key = str(inbound["id"])
+        try:
+            self._inbound_params.set(inbound_key, parse_inbound_params(inbound))
+            settings = inbound.get("settings")
+            if settings is not None:
+                if isinstance(settings, str):
+                    settings = json.loads(settings or "{}")
+                self._clients[inbound_key] = {
+                    c["email"]: c for c in settings.get("clients") or [] if c.get("email")
+                }
+                self._clients_synced_at[inbound_key] = time.monotonic()
+        except (TypeError, ValueError, AttributeError) as e:
+            logger.warning(f"3x-ui {self.server_id}: не удалось разобрать inbound {inbound.get('id')}: {e}")
 
     async def _update_client(self, inbound_id: int, client: dict) -> bool:
         """Обновляет данные клиента."""
-        form = FormData()
-        form.add_field("id", str(inbound_id))
-        form.add_field("settings", json.dumps({"clients": [client]}))
+        form = {"id": str(inbound_id), "settings": json.dumps({"clients": [client]})}
         
-        async with self.session.post(
-            f"{self.base_url}/panel/api/inbounds/updateClient/{client['id']}",
-            data=form
-        ) as resp:
-            data = await self._handle_json_response(resp, "updateClient")
-            return data.get("success", False)
+        data = await self._request(
+            "POST", f"/panel/api/inbounds/updateClient/{client['id']}", "updateClient", data=form
+        )
+        return data.get("success", False)
 
     async def _handle_json_response(self, resp, operation: str):
         """Унифицированная обработка JSON-ответов от 3x-ui."""
@@ -234,3 +385,49 @@ class XUIManager:
             await self.session.close()
             self.session = None
             self._logged_in = False
+
+
+# ---------- Общий пул менеджеров (один XUIManager на Server.id) ----------
+_managers: Dict[str, XUIManager] = {}
+
+
+async def get_xui_manager(server) -> XUIManager:
+    """
+    Возвращает общий долгоживущий XUIManager для сервера.
+    Сессия, TLS-соединения и cookie входа переиспользуются между вызовами,
+    поэтому вызывающему коду НЕ нужно закрывать менеджер.
+    """
+    manager = _managers.get(server.id)
+    if manager is not None and manager.matches(server):
+        return manager
+
+    if manager is not None:
+        # Данные сервера изменились — пересоздаём менеджер
+        await manager.close()
+
+    manager = XUIManager(
+        base_url=server.xui_url,
+        username=server.xui_username,
+        password=server.xui_password,
+        server_id=server.id
+    )
+    _managers[server.id] = manager
+    return manager
+
+
+async def invalidate_xui_manager(server_id: str) -> None:
+    """Закрывает и удаляет менеджер сервера из пула (например, после удаления сервера)."""
+    manager = _managers.pop(server_id, None)
+    if manager is not None:
+        await manager.close()
+
+
+async def close_all_xui_managers() -> None:
+    """Закрывает все сессии пула. Вызывается при остановке бота."""
+    managers = list(_managers.values())
+    _managers.clear()
+    for manager in managers:
+        try:
+            await manager.close()
+        except Exception as e:
+            logger.warning(f"Ошибка при закрытии сессии 3x-ui {manager.server_id}: {e}")
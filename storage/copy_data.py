@@ -0,0 +1,77 @@
+# storage/copy_data.py
+"""
+Перенос данных из SQLite-файла бота в БД из DatabaseConfig.URL (например, PostgreSQL).
+
+    python -m storage.copy_data [путь к bot.db]
+
+Исходная БД сначала обновляется до актуальной схемы миграциями, в целевой БД схема
+создаётся ими же. Таблицы копируются в порядке внешних ключей пачками по BATCH_SIZE строк
+в одной транзакции: при ошибке целевая БД остаётся пустой. Целевые таблицы должны быть пусты.
+"""
+import asyncio
+import logging
+import os
+import sys
+
+from sqlalchemy import Integer, func, select, text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from storage.database import Base, DB_PATH, DATABASE_URL, engine as target_engine
+from storage.migrations import upgrade
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000
+
+
+async def _reset_sequences(conn) -> None:
+    """Сдвигает последовательности SERIAL-ключей PostgreSQL за максимальный перенесённый id."""
+    for table in Base.metadata.sorted_tables:
+        pk = list(table.primary_key.columns)
+        if len(pk) != 1 or not isinstance(pk[0].type, Integer):
+            continue
+        column = pk[0].name
+        await conn.execute(text(
+            f"SELECT setval(pg_get_serial_sequence('{table.name}', '{column}'), "
+            f"COALESCE((SELECT MAX({column}) FROM {table.name}), 0) + 1, false)"
+        ))
+
+
+async def copy_data(source_path: str) -> None:
+    source_url = f"sqlite+aiosqlite:///{os.path.abspath(source_path)}"
+    if source_url == DATABASE_URL:
+        raise SystemExit("Целевая БД совпадает с исходной: задайте DatabaseConfig.URL в config.py")
+    if not os.path.exists(source_path):
+        raise SystemExit(f"Файл БД не найден: {source_path}")
+
+    source_engine = create_async_engine(source_url)
+    try:
+        async with source_engine.begin() as conn:
+            await conn.run_sync(upgrade)
+        async with target_engine.begin() as conn:
+            await conn.run_sync(upgrade)
+
+        async with source_engine.connect() as src, target_engine.begin() as dst:
+            for table in Base.metadata.sorted_tables:
+                existing = (await dst.execute(select(func.count()).select_from(table))).scalar()
+                if existing:
+                    raise SystemExit(f"Таблица {table.name} в целевой БД не пуста ({existing} строк)")
+
+                copied = 0
+                result = await src.stream(select(table))
+                async for rows in result.partitions(BATCH_SIZE):
+                    await dst.execute(table.insert(), [dict(row._mapping) for row in rows])
+                    copied += len(rows)
+                logger.info(f"📦 {table.name}: перенесено {copied} строк")
+
+            if dst.dialect.name == "postgresql":
+                await _reset_sequences(dst)
+    finally:
+        await source_engine.dispose()
+        await target_engine.dispose()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(copy_data(sys.argv[1] if len(sys.argv) > 1 else DB_PATH))
+    print("Перенос данных завершён")
@@ -0,0 +1,349 @@
+# storage/import_json.py
+"""
+Импорт старого JSON-хранилища (SERVERS_FILE, SUBS_FILE, PENDING_FILE) в БД.
+
+    python -m storage.import_json [--dry-run]
+
+Файлы читаются потоково — по одной записи верхнего уровня, без загрузки всего файла в память.
+Записи переводятся в строки servers / users / configs / pending_payments и вставляются
+пачками по BATCH_SIZE в одной транзакции: при ошибке БД остаётся без изменений.
+Уже существующие ключи пропускаются, поэтому импорт можно запускать повторно.
+С --dry-run всё выполняется так же, но транзакция откатывается — остаётся только отчёт.
+"""
+import asyncio
+import json
+import logging
+import os
+import sys
+from collections import Counter
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from sqlalchemy import select
+
+from config import SERVERS_FILE, SUBS_FILE, PENDING_FILE, PaymentConfig
+from storage.database import engine, User, Server, Config, PendingPayment, Tariff
+from storage.migrations import upgrade, parse_legacy_payload
+from utils.helpers import DAYS_TO_TARIFF_CODE, to_ts, now_ts, add_months_ts
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000
+_READ_SIZE = 64 * 1024
+_CODE_DAYS = {code: days for days, code in DAYS_TO_TARIFF_CODE.items()}
+_PAYMENT_COLUMNS = ["kind", "server_id", "config_id", "tariff_id", "category", "duration_days", "amount"]
+
+
+# ---------- Потоковое чтение ----------
+def iter_json_entries(path: str) -> Iterator[Tuple[Any, Any]]:
+    """
+    Перебирает записи верхнего уровня JSON-файла: (ключ, значение) для объекта,
+    (индекс, значение) для массива. В памяти держится только текущая запись.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, encoding="utf-8") as f:
+        buf = ""
+        pos = 0
+        eof = False
+
+        def fill() -> bool:
+            nonlocal buf, pos, eof
+            chunk = f.read(_READ_SIZE)
+            if not chunk:
+                eof = True
+                return False
+            buf = buf[pos:] + chunk
+            pos = 0
+            return True
+
+        def skip_ws() -> str:
+            nonlocal pos
+            while True:
+                while pos < len(buf) and buf[pos] in " \t\r\n":
+                    pos += 1
+                if pos < len(buf) or not fill():
+                    return buf[pos] if pos < len(buf) else ""
+
+        def decode() -> Any:
+            nonlocal pos
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buf, pos)
+                    # Число в конце буфера могло оборваться посередине
+                    if end < len(buf) or eof or isinstance(value, (dict, list, str)):
+                        pos = end
+                        return value
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                fill()
+
+        def expect(chars: str) -> str:
+            nonlocal pos
+            ch = skip_ws()
+            if ch not in chars:
+                raise ValueError(f"{path}: ожидалось одно из '{chars}', получено '{ch or 'EOF'}'")
+            pos += 1
+            return ch
+
+        opening = expect("{[")
+        closing = "}" if opening == "{" else "]"
+        if skip_ws() == closing:
+            return
+        index = 0
+        while True:
+            if opening == "{":
+                skip_ws()
+                key = decode()
+                expect(":")
+            else:
+                key = index
+            skip_ws()
+            yield key, decode()
+            index += 1
+            if expect("," + closing) == closing:
+                return
+
+
+# ---------- Преобразование записей ----------
+def _ts(value: Optional[str]) -> Optional[int]:
+    if not value:
+        return None
+    return to_ts(datetime.fromisoformat(value))
+
+
+def _server_row(server_id: str, data: dict) -> dict:
+    return {
+        "id": server_id,
+        "country": data.get("country"),
+        "city": data.get("city"),
+        "xui_url": data.get("xui_url"),
+        "xui_username": data.get("xui_username"),
+        "xui_password": data.get("xui_password"),
+        "inbound_id": str(data.get("inbound_id", "")),
+        "mobile_spoof": bool(data.get("mobile_spoof", False)),
+        "subscription_path": data.get("subscription_path") or "/sub",
+        "subscription_port": str(data.get("subscription_port") or "2096"),
+        "active": bool(data.get("active", True)),
+    }
+
+
+def _user_row(tg_id: str, data: dict) -> dict:
+    username = data.get("username") or None
+    notifications = data.get("notifications") or {}
+    return {
+        "tg_id": tg_id,
+        "username": username,
+        "first_name": username or "Anonymous",
+        "notify_expiry": bool(notifications.get("expiry", True)),
+        "notify_traffic": bool(notifications.get("traffic", True)),
+    }
+
+
+def _config_row(tg_id: str, data: dict) -> dict:
+    tariff = str(data.get("base_tariff") or "").strip()
+    is_trial = tariff.lower() == "trial"
+    if tariff in _CODE_DAYS:
+        base_tariff = _CODE_DAYS[tariff]
+    elif tariff.isdigit():
+        base_tariff = int(tariff)
+    else:
+        base_tariff = None
+
+    created_at = _ts(data.get("created_at"))
+    last_reset = _ts(data.get("last_traffic_reset"))
+    reset_from = last_reset or created_at
+    addons = data.get("addons") or {"extra_traffic_gb": 0, "traffic_reset_count": 0}
+    return {
+        "id": data["config_id"],
+        "user_tg_id": tg_id,
+        "server_id": data.get("server_id"),
+        "client_email": data.get("client_email"),
+        "base_tariff": base_tariff,
+        "is_trial": is_trial,
+        "traffic_limit_gb": int(data["traffic_limit_gb"]) if data.get("traffic_limit_gb") is not None else None,
+        "traffic_used_bytes": int(data.get("traffic_used_bytes") or 0),
+        "expiry": _ts(data.get("expiry")),
+        "created_at": created_at,
+        "last_traffic_reset": last_reset,
+        "next_traffic_reset_at": (
+            add_months_ts(reset_from) if base_tariff and base_tariff > 30 and not is_trial and reset_from else None
+        ),
+        "vless_link": data.get("vless_link"),
+        "subscription_link": data.get("subscription_link"),
+        "client_sub_id": data.get("client_sub_id"),
+        "active": bool(data.get("active", True)),
+        "addons": json.dumps(addons) if isinstance(addons, dict) else str(addons),
+    }
+
+
+def _payment_row(payment_id: str, data: dict, tariff_days: dict) -> dict:
+    parsed = parse_legacy_payload(data.get("payload"), tariff_days)
+    return {
+        "payment_id": payment_id,
+        "bot_invoice_id": str(data.get("bot_invoice_id", "")),
+        "payload": data.get("payload"),
+        "created_at": _ts(data.get("created_at")),
+        "user_id": str(data.get("user_id", "")),
+        "status": "pending",
+        # Для пачечной вставки у всех строк должен быть одинаковый набор колонок
+        **{name: parsed.get(name) for name in _PAYMENT_COLUMNS},
+    }
+
+
+# ---------- Вставка пачками ----------
+class _Importer:
+    def __init__(self, conn):
+        self.conn = conn
+        self.report: Dict[str, Counter] = {}
+        self.known_users: set = set()
+        self.known_servers: set = set()
+
+    def count(self, table: str, key: str, n: int = 1) -> None:
+        self.report.setdefault(table, Counter())[key] += n
+
+    async def insert_new(self, table, key_column: str, rows: List[dict], label: str = "добавлено") -> None:
+        """Вставляет строки, ключей которых ещё нет в таблице; существующие учитываются в отчёте."""
+        if not rows:
+            return
+        # Повторы ключа внутри файла: остаётся первая запись
+        unique = {}
+        for row in rows:
+            unique.setdefault(row[key_column], row)
+        if len(unique) < len(rows):
+            self.count(table.name, "повтор в файле", len(rows) - len(unique))
+        rows = list(unique.values())
+        column = table.c[key_column]
+        existing = set((await self.conn.execute(
+            select(column).where(column.in_([row[key_column] for row in rows]))
+        )).scalars())
+        new_rows = [row for row in rows if row[key_column] not in existing]
+        if new_rows:
+            await self.conn.execute(table.insert(), new_rows)
+        self.count(table.name, label, len(new_rows))
+        self.count(table.name, "уже в БД", len(rows) - len(new_rows))
+
+    async def ensure_users(self, tg_ids) -> None:
+        """Создаёт минимальные записи пользователей, на которых ссылаются конфиги или платежи."""
+        missing = [tg_id for tg_id in set(tg_ids) if tg_id not in self.known_users]
+        if not missing:
+            return
+        await self.insert_new(
+            User.__table__, "tg_id",
+            [{"tg_id": tg_id, "username": None, "first_name": "Anonymous"} for tg_id in missing],
+            label="добавлено без профиля"
+        )
+        self.known_users.update(missing)
+
+    async def import_servers(self, path: str) -> None:
+        batch = []
+        for server_id, data in iter_json_entries(path):
+            self.count("servers", "прочитано")
+            batch.append(_server_row(str(server_id), data))
+            if len(batch) >= BATCH_SIZE:
+                await self.insert_new(Server.__table__, "id", batch)
+                batch = []
+        await self.insert_new(Server.__table__, "id", batch)
+        self.known_servers = set((await self.conn.execute(select(Server.id))).scalars())
+
+    async def import_subscriptions(self, path: str) -> None:
+        users, configs = [], []
+
+        async def flush():
+            await self.insert_new(User.__table__, "tg_id", users)
+            self.known_users.update(row["tg_id"] for row in users)
+            await self.insert_new(Config.__table__, "id", configs)
+            users.clear()
+            configs.clear()
+
+        for tg_id, data in iter_json_entries(path):
+            tg_id = str(tg_id)
+            self.count("users", "прочитано")
+            users.append(_user_row(tg_id, data))
+            for config in data.get("configs") or []:
+                self.count("configs", "прочитано")
+                if config.get("server_id") not in self.known_servers:
+                    self.count("configs", "пропущено: нет сервера")
+                    continue
+                try:
+                    configs.append(_config_row(tg_id, config))
+                except (KeyError, ValueError) as e:
+                    self.count("configs", f"пропущено: {type(e).__name__}")
+            if len(configs) >= BATCH_SIZE or len(users) >= BATCH_SIZE:
+                await flush()
+        await flush()
+
+    async def import_pending_payments(self, path: str) -> None:
+        tariff_days = dict((await self.conn.execute(select(Tariff.id, Tariff.duration_days))).all())
+        # Счёт живёт 15 минут: давние записи уже не оплатить, и выдавать по ним автоматически нельзя
+        cutoff = now_ts() - PaymentConfig.STALE_AFTER
+        batch = []
+
+        async def flush():
+            await self.ensure_users(row["user_id"] for row in batch)
+            await self.insert_new(PendingPayment.__table__, "payment_id", batch)
+            batch.clear()
+
+        for payment_id, data in iter_json_entries(path):
+            self.count("pending_payments", "прочитано")
+            try:
+                row = _payment_row(str(payment_id), data, tariff_days)
+            except ValueError:
+                self.count("pending_payments", "пропущено: неверная дата")
+                continue
+            if (row["created_at"] or 0) < cutoff:
+                self.count("pending_payments", "пропущено: устарел")
+                continue
+            if not row["kind"]:
+                self.count("pending_payments", "payload не разобран")
+            batch.append(row)
+            if len(batch) >= BATCH_SIZE:
+                await flush()
+        await flush()
+
+
+def format_report(report: Dict[str, Counter], dry_run: bool) -> str:
+    lines = ["Сухой прогон (изменения откачены):" if dry_run else "Импорт завершён:"]
+    for table, counter in report.items():
+        details = ", ".join(f"{key}: {value}" for key, value in counter.items())
+        lines.append(f"  {table}: {details}")
+    return "\n".join(lines)
+
+
+async def import_json(dry_run: bool = False) -> Dict[str, Counter]:
+    async with engine.begin() as conn:
+        await conn.run_sync(upgrade)
+
+    try:
+        async with engine.connect() as conn:
+            transaction = await conn.begin()
+            importer = _Importer(conn)
+            importer.known_users = set((await conn.execute(select(User.tg_id))).scalars())
+            importer.known_servers = set((await conn.execute(select(Server.id))).scalars())
+            try:
+                for path, step in [
+                    (SERVERS_FILE, importer.import_servers),
+                    (SUBS_FILE, importer.import_subscriptions),
+                    (PENDING_FILE, importer.import_pending_payments),
+                ]:
+                    if not os.path.exists(path):
+                        logger.info(f"Файл не найден, пропуск: {path}")
+                        continue
+                    logger.info(f"📥 Импорт {path}")
+                    await step(path)
+            except Exception:
+                await transaction.rollback()
+                raise
+            if dry_run:
+                await transaction.rollback()
+            else:
+                await transaction.commit()
+        return importer.report
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    dry_run = "--dry-run" in sys.argv[1:]
+    print(format_report(asyncio.run(import_json(dry_run)), dry_run))
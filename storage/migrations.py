@@ -0,0 +1,354 @@
+# storage/migrations.py
+"""
+Версионные миграции схемы БД.
+
+Новая установка: create_all создаёт актуальную схему, версия сразу выставляется в последнюю.
+Существующая БД: create_all досоздаёт новые таблицы, затем по порядку применяются
+миграции с номером больше сохранённого в таблице schema_version.
+Каждая миграция идемпотентна (проверяет текущее состояние схемы).
+
+Миграции 2–3 переводят старые SQLite-базы со строковыми колонками и пересоздают таблицы
+средствами SQLite. PostgreSQL-база всегда создаётся сразу в актуальной схеме
+(данные переносятся через storage.copy_data), поэтому новые миграции, начиная с 4-й,
+должны работать на обоих диалектах.
+
+Ручной запуск для существующего data/bot.db:
+    python -m storage.migrations
+"""
+import asyncio
+import logging
+
+from sqlalchemy import BigInteger, Column, Integer, MetaData, String, Table, inspect, select, text
+
+from storage.database import Base
+
+logger = logging.getLogger(__name__)
+
+_version_metadata = MetaData()
+schema_version = Table(
+    "schema_version", _version_metadata,
+    Column("version", Integer, primary_key=True)
+)
+
+
+# ---------- Вспомогательные функции ----------
+def _column_names(sync_conn, table_name: str) -> set:
+    return {c["name"] for c in inspect(sync_conn).get_columns(table_name)}
+
+
+def _add_column(sync_conn, table_name: str, column_name: str, ddl: str) -> None:
+    """Добавляет колонку, если её ещё нет."""
+    if column_name in _column_names(sync_conn, table_name):
+        return
+    sync_conn.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {ddl}"))
+    logger.info(f"Миграция: добавлена колонка {table_name}.{column_name}")
+
+
+def _create_index(sync_conn, index_name: str, table_name: str, column_names: list) -> None:
+    """Создаёт индекс, если его ещё нет."""
+    existing = {i["name"] for i in inspect(sync_conn).get_indexes(table_name)}
+    if index_name in existing:
+        return
+    sync_conn.execute(text(f"CREATE INDEX {index_name} ON {table_name} ({', '.join(column_names)})"))
+    logger.info(f"Миграция: создан индекс {index_name}")
+
+
+def _string_columns(sync_conn, table_name: str, column_names) -> list:
+    """Возвращает колонки из списка, которые в БД всё ещё строковые."""
+    types = {c["name"]: c["type"] for c in inspect(sync_conn).get_columns(table_name)}
+    return [name for name in column_names if isinstance(types.get(name), String)]
+
+
+def _change_column_types(
+    sync_conn, table_name: str, column_types: dict, converters: dict, not_null_defaults: dict = None
+) -> None:
+    """
+    Меняет типы колонок с преобразованием данных.
+
+    SQLite не умеет ALTER COLUMN TYPE, поэтому таблица пересоздаётся по отражённой схеме
+    с новыми типами, данные переносятся через INSERT ... SELECT, индексы восстанавливаются.
+
+    Args:
+        column_types: имя колонки -> новый тип SQLAlchemy
+        converters: имя колонки -> SQL-выражение, вычисляющее новое значение из старой строки
+        not_null_defaults: имя колонки -> SQL-значение по умолчанию; такие колонки создаются
+            NOT NULL DEFAULT, как в модели (конвертер должен исключать NULL)
+    """
+    tmp_name = f"_{table_name}_rebuild"
+    sync_conn.execute(text(f"DROP TABLE IF EXISTS {tmp_name}"))  # остаток прерванной миграции
+
+    metadata = MetaData()
+    old_table = Table(table_name, metadata, autoload_with=sync_conn)
+    indexes = list(old_table.indexes)
+    new_table = old_table.to_metadata(metadata, name=tmp_name)
+    new_table.indexes.clear()
+    for name, column_type in column_types.items():
+        if name in (not_null_defaults or {}):
+            new_table.append_column(
+                Column(name, column_type, nullable=False, server_default=text(not_null_defaults[name])),
+                replace_existing=True
+            )
+        else:
+            new_table.c[name].type = column_type
+    new_table.create(sync_conn)
+
+    names = [c.name for c in old_table.columns]
+    sync_conn.execute(text(
+        f"INSERT INTO {tmp_name} ({', '.join(names)}) "
+        f"SELECT {', '.join(converters.get(n, n) for n in names)} FROM {table_name}"
+    ))
+    sync_conn.execute(text(f"DROP TABLE {table_name}"))
+    sync_conn.execute(text(f"ALTER TABLE {tmp_name} RENAME TO {table_name}"))
+    for index in indexes:
+        index.create(sync_conn)
+    logger.info(f"Миграция: таблица {table_name} пересоздана, новые типы: {', '.join(column_types)}")
+
+
+# ---------- Миграции ----------
+def _m001_traffic_history(sync_conn) -> None:
+    """Счётчик up-трафика на конфиге (для вычисления приростов в traffic_samples)."""
+    # NULL у существующих конфигов: первый прирост up не учитывается, чтобы не записать
+    # в историю весь накопленный за прошлое счётчик
+    _add_column(sync_conn, "configs", "traffic_up_bytes", "INTEGER")
+
+
+def _m002_numeric_traffic(sync_conn) -> None:
+    """Числовые traffic_used_bytes / traffic_limit_gb / base_tariff, отдельный флаг is_trial."""
+    _add_column(sync_conn, "configs", "is_trial", "BOOLEAN NOT NULL DEFAULT 0")
+    if "base_tariff" in _string_columns(sync_conn, "configs", ["base_tariff"]):
+        # Пробные конфиги исторически хранили в base_tariff строку "trial"/"Trial"
+        sync_conn.execute(text("UPDATE configs SET is_trial = 1 WHERE lower(base_tariff) = 'trial'"))
+
+    pending = _string_columns(sync_conn, "configs", ["traffic_used_bytes", "traffic_limit_gb", "base_tariff"])
+    if not pending:
+        return
+
+    types = {"traffic_used_bytes": BigInteger(), "traffic_limit_gb": Integer(), "base_tariff": Integer()}
+    converters = {
+        "traffic_used_bytes": "CAST(COALESCE(NULLIF(trim(traffic_used_bytes), ''), '0') AS BIGINT)",
+        "traffic_limit_gb": "CAST(NULLIF(trim(traffic_limit_gb), '') AS INTEGER)",
+        "base_tariff": (
+            "CASE WHEN lower(base_tariff) = 'trial' OR trim(base_tariff) = '' THEN NULL "
+            "ELSE CAST(base_tariff AS INTEGER) END"
+        ),
+    }
+    _change_column_types(
+        sync_conn, "configs",
+        {name: types[name] for name in pending},
+        {name: converters[name] for name in pending},
+        # Как в модели: traffic_used_bytes NOT NULL DEFAULT 0 (COALESCE выше исключает NULL)
+        not_null_defaults={"traffic_used_bytes": "0"} if "traffic_used_bytes" in pending else None
+    )
+
+
+def _m003_epoch_datetimes(sync_conn) -> None:
+    """expiry / created_at / last_traffic_reset в unix time и индексы для выборок по сроку."""
+    pending = _string_columns(sync_conn, "configs", ["expiry", "created_at", "last_traffic_reset"])
+    if pending:
+        # strftime('%s') понимает ISO 8601 с 'T', долями секунды и смещением/Z;
+        # строки без смещения (как писал strftime без tz) считаются UTC
+        _change_column_types(
+            sync_conn, "configs",
+            {name: Integer() for name in pending},
+            {name: f"CAST(strftime('%s', {name}) AS INTEGER)" for name in pending}
+        )
+    _create_index(sync_conn, "ix_configs_active_expiry", "configs", ["active", "expiry"])
+    _create_index(sync_conn, "ix_configs_user_tg_id", "configs", ["user_tg_id"])
+
+
+def _m004_next_traffic_reset(sync_conn) -> None:
+    """Плановое время ежемесячного сброса трафика, вычисленное заранее."""
+    from utils.helpers import add_months_ts
+
+    _add_column(sync_conn, "configs", "next_traffic_reset_at", "INTEGER")
+    _create_index(sync_conn, "ix_configs_active_next_reset", "configs", ["active", "next_traffic_reset_at"])
+
+    # Заполняем для длинных тарифов: месяц от последнего сброса (или от создания)
+    rows = sync_conn.execute(text(
+        "SELECT id, COALESCE(last_traffic_reset, created_at) FROM configs "
+        "WHERE is_trial = :is_trial AND base_tariff > 30 AND next_traffic_reset_at IS NULL "
+        "AND COALESCE(last_traffic_reset, created_at) IS NOT NULL"
+    ), {"is_trial": False}).fetchall()
+    if rows:
+        sync_conn.execute(
+            text("UPDATE configs SET next_traffic_reset_at = :next_reset WHERE id = :config_id"),
+            [{"config_id": row[0], "next_reset": add_months_ts(row[1])} for row in rows]
+        )
+        logger.info(f"Миграция: рассчитана дата сброса трафика для {len(rows)} конфигов")
+
+
+def _m005_blocked_users(sync_conn) -> None:
+    """Флаг пользователей, заблокировавших бота (рассылки их пропускают)."""
+    _add_column(sync_conn, "users", "is_blocked", "BOOLEAN NOT NULL DEFAULT FALSE")
+
+
+def _m006_payment_status(sync_conn) -> None:
+    """Статус обработки платежа: выдача выполняется ровно один раз и переживает перезапуск."""
+    _add_column(sync_conn, "pending_payments", "status", "VARCHAR NOT NULL DEFAULT 'pending'")
+    _add_column(sync_conn, "pending_payments", "updated_at", "INTEGER")
+    _create_index(sync_conn, "ix_pending_payments_status", "pending_payments", ["status"])
+
+
+def parse_legacy_payload(payload: str, tariff_days: dict = None) -> dict:
+    """
+    Разбирает строковый payload платежа в значения типизированных колонок pending_payments.
+
+    Известные форматы:
+        {uuid}|{server}|{category}|{days}|{user}|{price}  — подписка (текущий)
+        {uuid}|{server}|{category}|{1w|1m|...}|{user}     — подписка (старый, код тарифа)
+        {uuid}|{server}|{N}|{user}                        — подписка (старый, срок неизвестен)
+        renew|{config}|{tariff_id|1w|...}|{user}          — продление
+        reset_traffic|{config}|{user}, add_traffic|{config}|{user}
+    Неизвестный формат даёт {"kind": None}: такой платёж не выдаётся автоматически.
+
+    Args:
+        tariff_days: id тарифа -> срок в днях (для продлений по tariff_id)
+    """
+    from utils.helpers import DAYS_TO_TARIFF_CODE
+
+    code_days = {code: days for days, code in DAYS_TO_TARIFF_CODE.items()}
+    tariff_days = tariff_days or {}
+    parts = (payload or "").split("|")
+
+    if parts[0] in ("reset_traffic", "add_traffic") and len(parts) == 3:
+        return {"kind": parts[0], "config_id": parts[1]}
+    if parts[0] == "renew" and len(parts) == 4:
+        values = {"kind": "renew", "config_id": parts[1]}
+        if parts[2] in code_days:
+            values["duration_days"] = code_days[parts[2]]
+        elif parts[2].isdigit() and int(parts[2]) in tariff_days:
+            values["tariff_id"] = int(parts[2])
+            values["duration_days"] = tariff_days[int(parts[2])]
+        return values
+    if len(parts) == 6 and parts[3].isdigit():
+        return {
+            "kind": "subscription", "server_id": parts[1], "category": parts[2],
+            "duration_days": int(parts[3]),
+            "amount": int(parts[5]) if parts[5].isdigit() else None,
+        }
+    if len(parts) == 5 and parts[3] in code_days:
+        return {
+            "kind": "subscription", "server_id": parts[1], "category": parts[2],
+            "duration_days": code_days[parts[3]],
+        }
+    if len(parts) == 4:
+        return {"kind": "subscription", "server_id": parts[1]}
+    return {"kind": None}
+
+
+def _epoch_payment_created_at(sync_conn) -> None:
+    """pending_payments.created_at: строка ISO 8601 → unix time (строки без смещения — UTC)."""
+    if not _string_columns(sync_conn, "pending_payments", ["created_at"]):
+        return
+    if sync_conn.dialect.name == "postgresql":
+        sync_conn.execute(text("SET LOCAL TIME ZONE 'UTC'"))
+        sync_conn.execute(text(
+            "ALTER TABLE pending_payments ALTER COLUMN created_at TYPE INTEGER USING "
+            "CAST(EXTRACT(EPOCH FROM CAST(NULLIF(trim(created_at), '') AS TIMESTAMPTZ)) AS INTEGER)"
+        ))
+        logger.info("Миграция: pending_payments.created_at переведён в unix time")
+        return
+    _change_column_types(
+        sync_conn, "pending_payments",
+        {"created_at": Integer()},
+        {"created_at": "CAST(strftime('%s', NULLIF(trim(created_at), '')) AS INTEGER)"}
+    )
+
+
+def _m007_typed_payments(sync_conn) -> None:
+    """
+    Типизированные колонки платежа вместо разбора payload, created_at в unix time
+    (ISO-строки разного вида неверно сравниваются с границей возраста), индексы по user_id и created_at.
+    """
+    _epoch_payment_created_at(sync_conn)
+    for name, ddl in [
+        ("kind", "VARCHAR"), ("server_id", "VARCHAR"), ("config_id", "VARCHAR"),
+        ("tariff_id", "INTEGER"), ("category", "VARCHAR"), ("duration_days", "INTEGER"),
+        ("amount", "INTEGER"),
+    ]:
+        _add_column(sync_conn, "pending_payments", name, ddl)
+    _create_index(sync_conn, "ix_pending_payments_user_id", "pending_payments", ["user_id"])
+    _create_index(sync_conn, "ix_pending_payments_created_at", "pending_payments", ["created_at"])
+
+    tariff_days = dict(sync_conn.execute(text("SELECT id, duration_days FROM tariffs")).fetchall())
+    rows = sync_conn.execute(text(
+        "SELECT payment_id, payload FROM pending_payments WHERE kind IS NULL"
+    )).fetchall()
+    columns = ["kind", "server_id", "config_id", "tariff_id", "category", "duration_days", "amount"]
+    params = []
+    for payment_id, payload in rows:
+        values = parse_legacy_payload(payload, tariff_days)
+        params.append({"payment_id": payment_id, **{name: values.get(name) for name in columns}})
+    if params:
+        sync_conn.execute(
+            text(
+                f"UPDATE pending_payments SET {', '.join(f'{name} = :{name}' for name in columns)} "
+                "WHERE payment_id = :payment_id"
+            ),
+            params
+        )
+        parsed = sum(1 for p in params if p["kind"])
+        logger.info(f"Миграция: разобрано платежей {parsed} из {len(params)}")
+
+
+def _m008_configs_expiry_index(sync_conn) -> None:
+    """Индекс по одному expiry: очистка просроченных не фильтрует по active."""
+    _create_index(sync_conn, "ix_configs_expiry", "configs", ["expiry"])
+
+
+MIGRATIONS = [
+    (1, "История трафика: configs.traffic_up_bytes", _m001_traffic_history),
+    (2, "Числовые колонки трафика и тарифа в configs", _m002_numeric_traffic),
+    (3, "Сроки конфигов в unix time, индексы (active, expiry) и (user_tg_id)", _m003_epoch_datetimes),
+    (4, "configs.next_traffic_reset_at и индекс для выборки сбросов трафика", _m004_next_traffic_reset),
+    (5, "users.is_blocked для рассылок", _m005_blocked_users),
+    (6, "pending_payments.status и updated_at для идемпотентной выдачи", _m006_payment_status),
+    (7, "Типизированные колонки pending_payments, created_at в unix time, индексы (user_id) и (created_at)", _m007_typed_payments),
+    (8, "Индекс configs (expiry) для удаления просроченных конфигов", _m008_configs_expiry_index),
+]
+HEAD = MIGRATIONS[-1][0]
+
+
+# ---------- Применение ----------
+def _get_version(sync_conn) -> int:
+    return sync_conn.execute(select(schema_version.c.version)).scalar() or 0
+
+
+def _set_version(sync_conn, version: int) -> None:
+    sync_conn.execute(schema_version.delete())
+    sync_conn.execute(schema_version.insert().values(version=version))
+
+
+def upgrade(sync_conn) -> None:
+    """Создаёт недостающие таблицы и применяет невыполненные миграции."""
+    fresh = not inspect(sync_conn).has_table("configs")
+
+    _version_metadata.create_all(sync_conn)
+    Base.metadata.create_all(sync_conn)
+
+    if fresh:
+        _set_version(sync_conn, HEAD)
+        return
+
+    current = _get_version(sync_conn)
+    for version, description, migrate in MIGRATIONS:
+        if version <= current:
+            continue
+        logger.info(f"Применение миграции {version}: {description}")
+        migrate(sync_conn)
+        _set_version(sync_conn, version)
+
+
+async def _main():
+    from storage.database import engine
+
+    async with engine.begin() as conn:
+        await conn.run_sync(upgrade)
+        version = await conn.run_sync(_get_version)
+    await engine.dispose()
+    print(f"Схема БД обновлена до версии {version}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_main())
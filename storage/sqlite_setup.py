@@ -0,0 +1,59 @@
+# storage/sqlite_setup.py
+"""
+Настройка соединений SQLite: WAL, synchronous, кэш страниц, mmap и busy_timeout
+на каждом новом соединении пула, а также периодическое обслуживание БД.
+"""
+import logging
+
+from sqlalchemy import event
+
+from config import DatabaseConfig
+
+logger = logging.getLogger(__name__)
+
+
+def _pragmas() -> list:
+    return [
+        f"PRAGMA journal_mode={DatabaseConfig.JOURNAL_MODE}",
+        f"PRAGMA synchronous={DatabaseConfig.SYNCHRONOUS}",
+        f"PRAGMA cache_size=-{DatabaseConfig.CACHE_SIZE_KB}",  # отрицательное значение — в КиБ
+        f"PRAGMA mmap_size={DatabaseConfig.MMAP_SIZE}",
+        f"PRAGMA busy_timeout={DatabaseConfig.BUSY_TIMEOUT_MS}",
+    ]
+
+
+def configure_sqlite(engine) -> None:
+    """Регистрирует хук, выставляющий прагмы на каждом новом соединении движка."""
+    if engine.dialect.name != "sqlite":
+        return
+
+    pragmas = _pragmas()
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def _on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for pragma in pragmas:
+                cursor.execute(pragma)
+        finally:
+            cursor.close()
+
+
+async def run_sqlite_maintenance(engine) -> None:
+    """
+    PRAGMA optimize (обновляет статистику планировщика по мере необходимости)
+    и чекпоинт WAL, чтобы файл журнала не разрастался при постоянной записи.
+    """
+    if engine.dialect.name != "sqlite":
+        return
+
+    async with engine.connect() as conn:
+        await conn.exec_driver_sql("PRAGMA optimize")
+        result = await conn.exec_driver_sql(f"PRAGMA wal_checkpoint({DatabaseConfig.WAL_CHECKPOINT_MODE})")
+        busy, log_frames, checkpointed = result.fetchone()
+        await conn.commit()
+
+    if busy:
+        logger.warning(f"⚠️ Чекпоинт WAL не завершён: БД занята ({checkpointed}/{log_frames} страниц)")
+    else:
+        logger.info(f"🧹 Обслуживание SQLite: PRAGMA optimize, чекпоинт WAL ({checkpointed}/{log_frames} страниц)")
@@ -0,0 +1,22 @@
+# tasks/db_maintenance.py
+import asyncio
+import logging
+
+from config import DatabaseConfig
+from storage.database import async_engine
+from storage.sqlite_setup import run_sqlite_maintenance
+
+logger = logging.getLogger(__name__)
+
+
+async def sqlite_maintenance_task():
+    """Фоновая задача: периодический PRAGMA optimize и чекпоинт WAL."""
+    if async_engine.dialect.name != "sqlite":
+        return
+
+    while True:
+        await asyncio.sleep(DatabaseConfig.MAINTENANCE_INTERVAL)
+        try:
+            await run_sqlite_maintenance(async_engine)
+        except Exception as e:
+            logger.exception(f"💥 Ошибка обслуживания SQLite: {e}")
@@ -2,74 +2,103 @@
 import asyncio
 import logging
 from datetime import datetime, timezone, timedelta
-from dateutil.relativedelta import relativedelta
 
-from sqlalchemy import select, update
+from sqlalchemy import func, select, update
+from config import ExpirationConfig
 from storage.database import async_session_maker, Config, Server, Tariff
-from services.xui_manager import XUIManager
+from services.xui_manager import get_xui_manager
+from utils.helpers import to_ts, now_ts, add_months_ts
+from utils.cache import my_configs_cache
 
 
 # --- Задача 1: Полное удаление старых конфигов ---
-async def _delete_expired_configs():
-    """Полное удаление конфигов, просроченных более чем на 3 дня."""
-    now = datetime.now(timezone.utc)
-    three_days_ago = now - timedelta(days=3)
-    three_days_ago_str = three_days_ago.strftime("%Y-%m-%dT%H:%M:%S")
 
+
+async def _delete_server_clients(server, configs: list) -> list:
+    """
+    Удаляет клиентов одного сервера из 3x-ui через общую сессию панели.
+    Запросы идут параллельно (ограничены семафором запросов XUIManager).
+    Возвращает id конфигов, клиенты которых успешно удалены.
+    """
+    xui = await get_xui_manager(server)
+
+    async def _delete(cfg):
+        try:
+            if await xui.delete_client_by_email(inbound_id=server.inbound_id, email=cfg["client_email"]):
+                return cfg["config_id"]
+            logging.error(f"Не удалось удалить клиента {cfg['client_email']} из 3x-ui.")
+        except Exception as e:
+            logging.error(f"Ошибка при удалении конфига {cfg['config_id']}: {e}")
+        return None
+
+    results = await asyncio.gather(*(_delete(cfg) for cfg in configs))
+    return [config_id for config_id in results if config_id]
+
+
+async def _delete_config_rows(config_ids: list) -> None:
+    """Удаляет строки конфигов короткими транзакциями по ExpirationConfig.DB_CHUNK_SIZE."""
+    for i in range(0, len(config_ids), ExpirationConfig.DB_CHUNK_SIZE):
+        chunk = config_ids[i:i + ExpirationConfig.DB_CHUNK_SIZE]
+        async with async_session_maker() as session:
+            await session.execute(Config.__table__.delete().where(Config.id.in_(chunk)))
+            await session.commit()
+    my_configs_cache.clear()
+
+
+async def _cleanup_server(server, configs: list, semaphore: asyncio.Semaphore) -> int:
+    """Удаляет просроченные конфиги одного сервера: сначала в панели, затем в БД."""
+    async with semaphore:
+        try:
+            deleted_ids = await _delete_server_clients(server, configs)
+            await _delete_config_rows(deleted_ids)
+        except Exception as e:
+            logging.error(f"Ошибка при удалении конфигов сервера {server.id}: {e}", exc_info=True)
+            return 0
+        logging.info(f"Сервер {server.id}: удалено {len(deleted_ids)} из {len(configs)} конфигураций.")
+        return len(deleted_ids)
+
+
+async def _delete_expired_configs():
+    """
+    Полное удаление конфигов, просроченных более чем на 3 дня.
+    Конфиги группируются по серверам: на сервер — одна сессия панели и параллельные удаления,
+    строки удаляются из БД пачками сразу по завершении сервера (без долгой транзакции на время сетевых вызовов).
+    """
+    three_days_ago_ts = to_ts(datetime.now(timezone.utc) - timedelta(days=3))
+
+    # === ШАГ 1: Получаем просроченные конфиги вместе с серверами и группируем ===
+    servers_grouped = {}
     async with async_session_maker() as session:
-        stmt = select(Config).where(Config.expiry < three_days_ago_str)
-        result = await session.execute(stmt)
-        expired_configs = result.scalars().all()
-
-        if not expired_configs:
-            logging.info("Нет конфигураций для полного удаления (просрочены более 3 дней).")
-            return
-
-        logging.info(f"Найдено {len(expired_configs)} конфигураций для полного удаления.")
-        delete_count = 0
-
-        server_ids = {cfg.server_id for cfg in expired_configs}
-        servers = {}
-        for sid in server_ids:
-            server_stmt = select(Server).where(Server.id == sid)
-            server_result = await session.execute(server_stmt)
-            server = server_result.scalar_one_or_none()
-            if server:
-                servers[sid] = server
-            else:
-                logging.warning(f"Сервер {sid} не найден. Конфиги будут пропущены.")
-
-        for config in expired_configs:
-            server = servers.get(config.server_id)
-            if not server:
+        result = await session.execute(
+            select(Config, Server)
+            .outerjoin(Server, Config.server_id == Server.id)
+            .where(Config.expiry < three_days_ago_ts)
+        )
+        total = 0
+        for config, server in result:
+            total += 1
+            if server is None:
+                logging.warning(f"Сервер {config.server_id} не найден. Конфиг {config.id} будет пропущен.")
                 continue
+            servers_grouped.setdefault(server.id, {"server": server, "configs": []})
+            servers_grouped[server.id]["configs"].append({
+                "config_id": config.id,
+                "client_email": config.client_email
+            })
+
+    if not total:
+        logging.info("Нет конфигураций для полного удаления (просрочены более 3 дней).")
+        return
 
-            xui = None
-            try:
-                xui = XUIManager(
-                    base_url=server.xui_url,
-                    username=server.xui_username,
-                    password=server.xui_password,
-                    server_id=server.id
-                )
-                success = await xui.delete_client_by_email(
-                    inbound_id=server.inbound_id,
-                    email=config.client_email
-                )
-                if success:
-                    logging.info(f"Успешно удалён клиент {config.client_email} из 3x-ui на сервере {server.id}.")
-                    await session.execute(Config.__table__.delete().where(Config.id == config.id))
-                    delete_count += 1
-                else:
-                    logging.error(f"Не удалось удалить клиента {config.client_email} из 3x-ui.")
-            except Exception as e:
-                logging.error(f"Ошибка при удалении конфига {config.id}: {e}", exc_info=True)
-            finally:
-                if xui:
-                    await xui.close()
-
-        await session.commit()
-        logging.info(f"Завершено полное удаление: {delete_count} конфигураций.")
+    logging.info(f"Найдено {total} конфигураций для полного удаления на {len(servers_grouped)} серверах.")
+
+    # === ШАГ 2: Параллельно обрабатываем сервера ===
+    semaphore = asyncio.Semaphore(ExpirationConfig.MAX_CONCURRENT_SERVERS)
+    results = await asyncio.gather(*(
+        _cleanup_server(data["server"], data["configs"], semaphore)
+        for data in servers_grouped.values()
+    ))
+    logging.info(f"Завершено полное удаление: {sum(results)} конфигураций.")
 
 
 async def deactivate_expired_subscriptions():
@@ -84,101 +113,132 @@ async def deactivate_expired_subscriptions():
 
 
 # --- Задача 2: Ежемесячный сброс трафика ---
-async def _reset_monthly_traffic():
-    """Сбрасывает трафик для конфигов с тарифами > 30 дней, если прошёл календарный месяц."""
-    now = datetime.now(timezone.utc)
+RESET_MAX_SLEEP = 24 * 3600     # Максимальный интервал между проверками, сек
+RESET_RETRY_DELAY = 15 * 60     # Повтор, если остались просроченные (неудавшиеся) сбросы, сек
 
-    # === ШАГ 1: Получаем все активные конфиги и фильтруем в Python ===
-    configs_to_check = []
-    async with async_session_maker() as session:
-        stmt = select(Config).where(Config.active == True)
-        result = await session.execute(stmt)
-        all_configs = result.scalars().all()
-
-        for cfg in all_configs:
-            try:
-                # Проверяем, что тариф длинный
-                if cfg.base_tariff != "Trial" and int(cfg.base_tariff) > 30:
-                    # Получаем данные сервера
-                    server = await session.get(Server, cfg.server_id)
-                    if server:
-                        configs_to_check.append({
-                            "config_id": cfg.id,
-                            "client_email": cfg.client_email,
-                            "server_id": server.id,
-                            "server_data": {
-                                # === ИСПРАВЛЕНО: Правильные имена аргументов для XUIManager ===
-                                "base_url": server.xui_url,
-                                "username": server.xui_username,
-                                "password": server.xui_password,
-                                "server_id": server.id
-                            },
-                            "inbound_id": server.inbound_id, # inbound_id отдельно
-                            "last_traffic_reset": cfg.last_traffic_reset,
-                            "created_at": cfg.created_at
-                        })
-            except (ValueError, TypeError):
-                continue # Пропускаем некорректные тарифы
-
-    if not configs_to_check:
-        logging.info("Нет активных конфигураций с тарифами > 30 дней для проверки сброса трафика.")
-        return
 
-    logging.info(f"Проверка сброса трафика для {len(configs_to_check)} конфигураций.")
-    reset_count = 0
+async def _reset_server_traffic(server, configs: list) -> list:
+    """
+    Сбрасывает трафик клиентов одного сервера через общую сессию панели.
+    Возвращает id конфигов, для которых сброс прошёл успешно.
+    """
+    xui = await get_xui_manager(server)
 
-    for item in configs_to_check:
-        # Определяем дату, с которой считать "месяц"
-        reset_start_date_str = item["last_traffic_reset"] or item["created_at"]
+    async def _reset(cfg):
         try:
-            reset_start_date = datetime.fromisoformat(reset_start_date_str.replace("Z", "+00:00"))
-            if reset_start_date.tzinfo is None:
-                reset_start_date = reset_start_date.replace(tzinfo=timezone.utc)
-        except (ValueError, TypeError):
-            logging.error(f"Неверный формат даты для конфига {item['config_id']}: {reset_start_date_str}")
-            continue
-
-        next_reset_date = reset_start_date + relativedelta(months=1)
-        if now >= next_reset_date:
-            xui = None
-            try:
-                # === Теперь аргументы совпадают! ===
-                xui = XUIManager(**item["server_data"])
-                success = await xui.reset_client_traffic(
-                    inbound_id=item["inbound_id"], # Используем отдельно сохранённый inbound_id
-                    email=item["client_email"]
-                )
-                if success:
-                    new_reset_date = now.strftime("%Y-%m-%dT%H:%M:%S")
-                    # Обновляем в НОВОЙ сессии
-                    async with async_session_maker() as upd_session:
-                        await upd_session.execute(
-                            update(Config)
-                            .where(Config.id == item["config_id"])
-                            .values(
-                                traffic_used_bytes="0",
-                                last_traffic_reset=new_reset_date
-                            )
+            if await xui.reset_client_traffic(inbound_id=server.inbound_id, email=cfg["client_email"]):
+                return cfg["config_id"]
+            logging.error(f"Не удалось сбросить трафик для {cfg['client_email']} в 3x-ui.")
+        except Exception as e:
+            logging.error(f"Ошибка при сбросе трафика для {cfg['config_id']}: {e}")
+        return None
+
+    results = await asyncio.gather(*(_reset(cfg) for cfg in configs))
+    return [config_id for config_id in results if config_id]
+
+
+async def _reset_server(server, configs: list, semaphore: asyncio.Semaphore) -> int:
+    """Сбрасывает трафик на сервере и сдвигает дату следующего сброса на месяц."""
+    async with semaphore:
+        try:
+            reset_ids = await _reset_server_traffic(server, configs)
+            reset_at = now_ts()
+            for i in range(0, len(reset_ids), ExpirationConfig.DB_CHUNK_SIZE):
+                async with async_session_maker() as session:
+                    await session.execute(
+                        update(Config)
+                        .where(Config.id.in_(reset_ids[i:i + ExpirationConfig.DB_CHUNK_SIZE]))
+                        .values(
+                            traffic_used_bytes=0,
+                            last_traffic_reset=reset_at,
+                            next_traffic_reset_at=add_months_ts(reset_at),
+                            notify_traffic_80_sent=False,
+                            notify_traffic_95_sent=False
                         )
-                        await upd_session.commit()
-                    reset_count += 1
-                    logging.info(f"Трафик сброшен для {item['client_email']}. Новая дата сброса: {new_reset_date}")
-                else:
-                    logging.error(f"Не удалось сбросить трафик для {item['client_email']} в 3x-ui.")
-            except Exception as e:
-                logging.error(f"Ошибка при сбросе трафика для {item['config_id']}: {e}", exc_info=True)
-            finally:
-                if xui:
-                    await xui.close()
-
-    logging.info(f"Завершена проверка сброса трафика. Выполнено сбросов: {reset_count}")
+                    )
+                    await session.commit()
+            my_configs_cache.clear()
+        except Exception as e:
+            logging.error(f"Ошибка при сбросе трафика на сервере {server.id}: {e}", exc_info=True)
+            return 0
+        logging.info(f"Сервер {server.id}: трафик сброшен для {len(reset_ids)} из {len(configs)} конфигураций.")
+        return len(reset_ids)
+
+
+async def _reset_monthly_traffic():
+    """
+    Сбрасывает трафик конфигов, у которых наступило next_traffic_reset_at
+    (тарифы > 30 дней, раз в календарный месяц). Кандидаты выбираются одним запросом по индексу,
+    сбросы группируются по серверам.
+    """
+    # === ШАГ 1: Кандидаты на сброс вместе с серверами ===
+    servers_grouped = {}
+    async with async_session_maker() as session:
+        result = await session.execute(
+            select(Config, Server)
+            .join(Server, Config.server_id == Server.id)
+            .where(
+                Config.active == True,
+                Config.next_traffic_reset_at <= now_ts()
+            )
+        )
+        for config, server in result:
+            servers_grouped.setdefault(server.id, {"server": server, "configs": []})
+            servers_grouped[server.id]["configs"].append({
+                "config_id": config.id,
+                "client_email": config.client_email
+            })
+
+    if not servers_grouped:
+        logging.info("Нет конфигураций, которым пора сбрасывать трафик.")
+        return
+
+    total = sum(len(data["configs"]) for data in servers_grouped.values())
+    logging.info(f"Сброс трафика для {total} конфигураций на {len(servers_grouped)} серверах.")
+
+    # === ШАГ 2: Параллельно обрабатываем сервера ===
+    semaphore = asyncio.Semaphore(ExpirationConfig.MAX_CONCURRENT_SERVERS)
+    results = await asyncio.gather(*(
+        _reset_server(data["server"], data["configs"], semaphore)
+        for data in servers_grouped.values()
+    ))
+    logging.info(f"Завершена проверка сброса трафика. Выполнено сбросов: {sum(results)}")
+
+
+async def _next_reset_delay() -> int:
+    """
+    Сколько спать до ближайшего next_traffic_reset_at (не больше суток).
+    Тот же join с Server, что и в _reset_monthly_traffic: конфиги удалённого сервера
+    не сбрасываются и не должны будить задачу каждые RESET_RETRY_DELAY.
+    """
+    async with async_session_maker() as session:
+        earliest = (await session.execute(
+            select(func.min(Config.next_traffic_reset_at))
+            .join(Server, Config.server_id == Server.id)
+            .where(Config.active == True)
+        )).scalar()
+
+    if earliest is None:
+        return RESET_MAX_SLEEP
+    delay = earliest - now_ts()
+    if delay <= 0:
+        # Остались сбросы, не выполненные из-за ошибок панели
+        return RESET_RETRY_DELAY
+    return min(RESET_MAX_SLEEP, delay + 1)
+
 
 async def reset_monthly_traffic():
-    """Фоновая задача для ежемесячного сброса трафика (раз в сутки)."""
+    """Фоновая задача ежемесячного сброса трафика: просыпается к ближайшей дате сброса."""
     while True:
         try:
             logging.info("Запуск проверки ежемесячного сброса трафика...")
             await _reset_monthly_traffic()
         except Exception as e:
             logging.error(f"Критическая ошибка в задаче сброса трафика: {e}", exc_info=True)
-        await asyncio.sleep(24 * 3600) # Раз в 24 часа
+
+        try:
+            delay = await _next_reset_delay()
+        except Exception as e:
+            logging.error(f"Не удалось определить время следующего сброса трафика: {e}", exc_info=True)
+            delay = RESET_MAX_SLEEP
+        await asyncio.sleep(delay)
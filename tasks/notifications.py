@@ -6,9 +6,10 @@ from datetime import datetime, timezone, timedelta
 from aiogram import Bot
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.exceptions import TelegramAPIError
-from sqlalchemy import select
+from sqlalchemy import select, and_, or_, cast, BigInteger
 from storage.database import async_session_maker, Config, User, Server
-from services.xui_manager import XUIManager
+from utils.helpers import to_ts, from_ts
+from services.message_sender import set_outbound_lane, LANE_NOTIFICATION
 
 logger = logging.getLogger(__name__)
 
@@ -16,13 +17,18 @@ logger = logging.getLogger(__name__)
 BASE_INTERVAL = 3 * 3600  # 10800 сек
 JITTER_RANGE = 600        # ±600 сек = ±10 мин
 
+GIB = 1024 ** 3
+
 
 async def send_subscription_notifications(bot: Bot):
+    # Уведомления уступают очередь отправки интерактивным ответам (темп задаёт services.message_sender)
+    set_outbound_lane(LANE_NOTIFICATION)
     while True:
         try:
             logger.info("🔍 Проверка уведомлений об истечении подписки...")
             now = datetime.now(timezone.utc)
-            warning_threshold = now + timedelta(days=3)
+            now_ts = to_ts(now)
+            warning_threshold_ts = to_ts(now + timedelta(days=3))
 
             # === ШАГ 1: Получаем и копируем данные ===
             notifications_data = []
@@ -32,8 +38,8 @@ async def send_subscription_notifications(bot: Bot):
                     .join(Server, Config.server_id == Server.id)
                     .where(
                         Config.active == True,
-                        Config.expiry > now.isoformat(),
-                        Config.expiry <= warning_threshold.isoformat(),
+                        Config.expiry > now_ts,
+                        Config.expiry <= warning_threshold_ts,
                         Config.notify_expiry_sent == False
                     )
                 )
@@ -51,8 +57,8 @@ async def send_subscription_notifications(bot: Bot):
                     .join(Server, Config.server_id == Server.id)
                     .where(
                         Config.active == True,
-                        Config.expiry <= now.isoformat(),
-                        Config.expiry > (now - timedelta(days=1)).isoformat(),
+                        Config.expiry <= now_ts,
+                        Config.expiry > now_ts - 86400,
                         Config.notify_expiry_sent == False
                     )
                 )
@@ -72,7 +78,7 @@ async def send_subscription_notifications(bot: Bot):
                     continue
 
                 try:
-                    expiry_dt = datetime.fromisoformat(item["expiry"].replace("Z", "+00:00"))
+                    expiry_dt = from_ts(item["expiry"])
                     days_left = max(0, (expiry_dt - now).days)
                     short_id = item["config_id"][:7] + "..." if len(item["config_id"]) > 7 else item["config_id"]
                     server_name = f"{item['server_country']} ({item['server_city']})"
@@ -98,8 +104,6 @@ async def send_subscription_notifications(bot: Bot):
                         )
                         await upd_session.commit()
 
-                    await asyncio.sleep(0.1)
-
                 except TelegramAPIError as e:
                     logger.warning(f"Не удалось отправить уведомление {item['user_tg_id']}: {e}")
 
@@ -116,51 +120,42 @@ async def send_traffic_notifications(bot: Bot):
     Отправляет уведомления о трафике на основе данных из БД.
     Актуализация трафика происходит в отдельной задаче (traffic_updater).
     """
+    set_outbound_lane(LANE_NOTIFICATION)
     while True:
         try:
             logger.info("🔍 Проверка уведомлений о трафике (из БД)...")
             async with async_session_maker() as session:
-                # Получаем только активные конфиги — без JOIN, т.к. сервер нужен только для отображения
-                configs = (await session.execute(
-                    select(Config).where(Config.active == True)
-                )).scalars().all()
+                # Один запрос: активные конфиги, пересёкшие порог 80% / 95% и ещё не уведомлённые,
+                # только у пользователей с включёнными уведомлениями, вместе с сервером.
+                # Сравнение в целых числах: used * 100 >= limit_gb * GiB * percent
+                limit_bytes = cast(Config.traffic_limit_gb, BigInteger) * GIB
+                used_percent_x100 = Config.traffic_used_bytes * 100
+                rows = (await session.execute(
+                    select(Config, Server.country, Server.city)
+                    .join(User, User.tg_id == Config.user_tg_id)
+                    .outerjoin(Server, Server.id == Config.server_id)
+                    .where(
+                        Config.active == True,
+                        Config.traffic_limit_gb > 0,
+                        User.notify_traffic == True,
+                        or_(
+                            and_(used_percent_x100 >= limit_bytes * 80, Config.notify_traffic_80_sent == False),
+                            and_(used_percent_x100 >= limit_bytes * 95, Config.notify_traffic_95_sent == False)
+                        )
+                    )
+                )).all()
 
             notified_count = 0
-            for config in configs:
+            for config, server_country, server_city in rows:
                 try:
-                    # === 1. Читаем данные из БД (уже актуальные благодаря traffic_updater) ===
-                    try:
-                        traffic_used = int(config.traffic_used_bytes or "0")
-                        traffic_limit_gb = int(config.traffic_limit_gb or "0")
-                    except (ValueError, TypeError):
-                        continue
-
-                    if traffic_limit_gb <= 0:
-                        continue
-
-                    traffic_limit_bytes = traffic_limit_gb * (1024 ** 3)
-                    if traffic_limit_bytes == 0:
-                        continue
-
-                    usage_percent = (traffic_used / traffic_limit_bytes) * 100
-
-                    # Пропускаем, если уведомления отключены или уже отправлены
-                    user = await _get_notifying_user(config.user_tg_id, notify_traffic=True)
-                    if not user:
-                        continue
-
-                    # === 2. Получаем имя сервера для отображения ===
-                    server_name = "—"
-                    if config.server_id:
-                        server_result = await session.execute(
-                            select(Server).where(Server.id == config.server_id)
-                        )
-                        server = server_result.scalar_one_or_none()
-                        if server:
-                            server_name = f"{server.country} ({server.city})"
+                    # Данные из БД (уже актуальные благодаря traffic_updater)
+                    traffic_used = config.traffic_used_bytes or 0
+                    traffic_limit_gb = config.traffic_limit_gb
+                    usage_percent = (traffic_used / (traffic_limit_gb * GIB)) * 100
 
+                    server_name = f"{server_country} ({server_city})" if server_country else "—"
                     short_id = config.id[:7] + "..." if len(config.id) > 7 else config.id
-                    used_gb = traffic_used / (1024 ** 3)
+                    used_gb = traffic_used / GIB
 
                     should_notify_80 = usage_percent >= 80 and not config.notify_traffic_80_sent
                     should_notify_95 = usage_percent >= 95 and not config.notify_traffic_95_sent
@@ -183,9 +178,6 @@ async def send_traffic_notifications(bot: Bot):
                 except Exception as e:
                     logger.warning(f"⚠️ Ошибка при проверке конфига {config.id}: {e}")
 
-                # Небольшая пауза, чтобы не спамить Telegram API
-                await asyncio.sleep(0.1)
-
             logger.info(f"✅ Проверка трафика завершена. Отправлено уведомлений: {notified_count}")
 
         except Exception as e:
@@ -217,8 +209,6 @@ async def _send_traffic_notification(bot: Bot, config, message: str, level: str)
                 else:
                     db_config.notify_traffic_80_sent = True
                 await session.commit()
-
-        await asyncio.sleep(0.1)
     except TelegramAPIError as e:
         logger.warning(f"Не удалось отправить уведомление {config.user_tg_id}: {e}")
 
@@ -0,0 +1,105 @@
+# tasks/payment_watcher.py
+"""
+Фоновая проверка оплат: вместо ручной кнопки «Проверить оплату» все открытые счета
+опрашиваются пачками через getInvoices, оплаченные выполняются сразу,
+просроченные удаляются. Переходы состояний платежа — в services.payment_service.
+"""
+import asyncio
+import logging
+from typing import Dict, List
+
+from aiogram import Bot
+from sqlalchemy.engine import Row
+
+from config import PaymentConfig
+from services.crypto_pay import get_invoices
+from services.payment_service import (
+    complete_paid_payment, recover_payments, STATUS_DONE, STATUS_PENDING
+)
+from storage.database import async_session_maker, PendingPayment
+from utils.helpers import now_ts
+
+logger = logging.getLogger(__name__)
+
+
+async def _delete_payments(payment_ids: List[str]) -> None:
+    if not payment_ids:
+        return
+    async with async_session_maker() as session:
+        await session.execute(
+            PendingPayment.__table__.delete().where(
+                PendingPayment.payment_id.in_(payment_ids),
+                PendingPayment.status == STATUS_PENDING
+            )
+        )
+        await session.commit()
+
+
+async def _prune_finished_payments() -> None:
+    """Удаляет выполненные счета старше PaymentConfig.STALE_AFTER (неудачные остаются для разбора)."""
+    async with async_session_maker() as session:
+        await session.execute(
+            PendingPayment.__table__.delete().where(
+                PendingPayment.status == STATUS_DONE,
+                PendingPayment.updated_at < now_ts() - PaymentConfig.STALE_AFTER
+            )
+        )
+        await session.commit()
+
+
+async def check_pending_payments(bot: Bot) -> None:
+    """Один проход: статусы всех открытых счетов, пачками через getInvoices."""
+    async with async_session_maker() as session:
+        result = await session.execute(
+            PendingPayment.__table__.select().where(PendingPayment.status == STATUS_PENDING)
+        )
+        rows = result.fetchall()
+    if not rows:
+        return
+
+    by_invoice: Dict[str, Row] = {str(row.bot_invoice_id): row for row in rows}
+    invoice_ids = [int(i) for i in by_invoice if i.isdigit()]
+
+    paid: List[str] = []
+    expired: List[str] = []
+    seen = set()
+    # Клиент сам делит список на запросы по PaymentConfig.BATCH_SIZE id
+    for invoice in await get_invoices(invoice_ids):
+        invoice_id = str(invoice.get("invoice_id"))
+        row = by_invoice.get(invoice_id)
+        if not row:
+            continue
+        seen.add(invoice_id)
+        if invoice.get("status") == "paid":
+            paid.append(row.payment_id)
+        elif invoice.get("status") == "expired":
+            expired.append(row.payment_id)
+
+    # Счета, которых API не знает (удалены или не создались), чистим по возрасту
+    cutoff = now_ts() - PaymentConfig.STALE_AFTER
+    expired.extend(
+        row.payment_id for invoice_id, row in by_invoice.items()
+        if invoice_id not in seen and (row.created_at or 0) < cutoff
+    )
+    if expired:
+        await _delete_payments(expired)
+        logger.info(f"🧹 Удалено просроченных счетов: {len(expired)}")
+
+    if paid:
+        await asyncio.gather(*(complete_paid_payment(bot, payment_id) for payment_id in paid))
+
+
+async def watch_payments(bot: Bot):
+    # Сначала доводим платежи, прерванные перезапуском
+    try:
+        await recover_payments(bot)
+    except Exception as e:
+        logger.error(f"Ошибка при восстановлении платежей: {e}")
+
+    while True:
+        try:
+            await check_pending_payments(bot)
+            await _prune_finished_payments()
+        except Exception as e:
+            logger.error(f"Ошибка в watch_payments: {e}")
+        await asyncio.sleep(PaymentConfig.WATCH_INTERVAL)
@@ -0,0 +1,47 @@
+# tasks/reconcile_task.py
+"""
+Фоновая сверка configs с панелями: раз в ReconcileConfig.INTERVAL все активные сервера
+сверяются (только отчёт), при расхождениях администратор получает сводку.
+Исправление — вручную, кнопкой в карточке сервера.
+"""
+import asyncio
+import logging
+
+from aiogram import Bot
+from aiogram.enums import ParseMode
+
+from config import ADMIN_TELEGRAM_ID, ReconcileConfig
+from services.reconcile_service import reconcile_all_servers, has_discrepancies
+from services.server_registry import server_registry
+
+logger = logging.getLogger(__name__)
+
+
+def _format_summary(reports: list) -> str:
+    lines = ["<b>🔍 Сверка с панелями: найдены расхождения</b>\n"]
+    for report in reports:
+        if "error" in report:
+            lines.append(f"❌ {report['server_id']}: {report['error']}")
+            continue
+        ghosts = report["ghosts"]
+        active = sum(1 for m in report["missing"] if m["active"] and not m["expired"])
+        lines.append(
+            f"🖥️ {report['server_id']}: 👻 без записи в БД — {len(ghosts)} "
+            f"(включены: {sum(1 for c in ghosts if c['enable'])}), "
+            f"🕳 без клиента в панели — {len(report['missing'])} (действующих: {active})"
+        )
+    lines.append("\nПодробности и исправление — в карточке сервера.")
+    return "\n".join(lines)
+
+
+async def reconcile_servers_task(bot: Bot):
+    while True:
+        await asyncio.sleep(ReconcileConfig.INTERVAL)
+        try:
+            reports = await reconcile_all_servers(server_registry.active())
+            problems = [r for r in reports if "error" in r or has_discrepancies(r)]
+            logger.info(f"🔍 Сверка с панелями: серверов {len(reports)}, с расхождениями {len(problems)}")
+            if problems:
+                await bot.send_message(ADMIN_TELEGRAM_ID, _format_summary(problems), parse_mode=ParseMode.HTML)
+        except Exception as e:
+            logger.exception(f"💥 Ошибка в reconcile_servers_task: {e}")
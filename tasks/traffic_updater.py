@@ -1,22 +1,116 @@
 # tasks/traffic_updater.py
 import asyncio
 import logging
-from sqlalchemy import select
+import time
+from sqlalchemy import select, bindparam
+from config import TrafficSyncConfig
 from storage.database import async_session_maker, Config, Server
-from services.xui_manager import XUIManager
+from services.traffic_stats import counter_delta, record_traffic_samples, prune_traffic_history
+from services.xui_manager import get_xui_manager
+from utils.cache import my_configs_cache
 
 logger = logging.getLogger(__name__)
 
 
+async def _sync_server(server_id: str, data: dict) -> int:
+    """
+    Синхронизирует трафик одного сервера: один запрос clientStats, один пакетный UPDATE
+    счётчиков и пакетная запись приростов в историю трафика.
+    Возвращает количество обновлённых конфигов.
+    """
+    server = data["server"]
+    inbound_id = data["inbound_id"]
+    configs = data["configs"]
+    emails = [cfg["client_email"] for cfg in configs if cfg["client_email"]]
+
+    if not emails:
+        return 0
+
+    xui = await get_xui_manager(server)
+
+    # Один запрос на сервер: счётчики всех клиентов inbound из clientStats
+    traffic_data = await xui.get_inbound_client_traffics(inbound_id)
+    sampled_at = int(time.time())
+
+    updates = []
+    deltas = []
+    for cfg in configs:
+        counters = traffic_data.get(cfg["client_email"])
+        if counters is None:
+            continue
+        updates.append({
+            "b_config_id": cfg["config_id"],
+            "b_used_bytes": counters["down"],
+            "b_up_bytes": counters["up"]
+        })
+        deltas.append({
+            "config_id": cfg["config_id"],
+            "up": counter_delta(cfg["prev_up"], counters["up"]) if cfg["prev_up"] is not None else 0,
+            "down": counter_delta(cfg["prev_down"], counters["down"])
+        })
+    missing = len(configs) - len(updates)
+    if missing:
+        logger.warning(f"⚠️ Сервер {server_id}: нет статистики для {missing} конфигов")
+
+    if updates:
+        # Счётчики и история — в одной транзакции, одним executemany на каждую таблицу
+        async with async_session_maker() as upd_session:
+            await upd_session.execute(
+                Config.__table__.update()
+                .where(Config.id == bindparam("b_config_id"))
+                .values(
+                    traffic_used_bytes=bindparam("b_used_bytes"),
+                    traffic_up_bytes=bindparam("b_up_bytes")
+                ),
+                updates
+            )
+            await record_traffic_samples(upd_session, deltas, sampled_at)
+            await upd_session.commit()
+        # Счётчики трафика изменились у многих пользователей сразу
+        my_configs_cache.clear()
+
+    return len(updates)
+
+
+async def _sync_server_guarded(server_id: str, data: dict, semaphore: asyncio.Semaphore) -> int:
+    """Обёртка над _sync_server: глобальный лимит параллелизма, таймаут и замер времени."""
+    async with semaphore:
+        started = time.monotonic()
+        try:
+            updated = await asyncio.wait_for(
+                _sync_server(server_id, data),
+                timeout=TrafficSyncConfig.SERVER_TIMEOUT
+            )
+            logger.info(
+                f"✅ Сервер {server_id}: обновлено {updated} конфигов "
+                f"за {time.monotonic() - started:.2f} с"
+            )
+            return updated
+        except asyncio.TimeoutError:
+            logger.error(
+                f"⏱️ Сервер {server_id}: превышен таймаут {TrafficSyncConfig.SERVER_TIMEOUT} с, пропускаем"
+            )
+        except Exception as e:
+            logger.error(
+                f"❌ Ошибка при обновлении сервера {server_id} "
+                f"(через {time.monotonic() - started:.2f} с): {e}"
+            )
+        return 0
+
+
 async def update_all_traffic():
     """
     Обновляет трафик всех активных конфигов.
-    Группирует конфиги по серверам, чтобы минимизировать количество входов в панель.
+    Группирует конфиги по серверам: на каждый сервер — один запрос списка inbound'ов
+    (clientStats) и один пакетный UPDATE, независимо от числа клиентов.
+    Сервера обрабатываются параллельно (не более MAX_CONCURRENT_SERVERS одновременно),
+    каждый — со своим таймаутом, поэтому зависшая панель не задерживает остальные.
     """
     while True:
         try:
             logger.info("🔄 Запуск обновления трафика со всех серверов...")
-            
+            cycle_started = time.monotonic()
+
             # === ШАГ 1: Получаем данные и КОПИРУЕМ их в простые структуры ===
             config_data_list = []
             async with async_session_maker() as session:
@@ -29,20 +123,16 @@ async def update_all_traffic():
                     config_data_list.append({
                         "config_id": config.id,
                         "client_email": config.client_email,
+                        "prev_up": config.traffic_up_bytes,
+                        "prev_down": config.traffic_used_bytes or 0,
                         "server_id": server.id,
-                        "server_data": {
-                            # === КЛЮЧЕВОЕ ИЗМЕНЕНИЕ: Используем ТОЧНЫЕ имена аргументов XUIManager ===
-                            "base_url": server.xui_url,
-                            "username": server.xui_username,
-                            "password": server.xui_password,
-                            "server_id": server.id
-                        },
+                        "server": server,
                         "inbound_id": server.inbound_id
                     })
 
             if not config_data_list:
                 logger.info("ℹ️ Нет активных конфигов для обновления.")
-                await asyncio.sleep(3600)
+                await asyncio.sleep(TrafficSyncConfig.INTERVAL)
                 continue
 
             # === ШАГ 2: Группируем данные ВНЕ сессии ===
@@ -50,65 +140,46 @@ async def update_all_traffic():
             for item in config_data_list:
                 sid = item["server_id"]
                 servers_grouped.setdefault(sid, {
-                    "server_data": item["server_data"],
+                    "server": item["server"],
                     "inbound_id": item["inbound_id"],
                     "configs": []
                 })
                 servers_grouped[sid]["configs"].append({
                     "config_id": item["config_id"],
-                    "client_email": item["client_email"]
+                    "client_email": item["client_email"],
+                    "prev_up": item["prev_up"],
+                    "prev_down": item["prev_down"]
                 })
 
-            updated_count = 0
-            for server_id, data in servers_grouped.items():
-                server_info = data["server_data"]
-                inbound_id = data["inbound_id"]
-                configs = data["configs"]
-                emails = [cfg["client_email"] for cfg in configs if cfg["client_email"]]
-
-                if not emails:
-                    continue
-
-                try:
-                    # === Теперь аргументы совпадают! ===
-                    xui = XUIManager(**server_info)
-                    await xui.ensure_login()
-
-                    traffic_data = {}
-                    for email in emails:
-                        try:
-                            used_bytes = await xui.get_client_traffic(email)
-                            traffic_data[email] = used_bytes
-                        except Exception as e:
-                            logger.warning(f"⚠️ Не удалось получить трафик для {email} на {server_id}: {e}")
-                            traffic_data[email] = 0
-
-                    await xui.close()
-
-                    # === ШАГ 3: Обновляем БД в НОВОЙ сессии ===
-                    async with async_session_maker() as upd_session:
-                        for cfg in configs:
-                            used_bytes = traffic_data.get(cfg["client_email"], 0)
-                            await upd_session.execute(
-                                Config.__table__.update()
-                                .where(Config.id == cfg["config_id"])
-                                .values(traffic_used_bytes=str(used_bytes))
-                            )
-                        await upd_session.commit()
-
-                    updated_count += len(configs)
-                    logger.info(f"✅ Сервер {server_id}: обновлено {len(configs)} конфигов")
-
-                except Exception as e:
-                    logger.error(f"❌ Ошибка при обновлении сервера {server_id}: {e}")
-                    if 'xui' in locals():
-                        await xui.close()
-
-                await asyncio.sleep(1)
-
-            logger.info(f"✅ Обновление трафика завершено. Всего обновлено: {updated_count} конфигов")
+            # === ШАГ 3: Параллельно синхронизируем сервера ===
+            semaphore = asyncio.Semaphore(TrafficSyncConfig.MAX_CONCURRENT_SERVERS)
+            results = await asyncio.gather(*(
+                _sync_server_guarded(server_id, data, semaphore)
+                for server_id, data in servers_grouped.items()
+            ))
+            updated_count = sum(results)
+
+            logger.info(
+                f"✅ Обновление трафика завершено за {time.monotonic() - cycle_started:.2f} с. "
+                f"Всего обновлено: {updated_count} конфигов"
+            )
 
         except Exception as e:
             logger.exception(f"💥 Критическая ошибка в update_all_traffic: {e}")
 
-        await asyncio.sleep(3600)
+        await asyncio.sleep(TrafficSyncConfig.INTERVAL)
+
+
+async def prune_traffic_history_task():
+    """Фоновая задача: раз в сутки прореживает историю трафика по срокам хранения."""
+    while True:
+        try:
+            samples, daily = await prune_traffic_history(
+                TrafficSyncConfig.RAW_SAMPLES_RETENTION_DAYS,
+                TrafficSyncConfig.DAILY_ROLLUP_RETENTION_DAYS
+            )
+            logger.info(f"🧹 История трафика прорежена: сырых записей {samples}, дневных сумм {daily}")
+        except Exception as e:
+            logger.exception(f"💥 Ошибка при прореживании истории трафика: {e}")
+
+        await asyncio.sleep(24 * 3600)
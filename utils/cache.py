@@ -0,0 +1,70 @@
+# utils/cache.py
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+from config import CacheConfig
+
+
+class TTLCache:
+    """
+    In-memory кэш с временем жизни записей и вытеснением давно не используемых (LRU).
+    Рассчитан на один event loop: операции синхронные, блокировки не нужны.
+    """
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        expires_at, value = item
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        """Сохраняет значение; ttl сокращает время жизни относительно стандартного."""
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: Hashable) -> None:
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "evictions": self.evictions,
+        }
+
+
+# Отрисованный список «Мои конфиги» (текст и клавиатура) по tg_id пользователя
+my_configs_cache = TTLCache(CacheConfig.MY_CONFIGS_TTL, CacheConfig.MY_CONFIGS_MAX_ENTRIES)
+
+
+def invalidate_user_configs(user_id) -> None:
+    """Сбрасывает кэш «Мои конфиги» пользователя после изменения его конфигов."""
+    my_configs_cache.invalidate(str(user_id))
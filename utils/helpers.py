@@ -4,6 +4,8 @@ import string
 from datetime import datetime, timezone
 from typing import Union, Optional
 
+from dateutil.relativedelta import relativedelta
+
 from config import STABLE_BASE_PRICES, MOBILE_BASE_PRICES
 
 # Маппинг дней → код тарифа
@@ -76,6 +78,26 @@ def bytes_to_gb(bytes_value: int) -> float:
     """Конвертирует байты в гигабайты."""
     return bytes_value / (1024 ** 3)
 
+def now_ts() -> int:
+    """Текущее время в unix time (сек, UTC)."""
+    return int(datetime.now(timezone.utc).timestamp())
+
+def to_ts(dt: datetime) -> int:
+    """Конвертирует datetime в unix time. Наивные datetime считаются UTC."""
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp())
+
+def from_ts(ts: Optional[int]) -> Optional[datetime]:
+    """Конвертирует unix time в datetime (UTC). None остаётся None."""
+    if ts is None:
+        return None
+    return datetime.fromtimestamp(ts, timezone.utc)
+
+def add_months_ts(ts: int, months: int = 1) -> int:
+    """Прибавляет к unix time календарные месяцы (31 января + 1 месяц = 28/29 февраля)."""
+    return to_ts(from_ts(ts) + relativedelta(months=months))
+
 async def get_next_config_number(user_id: str) -> int:
     """
     Возвращает номер следующего конфига для пользователя.
@@ -108,10 +108,34 @@ def _extract_network_params(stream_settings: Dict[str, Any]) -> Dict[str, str]:
     }
 
 
+def parse_inbound_params(inbound: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Извлекает из inbound только то, что нужно для ссылок (без списка клиентов).
+    
+    Args:
+        inbound: Данные inbound из 3x-ui API
+    
+    Returns:
+        Словарь: port, security, reality (pbk, sni, sid, ...), network (тип транспорта)
+    """
+    stream_settings_json = inbound.get("streamSettings", "{}")
+    if isinstance(stream_settings_json, str):
+        stream_settings = json.loads(stream_settings_json or "{}")
+    else:
+        stream_settings = stream_settings_json or {}
+    
+    return {
+        "port": inbound.get("port", 443),
+        "security": stream_settings.get("security"),
+        "reality": _extract_reality_params(stream_settings),
+        "network": _extract_network_params(stream_settings)
+    }
+
+
 def build_vless_reality_link(
     client_uuid: str,
     server_ip: str,
-    inbound: Dict[str, Any],
+    inbound_params: Dict[str, Any],
     user_id: int,
     config_number: int,
     random_prefix: str,
@@ -123,7 +147,7 @@ def build_vless_reality_link(
     Args:
         client_uuid: UUID клиента
         server_ip: IP-адрес сервера
-        inbound: Данные inbound из 3x-ui API
+        inbound_params: Параметры inbound из parse_inbound_params
         user_id: Telegram ID пользователя
         config_number: Номер конфигурации
         random_prefix: Случайный префикс для подписки
@@ -134,19 +158,12 @@ def build_vless_reality_link(
     """
     try:
         # Проверяем тип безопасности
-        stream_settings_json = inbound.get("streamSettings", "{}")
-        if isinstance(stream_settings_json, str):
-            stream_settings = json.loads(stream_settings_json)
-        else:
-            stream_settings = stream_settings_json
-        
-        if stream_settings.get("security") != "reality":
+        if inbound_params["security"] != "reality":
             raise ValueError("Требуется REALITY security")
         
-        # Извлекаем параметры
-        reality_params = _extract_reality_params(stream_settings)
-        network_params = _extract_network_params(stream_settings)
-        port = inbound.get("port", 443)
+        reality_params = inbound_params["reality"]
+        network_params = inbound_params["network"]
+        port = inbound_params["port"]
         
         # Формируем remark
         remark = f"Reality-{random_prefix_email}_{user_id}_{config_number}"